@@ -6,102 +6,97 @@
 # Email: l.remaggi@surrey.ac.uk
 # 11/01/2018
 
-from scipy import signal
 import numpy as np
-from audiolazy import lazy_lpc as lpc
+from LinearPrediction import lpc
 from Utility import Utility
 
+# Peaks are searched only within the first CUTOFF_SAMPLES samples of the RIR
+CUTOFF_SAMPLES = 5000
+
 
 class Peakpicking:
 
-    def __init__(self, RIR, fs, groupdelay_threshold, use_LPC=1, cutoff_samples=5000, nLPC=12):
-        self.RIR = RIR
+    def __init__(self, RIR, fs, groupdelay_threshold, use_LPC=1, cutoff_samples=CUTOFF_SAMPLES, nLPC=12,
+                 cluster_tolerance=0.00025):
+        self.RIR = RIR  # One channel, or several channels (one per column) whose peaks are clustered together
         self.fs = fs
         self.groupdelay_threshold = groupdelay_threshold
         self.use_LPC = use_LPC
         self.cutoff_samples = cutoff_samples
         self.nLPC = nLPC
-        self.p_pos = None
+        self.cluster_tolerance = cluster_tolerance  # Largest gap (s) between peaks of the same cluster (multi-channel)
+        self.peak_locs = None  # Positions of the peaks (samples), in ascending order
+        self.peak_vals = None  # Normalized values of the peaks
+        self.peak_support = None  # Number of channels in which each peak was found
+        self.l_rir = None
 
     def DYPSA(self):
-        # This method estimates the position of peaks in a room impulse response by applying the DYPSA algorithm
+        # This method estimates the position of peaks in a room impulse response by applying the DYPSA algorithm.
+        # With a multi-channel RIR (e.g. the four B-format channels, or beams steered in different directions), the
+        # matched filtering and the group delay are calculated for all the channels together, and the peaks found in
+        # the different channels are then merged by clustering_dypsa
+        from scipy import signal
 
         # Check that cutoff_samples is integer
         cutoff_samples = np.int_(self.cutoff_samples)
 
-        # General variables internal to this method
-        prev_rir = self.RIR * 1  # This is defined to allow future changes at the peak positions
-        l_rir = len(self.RIR)
-        internal_RIR = self.RIR * 1
-        internal_RIR[cutoff_samples:l_rir] = 0
+        # General variables internal to this method (the channels are processed as rows)
+        # Floating point RIRs (e.g. float32) are not copied, as only their beginning is analysed in float64
+        prev_rir = np.asarray(self.RIR).reshape(len(self.RIR), -1).T  # Allows future changes at the peaks
+        if not np.issubdtype(prev_rir.dtype, np.floating):
+            prev_rir = prev_rir.astype(float)
+        nChannels, l_rir = prev_rir.shape
+
+        # The RIR after cutoff_samples is set to zero, and only its beginning is analysed: after twice cutoff_samples
+        # the filters below only output their decay (numbers close to the smallest floats, which are slow to process)
+        internal_RIR = prev_rir[:, :2*cutoff_samples].astype(float)
+        internal_RIR[:, cutoff_samples:] = 0
 
         if self.use_LPC == 1:
             # LPC for reduction of amount of data in RIR
             rir_up = signal.decimate(internal_RIR, 2)
-            l_rir_lpc = len(rir_up)
+            l_rir_lpc = rir_up.shape[1]
 
-            # Calculate the matching AR filter based on the RIR
-            ar = lpc.lpc.kautocor(rir_up, self.nLPC)
-            a = np.array(ar.numerator)
-            b = np.array(ar.denominator)
+            # Calculate the matching AR filter of each channel
+            A, _ = lpc(rir_up, self.nLPC)
+            b = np.array([1.0])
 
-            # Convert the filter into a time-reversed impulse response
+            # Convert the filters into time-reversed impulse responses
             impulse = np.zeros(l_rir_lpc)
             impulse[0] = 1
-            matched_forward = signal.lfilter(b, a, impulse)
-            matched = np.flipud(matched_forward)
+            matched = np.stack([np.flipud(signal.lfilter(b, a, impulse)) for a in A])
 
-            # Apply the matched filter to the RIR
-            rir_matched = signal.convolve(rir_up, matched)
-            rir_matched = rir_matched[l_rir_lpc-1:]
+            # Apply the matched filters to the RIR
+            rir_matched = signal.fftconvolve(rir_up, matched, axes=1)
+            rir_matched = rir_matched[:, l_rir_lpc-1:]
 
             # Linearly interpolating
             RIR_new = signal.upfirdn([1], rir_matched, 2)
 
-        # Realigning the new RIR with the original one
-        val_max_new = np.argmax(abs(RIR_new))
-        val_max_old = np.argmax(abs(prev_rir))
-        diff_max = val_max_new - val_max_old
-        if diff_max > 0:
-            del internal_RIR
-            internal_RIR = np.concatenate([RIR_new[diff_max:], np.zeros(diff_max)])
-        elif diff_max < 0:
-            del internal_RIR
-            internal_RIR = np.concatenate([np.zeros(abs(diff_max)), RIR_new[:l_rir-abs(diff_max)]])
-        else:
-            del internal_RIR
-            internal_RIR = RIR_new
+        # Realigning the new RIR with the original one, channel by channel (the channels realigned to different lengths
+        # are padded with zeros to the longest one)
+        realigned = []
+        for idx_chan in range(0, nChannels):
+            val_max_new = np.argmax(abs(RIR_new[idx_chan]))
+            val_max_old = np.argmax(abs(prev_rir[idx_chan]))
+            diff_max = val_max_new - val_max_old
+            if diff_max > 0:
+                realigned.append(np.concatenate([RIR_new[idx_chan, diff_max:], np.zeros(diff_max)]))
+            elif diff_max < 0:
+                realigned.append(np.concatenate([np.zeros(abs(diff_max)), RIR_new[idx_chan, :l_rir-abs(diff_max)]]))
+            else:
+                realigned.append(RIR_new[idx_chan])
+        internal_RIR = np.zeros([nChannels, max([len(channel) for channel in realigned])])
+        for idx_chan in range(0, nChannels):
+            internal_RIR[idx_chan, :len(realigned[idx_chan])] = realigned[idx_chan]
 
         # Running the DYPSA algorithm
-        OriginalDYPSA = Utility(RIR=internal_RIR, fs=self.fs)
+        if not np.any(internal_RIR):
+            raise ValueError('No peak found by DYPSA: the RIR is silent')
+        OriginalDYPSA = Utility(RIR=internal_RIR.T, fs=self.fs)
         peaks_properties = OriginalDYPSA.xewgrdel()
-        tew = peaks_properties.tew
-        sew = peaks_properties.sew
-        y = peaks_properties.y
-        ntew = np.int_(np.round_(tew))
-
-        # This avoids possible problems with sources too close to the microphones
-        if ntew[0] < 0:
-            ntew[0] = 0
-
-        # Create an array which has zeros except for where tew defines peak positions
-        k = 0
-        peaks_init = np.zeros(l_rir)
-        for idx_samp in range(0, len(y)):
-            if k == len(ntew):
-                break
-
-            if idx_samp == ntew[k]:
-                peaks_init[idx_samp] = 1
-                k += 1
-
-        # Peaks taken from the group-delay function where the slope is less than the threshold in input are deleted
-        for idx_sew in range(0, len(sew)):
-            if sew[idx_sew] > self.groupdelay_threshold:
-                peaks_init[ntew[idx_sew]] = 0
-        self.p_pos = peaks_init
-
-        # Normalizing the RIR
+
+        # Normalizing the RIR (all the channels by the same value, so that their peaks can be compared)
         internal_RIR = abs(internal_RIR)
         norm_val = np.max(internal_RIR)
         internal_RIR = internal_RIR / norm_val
@@ -109,39 +104,119 @@ class Peakpicking:
         # Take the neighbourhood of the calculated position in the signal (which corresponds in total to 1ms) taking the rms
         # of the energy
         half_win = int(round(self.fs/2000))
-        for idx_samp in range(0, len(ntew)):
-            center = int(ntew[idx_samp])
-            if (center - half_win) > 0:
-                segment = internal_RIR[center-half_win:center+half_win]
-            else:
-                segment = internal_RIR[0:center+half_win]
 
-            self.p_pos[center] = np.sqrt(np.mean(segment**2))
+        peak_locs = []
+        peak_vals = []
+        for idx_chan in range(0, nChannels):
+            ntew = np.int_(np.round_(peaks_properties.tew[idx_chan]))
+            if len(ntew) == 0:
+                peak_locs.append(np.zeros(0, dtype=int))
+                peak_vals.append(np.zeros(0))
+                continue
+
+            # This avoids possible problems with sources too close to the microphones
+            if ntew[0] < 0:
+                ntew[0] = 0
+
+            # The peaks are kept as a sparse list of positions and values, rather than an array as long as the RIR.
+            # Every position in ntew is given the rms of the RIR around it (this also overrides the group-delay slope
+            # threshold on sew, as in the original implementation)
+            locs = np.where(ntew < 0, ntew + l_rir, ntew)
+            locs, last = np.unique(locs[::-1], return_index=True)  # The last value written at each position
+            centers = ntew[len(ntew) - 1 - last]
+
+            peak_locs.append(locs)
+            peak_vals.append(self._neighbourhood_rms(internal_RIR[idx_chan], centers, half_win))
+
+        if nChannels == 1:
+            peak_locs, peak_vals = peak_locs[0], peak_vals[0]
+            peak_support = np.ones(len(peak_locs), dtype=int)
+        else:
+            # Peaks of the different channels closer than cluster_tolerance are the same reflection
+            peak_locs, peak_vals, peak_support = clustering_dypsa(peak_locs, peak_vals,
+                                                                  int(round(self.cluster_tolerance*self.fs)))
 
         ################################################################
         # From here there are additional improvements to the performance
         ################################################################
-        # First, the array containing the peaks is normalized, and the position of the strongest peak found
-        self.p_pos = self.p_pos / np.max(self.p_pos)
-        ds_pos = int(np.argmax(self.p_pos))
+        # First, the peaks are normalized, and the position of the strongest peak found
+        if len(peak_vals) == 0 or np.max(peak_vals) <= 0:
+            raise ValueError('No peak found by DYPSA')
+        peak_vals = peak_vals / np.max(peak_vals)
+        ds_pos = int(peak_locs[np.argmax(peak_vals)])
 
         # Everything before the direct sound is equal to zero
-        self.p_pos[:ds_pos-1] = 0
+        keep = peak_locs >= (ds_pos - 1 if ds_pos > 0 else l_rir - 1)
+        peak_locs, peak_vals, peak_support = peak_locs[keep], peak_vals[keep], peak_support[keep]
 
         # Deletes small errors by aligning the estimated direct sound position to the one in input
-        ds_pos_gt = int(np.argmax(internal_RIR))
+        ds_pos_gt = int(np.argmax(np.max(internal_RIR, 0)))
         estimation_err = ds_pos_gt - ds_pos
         if estimation_err > 0:
-            self.p_pos = list(self.p_pos)
-            self.p_pos = [[0]*estimation_err + self.p_pos[estimation_err:]]
+            keep = peak_locs >= estimation_err
         elif estimation_err < 0:
-            self.p_pos = list(self.p_pos)
-            self.p_pos = [self.p_pos[abs(estimation_err):] + [0]*abs(estimation_err)]
-        self.p_pos = np.transpose(np.array(self.p_pos))
+            peak_locs = peak_locs + estimation_err
+            keep = peak_locs >= 0
+        else:
+            keep = np.ones(len(peak_locs), dtype=bool)
 
-        return self
+        # Only the non-zero values are peaks
+        keep = keep & (peak_vals != 0)
+        self.peak_locs = peak_locs[keep]
+        self.peak_vals = peak_vals[keep]
+        self.peak_support = peak_support[keep]
+        self.l_rir = l_rir
 
+        return self
 
-def clustering_dypsa():
 
-    return
+    def densePeaks(self):
+        # Returns the peaks as an array as long as the RIR, equal to zero except at the peak positions
+        p_pos = np.zeros(self.l_rir)
+        p_pos[self.peak_locs] = self.peak_vals
+
+        return p_pos
+
+    @staticmethod
+    def _neighbourhood_rms(x, centers, half_win):
+        # rms of x over [center-half_win, center+half_win) for each center, with the slicing rules of Python (windows
+        # starting before the first sample start from it; negative ends count from the end of x)
+        ends = centers + half_win
+        ends = np.clip(np.where(ends < 0, ends + len(x), ends), 0, len(x))
+        starts = np.where(centers - half_win > 0, centers - half_win, 0)
+        starts = np.minimum(starts, ends)
+
+        rms = np.full(len(centers), np.nan)
+        full = (ends - starts) == 2*half_win
+        if np.any(full):
+            windows = x[starts[full, None] + np.arange(0, 2*half_win)]
+            rms[full] = np.sqrt(np.mean(windows ** 2, 1))
+        for idx_peak in np.where(~full & (ends > starts))[0]:
+            rms[idx_peak] = np.sqrt(np.mean(x[starts[idx_peak]:ends[idx_peak]] ** 2))
+
+        return rms
+
+
+def clustering_dypsa(peak_locs, peak_vals, tolerance):
+    # Merges the peaks found by DYPSA in different channels: the peaks of all the channels are sorted by position and
+    # swept once, starting a new cluster wherever the gap from the previous peak is larger than tolerance (samples).
+    # Each cluster is represented by its strongest peak (position and value), and also returns the number of channels
+    # where it was found. The clusters are in ascending order of position
+    channels = np.concatenate([np.full(len(locs), idx_chan) for idx_chan, locs in enumerate(peak_locs)])
+    peak_locs = np.concatenate(peak_locs)
+    peak_vals = np.concatenate(peak_vals)
+
+    order = np.argsort(peak_locs, kind='stable')
+    peak_locs, peak_vals, channels = peak_locs[order], peak_vals[order], channels[order]
+    clusters = np.concatenate([[0], np.cumsum(np.diff(peak_locs) > tolerance)])
+
+    # Strongest peak of each cluster (the earliest one if more than one are equally strong; NaN values are the weakest)
+    ranking = np.lexsort((np.nan_to_num(-peak_vals, nan=np.inf), clusters))
+    first = np.concatenate([[True], clusters[ranking][1:] != clusters[ranking][:-1]])
+    strongest = ranking[first]
+
+    # Number of distinct channels in each cluster
+    pairs = np.unique(np.stack([clusters, channels], 1), axis=0)
+    support = np.bincount(pairs[:, 0], minlength=len(strongest))
+
+    return peak_locs[strongest], peak_vals[strongest], support
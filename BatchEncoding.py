@@ -0,0 +1,320 @@
+#
+# This class runs the RSAO encoder over a corpus of B-format RIRs, listed in a manifest file, and writes one VISR .json
+# file for each RIR. The RIRs are encoded in parallel by a pool of processes, and a summary with the timing of each
+# RIR and the reason of every failure is saved alongside the .json files.
+#
+# The manifest is either a .csv file, with one row per RIR and a header, or a .json file, containing a list of
+# dictionaries. The fields are:
+# * 'wav': path of the .wav file containing the 4 channels of the B-format RIR (W, X, Y, Z), or the channels of a
+#   higher order ambisonic RIR (with the 'ambisonic_format' option). Relative paths are relative to the manifest
+# * 'x', 'y', 'z' (or 'RoomDims' as a list, in .json manifests): dimensions of the room in meters
+# * 'name' (optional): name of the room written in the .json file (default: name of the .wav file, or its path relative
+#   to the manifest, e.g. 'room1_rir', when .wav files in different folders share the same name)
+# * 'output' (optional): path of the output .json file (default: <outdir>/<name>.json)
+# * any of the encoder options in ENCODER_OPTIONS (optional): they override the defaults given to BatchEncoder
+#
+# With save_params, the parameters and encoder settings of each RIR are also saved in a .npz file (see ParameterStore),
+# next to its .json file. With cache, the outputs of each encoder stage are stored in a ResultCache directory shared by
+# all the workers, so that encoding the corpus again (e.g. after changing only the late options) reuses them. With
+# library, the rooms are appended to a single room library file (or to shards of shard_size rooms, see
+# RoomLibraryWriter) as soon as they are encoded, instead of being written to one .json file each. With profile
+# ('time' or 'memory'), the summary also reports the wall time and CPU time (and the peak memory) of each encoder stage
+# for each RIR (see StageProfiler).
+#
+# Usage:
+#   python BatchEncoding.py manifest.csv --outdir JSONs --workers 8 --discrete-mode strongest
+
+import os
+import sys
+import csv
+import json
+import time
+import argparse
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+
+# Encoder options that can be set for the whole batch or for each single RIR, with the type they are converted to
+ENCODER_OPTIONS = {'groupdelay_threshold': float, 'use_LPC': int, 'n_discrete': int, 'discrete_mode': str,
+                   'doa_search': str, 'peak_channels': str, 'ambisonic_format': str, 'precision': str,
+                   'late_analysis': str}
+
+
+class BatchEncoder:
+
+    def __init__(self, manifest, outdir='.', workers=None, options=None, objtype='pointreverb', summary=None,
+                 save_params=False, cache=None, cache_bytes=500*2**20, library=None, shard_size=None,
+                 profile=None):
+        self.manifest = manifest
+        self.outdir = outdir
+        self.workers = workers if workers is not None else os.cpu_count()
+        self.options = options if options is not None else {}
+        self.objtype = objtype
+        self.summaryfile = summary if summary is not None else os.path.join(outdir, 'summary.json')
+        self.save_params = save_params
+        self.cache = cache
+        self.cache_bytes = cache_bytes
+        self.library = library
+        self.shard_size = shard_size
+        self.librarywriter = None
+        self.profile = profile
+        self.entries = None
+        self.results = None
+        self.summary = None
+
+    def run(self):
+        manifest = read_manifest(self.manifest)
+        if not os.path.isdir(self.outdir):
+            os.makedirs(self.outdir)
+
+        start = time.perf_counter()
+        self.resolve(manifest)
+        if self.library is not None:
+            from GenerateJSON import RoomLibraryWriter
+            self.librarywriter = RoomLibraryWriter(filename=self.library, shard_size=self.shard_size,
+                                                   objtype=self.objtype).open()
+        try:
+            crashed = self._run_pool([idx_entry for idx_entry in range(0, len(self.entries))
+                                      if self.entries[idx_entry] is not None], self.workers)
+
+            # A RIR that makes its worker process die (rather than raising an exception) breaks the whole pool. The
+            # jobs that were lost with it are run again one at a time, so that only the culprit is reported as failed
+            for idx_entry in crashed:
+                if self._run_pool([idx_entry], 1):
+                    self.results[idx_entry] = _failure(self.entries[idx_entry], 'Worker process terminated abruptly',
+                                                       0)
+        finally:
+            if self.librarywriter is not None:
+                self.librarywriter.close()
+
+        failed = [result for result in self.results if result['status'] != 'ok']
+        self.summary = {'manifest': self.manifest,
+                        'workers': self.workers,
+                        'total': len(self.results),
+                        'succeeded': len(self.results) - len(failed),
+                        'failed': len(failed),
+                        'wall_time': time.perf_counter() - start,
+                        'rirs': self.results}
+        with open(self.summaryfile, 'w') as outfile:
+            json.dump(self.summary, outfile, indent=1)
+
+        return self
+
+    def resolve(self, manifest):
+        # Resolves the jobs of the manifest entries, before any of them is run. An invalid manifest entry is reported
+        # as failed, without stopping the batch
+        self.entries = [None] * len(manifest)
+        self.results = [None] * len(manifest)
+        for idx_entry in range(0, len(manifest)):
+            try:
+                self.entries[idx_entry] = self._job(manifest[idx_entry])
+            except (KeyError, TypeError, ValueError) as error:
+                wav = manifest[idx_entry].get('wav') if isinstance(manifest[idx_entry], dict) else None
+                self.results[idx_entry] = _failure({'wav': wav}, 'Invalid manifest entry: ' + str(error), 0)
+
+        # Default names clash when .wav files in different folders share the same name: these entries are named after
+        # the path of their .wav file relative to the manifest instead
+        root = os.path.dirname(os.path.abspath(self.manifest))
+        names = {}
+        for idx_entry in range(0, len(manifest)):
+            if self.entries[idx_entry] is not None:
+                names.setdefault(self.entries[idx_entry]['name'], []).append(idx_entry)
+        for idx_entries in names.values():
+            for idx_entry in idx_entries if len(idx_entries) > 1 else []:
+                if not manifest[idx_entry].get('name') and not manifest[idx_entry].get('output'):
+                    path = os.path.splitext(os.path.relpath(self.entries[idx_entry]['wav'], root))[0]
+                    name = '_'.join(part for part in path.split(os.sep) if part not in ('', '.', '..'))
+                    self.entries[idx_entry] = self._job(manifest[idx_entry], name)
+
+        # An entry that would still overwrite the files of a previous entry fails, rather than silently replacing them
+        written = {}
+        for idx_entry in range(0, len(manifest)):
+            if self.entries[idx_entry] is None:
+                continue
+            paths = [os.path.normcase(os.path.abspath(self.entries[idx_entry][key])) for key in ('output', 'params')
+                     if self.entries[idx_entry][key] is not None]
+            clashes = [path for path in paths if path in written]
+            if clashes:
+                self.results[idx_entry] = _failure(self.entries[idx_entry], 'Output file ' + clashes[0] +
+                                                   ' is already written by manifest entry ' +
+                                                   str(written[clashes[0]] + 1), 0)
+                self.entries[idx_entry] = None
+            else:
+                written.update({path: idx_entry for path in paths})
+
+        return self
+
+    def _run_pool(self, idx_entries, workers):
+        # Runs the selected jobs on a pool of processes, and returns the jobs lost because the pool broke
+        crashed = []
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = {pool.submit(encode_rir, self.entries[idx_entry]): idx_entry for idx_entry in idx_entries}
+            for future in as_completed(futures):
+                try:
+                    self.results[futures[future]] = future.result()
+                except BrokenProcessPool:
+                    crashed.append(futures[future])
+                    continue
+
+                # Rooms are appended to the library as they arrive, so the library is never held in memory
+                result = self.results[futures[future]]
+                if 'room' in result:
+                    self.librarywriter.appendentry(result.pop('room'))
+                    result['output'] = self.librarywriter.files[-1]
+
+        return sorted(crashed)
+
+    def _job(self, entry, name=None):
+        # Resolves paths, room dimensions and encoder options of a manifest entry. name replaces the default name
+        if not isinstance(entry, dict):
+            raise TypeError('entries must be objects (or .csv rows), not ' + type(entry).__name__)
+        if not entry.get('wav'):
+            raise ValueError("the 'wav' file is missing")
+        wav = entry['wav']
+        if not os.path.isabs(wav):
+            wav = os.path.join(os.path.dirname(os.path.abspath(self.manifest)), wav)
+        name = entry.get('name') or name or os.path.splitext(os.path.basename(wav))[0]
+
+        if 'RoomDims' in entry:
+            RoomDims = entry['RoomDims']
+        else:
+            RoomDims = [entry.get('x'), entry.get('y'), entry.get('z')]
+
+        options = dict(self.options)
+        for option in ENCODER_OPTIONS:
+            if entry.get(option) not in (None, ''):
+                options[option] = entry[option]
+
+        output = entry.get('output') or os.path.join(self.outdir, name + '.json')
+
+        return {'wav': wav,
+                'name': name,
+                'output': output if self.library is None else None,
+                'params': os.path.splitext(output)[0] + '.npz' if self.save_params else None,
+                'cache': (self.cache, self.cache_bytes) if self.cache is not None else None,
+                'profile': self.profile,
+                'RoomDims': RoomDims,
+                'options': options,
+                'objtype': self.objtype}
+
+
+def read_manifest(path):
+    # Returns the list of entries (dictionaries) in a .csv or .json manifest
+    if os.path.splitext(path)[1].lower() == '.json':
+        with open(path) as infile:
+            entries = json.load(infile)
+    else:
+        with open(path, newline='') as infile:
+            entries = [dict(row) for row in csv.DictReader(infile)]
+
+    return entries
+
+
+def encode_rir(job):
+    # Encodes a single RIR: runs the early and late parameterization and writes the .json file. Any error is returned
+    # in the result instead of being raised, so that it does not stop the batch
+    from scipy.io import wavfile
+    import numpy as np
+    from Encoder_SAO_Bformat import EncoderSAOBFormat
+    from GenerateJSON import GenerateJSON_RSAO
+    from ParameterStore import ParameterStore, encoder_settings
+    from ResultCache import ResultCache
+    from Instrumentation import StageProfiler
+
+    timings = {}
+    start = time.perf_counter()
+    try:
+        RoomDims = [float(dim) for dim in job['RoomDims']]
+        options = {key: ENCODER_OPTIONS[key](val) for key, val in job['options'].items()}
+        if job.get('cache') is not None:
+            options['cache'] = ResultCache(directory=job['cache'][0], max_bytes=job['cache'][1])
+        if job.get('profile'):
+            options['profiler'] = StageProfiler(memory=job['profile'] == 'memory')
+
+        fs, RIRs = wavfile.read(job['wav'])
+        RIRs = np.array(RIRs)
+        timings['load'] = time.perf_counter() - start
+
+        EarlyReflections = EncoderSAOBFormat(RIRs=RIRs, fs=fs, **options)
+        EarlyReflections.direct_and_early_parameterization()
+        timings['early'] = time.perf_counter() - start - sum(timings.values())
+
+        LateReverb = EncoderSAOBFormat(RIRs=RIRs, fs=fs, RoomDims=RoomDims, EarlyProperties=EarlyReflections.param,
+                                       **options)
+        LateReverb.late_parameterization()
+        timings['late'] = time.perf_counter() - start - sum(timings.values())
+
+        JsonFile = GenerateJSON_RSAO(paramEarly=EarlyReflections.param, paramLate=LateReverb.param, name=job['name'],
+                                     maxEarly=EarlyReflections.n_discrete, filename=job['output'],
+                                     objtype=job['objtype'])
+        JsonFile.getobjectvector_roomlibrary()
+        if job['output'] is not None:
+            JsonFile.savejson()
+        timings['json'] = time.perf_counter() - start - sum(timings.values())
+
+        if job.get('params') is not None:
+            settings = encoder_settings(EarlyReflections)
+            settings['RoomDims'] = RoomDims
+            ParameterStore(filename=job['params'], paramEarly=EarlyReflections.param, paramLate=LateReverb.param,
+                           settings=settings).save()
+            timings['params'] = time.perf_counter() - start - sum(timings.values())
+
+    except (Exception, SystemExit):
+        # sys.exit is used by the encoder to reject invalid inputs
+        return _failure(job, traceback.format_exc(), time.perf_counter() - start, timings)
+
+    result = {'wav': job['wav'], 'output': job['output'], 'params': job.get('params'), 'status': 'ok', 'error': None,
+              'time': time.perf_counter() - start, 'stages': timings}
+    if job.get('profile'):
+        result['profile'] = options['profiler'].report()
+    if job['output'] is None:
+        result['room'] = JsonFile.libentry  # Appended to the room library by the main process
+
+    return result
+
+
+def _failure(job, error, elapsed, timings=None):
+    return {'wav': job['wav'], 'output': None, 'params': None, 'status': 'failed', 'error': error, 'time': elapsed,
+            'stages': timings if timings is not None else {}}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Encode a corpus of B-format RIRs into VISR RSAO .json files.')
+    parser.add_argument('manifest', help='.csv or .json file listing the RIRs, room dimensions and encoder options')
+    parser.add_argument('--outdir', default='.', help='directory of the .json files (default: current directory)')
+    parser.add_argument('--workers', type=int, default=None, help='number of processes (default: number of CPUs)')
+    parser.add_argument('--summary', default=None, help='summary file (default: <outdir>/summary.json)')
+    parser.add_argument('--objtype', default='pointreverb', help='object type written in the .json files')
+    parser.add_argument('--save-params', action='store_true', help='also save the parameters of each RIR (.npz file)')
+    parser.add_argument('--cache', default=None, help='directory of the cache of the encoder stages (default: none)')
+    parser.add_argument('--profile', choices=['time', 'memory'], default=None,
+                        help='report the time (and peak memory, slower) of each encoder stage in the summary')
+    parser.add_argument('--cache-size', type=float, default=500, help='maximum size of the cache in MB (default: 500)')
+    parser.add_argument('--library', default=None, help='write all the rooms to this room library file instead')
+    parser.add_argument('--shard-size', type=int, default=None, help='maximum number of rooms in each library file')
+    parser.add_argument('--groupdelay-threshold', type=float, default=None)
+    parser.add_argument('--use-LPC', type=int, default=None)
+    parser.add_argument('--n-discrete', type=int, default=None)
+    parser.add_argument('--discrete-mode', choices=['first', 'strongest'], default=None)
+    parser.add_argument('--doa-search', choices=['grid', 'refine'], default=None)
+    parser.add_argument('--peak-channels', choices=['W', 'WXYZ', 'beams'], default=None)
+    parser.add_argument('--ambisonic-format', choices=['WXYZ', 'SN3D', 'N3D'], default=None)
+    parser.add_argument('--precision', choices=['float64', 'float32'], default=None)
+    parser.add_argument('--late-analysis', choices=['full', 'multirate'], default=None)
+    args = parser.parse_args()
+
+    defaults = {option: getattr(args, option) for option in ENCODER_OPTIONS if getattr(args, option) is not None}
+    batch = BatchEncoder(manifest=args.manifest, outdir=args.outdir, workers=args.workers, options=defaults,
+                         objtype=args.objtype, summary=args.summary, save_params=args.save_params,
+                         cache=args.cache, cache_bytes=int(args.cache_size*2**20), library=args.library,
+                         shard_size=args.shard_size, profile=args.profile)
+    batch.run()
+
+    print('Encoded ' + str(batch.summary['succeeded']) + ' of ' + str(batch.summary['total']) + ' RIRs in ' +
+          '{:0.1f}'.format(batch.summary['wall_time']) + 's (summary in ' + batch.summaryfile + ')')
+    for idx_entry in range(0, len(batch.results)):
+        if batch.results[idx_entry]['status'] != 'ok':
+            print('FAILED: ' + (batch.results[idx_entry]['wav'] or 'manifest entry ' + str(idx_entry + 1)) + ' (' +
+                  batch.results[idx_entry]['error'].strip().splitlines()[-1] + ')')
+
+    sys.exit(1 if batch.summary['failed'] else 0)
@@ -1,66 +1,294 @@
 #
 # This class contains some algorithms that are useful for signal processing.
 #
+# The steering works with first-order B-format signals (W, X, Y, Z, with W gain 1 and X, Y, Z gains equal to the
+# direction cosines), and with ambisonic signals of any order in ACN channel ordering, with SN3D or N3D normalization.
+# The steered signal is the product of the ambisonic channels with a steering vector (one weight per channel), and the
+# steering vectors of all the DOAs investigated are precomputed as one (DOAs x channels) matrix.
+#
 # Author: Luca Remaggi
 # Email: l.remaggi@surrey.ac.uk
 # 05/02/2018
 
+import math
 import numpy as np
 
+# Cache of the steering direction tables, one for each dimension setting. Each table is computed the first time it is
+# needed and then shared by all the Beamformers objects (i.e. by all the reflections of all the RIRs)
+_direction_tables = {}
+
 
 class Beamformers:
 
-    def __init__(self, signal, d=1, dimension='3D'):
+    def __init__(self, signal, d=1, dimension='3D', search='grid', n_coarse=128, resolution=0.01,
+                 ambisonic_format='WXYZ'):
         self.signal = signal
-        self.d = d
+        self.d = d  # Directivity of the first-order beams (1: cardioid); higher orders use in-phase beams
+        self.ambisonic_format = ambisonic_format  # 'WXYZ' (first-order B-format), or ACN 'SN3D' or 'N3D'
         self.dimension = dimension
+        self.search = search  # 'grid': 1 degree exhaustive search, 'refine': coarse scan refined locally
+        self.n_coarse = n_coarse  # Number of DOAs of the coarse scan on the sphere ('refine' only)
+        self.resolution = resolution  # Angular resolution (in degrees) at which refinement stops ('refine' only)
+        self.order = None
         self.az_rad_curr = None
         self.el_rad_curr = None
         self.hBeam = None
 
     def steerBFormat(self):
-        try:
-            self.signal.shape[1] == 4
-        except ValueError:
-            print('To use this beamformer the input must be B-format. The data shape should be Nx4, where N is the '
-                  'number of samples')
-
-        # The four channels
-        W = self.signal[:, 0]
-        X = self.signal[:, 1]
-        Y = self.signal[:, 2]
-        Z = self.signal[:, 3]
+        # The ambisonic channels (W, X, Y, Z for first-order B-format), one per column
+        WXYZ = np.asarray(self.signal, dtype=np.float64)
+        self.order = ambisonic_order(WXYZ.shape[1], self.ambisonic_format)
+
+        if self.search == 'refine':
+            return self._steer_coarse_to_fine(WXYZ)
 
         # Defining the angles under investigation
-        if self.dimension is 'az' or self.dimension is '3D':
+        azimuths, elevations, directions = direction_table(self.dimension)
+
+        # The steered response is linear in the ambisonic channels, i.e. for each DOA it is WXYZ times a steering
+        # vector. The energy of every steered response is then a quadratic form of the covariance of the channels,
+        # which avoids calculating the steered signals for all the DOAs
+        steering = steering_table(self.dimension, self.d, self.order, self.ambisonic_format)
+        covariance = np.dot(WXYZ.T, WXYZ)
+        angular_response = np.sum(np.dot(steering, covariance) * steering, 1)
+
+        # Find the direction of the max energy (the table is ordered azimuth first, so that ties are solved as in the
+        # search over the azimuth x elevation grid)
+        idx_max = int(np.argmax(angular_response))
+        max_az, max_el = np.unravel_index(idx_max, (len(azimuths), len(elevations)))
+        self.az_rad_curr = azimuths[max_az]
+        self.el_rad_curr = elevations[max_el]
+        self.hBeam = np.dot(WXYZ, steering[idx_max])
+
+        return self
+
+    def _steer_coarse_to_fine(self, WXYZ):
+        # Hierarchical DOA search: the energy is first calculated on a coarse and (almost) uniform sampling of the
+        # sphere, then a small grid of DOAs around the current maximum is scanned again and again, each time with a
+        # smaller angular step, until the step reaches the required resolution
+        covariance = np.dot(WXYZ.T, WXYZ)
+        az_free = self.dimension == 'az' or self.dimension == '3D'
+        el_free = self.dimension == 'el' or self.dimension == '3D'
+
+        # Coarse scan. The energy over the sphere can have a second local maximum (e.g. two reflections within the
+        # same segment), therefore both the maximum and the best DOA far from it (more than 60 degrees) are refined
+        azimuths, elevations, step = coarse_table(self.dimension, self.n_coarse)
+        directions = sph2cart(azimuths, elevations)
+        coarse_energy = beam_energy(covariance, directions, self.d, self.order, self.ambisonic_format)
+        idx_starts = [int(np.argmax(coarse_energy))]
+        far = np.dot(directions, directions[idx_starts[0]]) < 0.5
+        if np.any(far):
+            idx_starts.append(int(np.flatnonzero(far)[np.argmax(coarse_energy[far])]))
+
+        az_refined, el_refined, energy = self._refine(covariance, azimuths[idx_starts], elevations[idx_starts], step,
+                                                      az_free, el_free)
+        az_curr = az_refined[np.argmax(energy)]
+        el_curr = el_refined[np.argmax(energy)]
+
+        self.az_rad_curr = np.mod(az_curr, 2*np.pi)
+        self.el_rad_curr = el_curr
+        self.hBeam = np.dot(WXYZ, steering_vectors(sph2cart(az_curr, el_curr), self.d, self.order,
+                                                   self.ambisonic_format)[0])
+
+        return self
+
+    def _refine(self, covariance, az_curr, el_curr, step, az_free, el_free):
+        # Local refinement of each of the starting DOAs in input: a 5x5 grid spanning +-2 steps around the current
+        # maximum, with the step reduced by 3 at each iteration, so that every new grid still contains the region where
+        # the previous maximum could be
+        offsets = np.linspace(-2, 2, 5)
+        az_offsets, el_offsets = np.meshgrid(offsets if az_free else [0], offsets if el_free else [0], indexing='ij')
+        az_offsets = az_offsets.ravel()
+        el_offsets = el_offsets.ravel()
+
+        energy = beam_energy(covariance, sph2cart(az_curr, el_curr), self.d, self.order, self.ambisonic_format)
+        step = step / 2
+        while step > np.radians(self.resolution):
+            # Azimuth steps are scaled so that they correspond to the same arc at any elevation
+            az_step = np.minimum(step / np.maximum(np.cos(el_curr), 1e-6), np.pi / 2)
+            az_grid = az_curr[:, None] + az_offsets[None, :] * az_step[:, None]
+            el_grid = np.clip(el_curr[:, None] + el_offsets[None, :] * step, -np.pi/2, np.pi/2)
+
+            grid_energy = beam_energy(covariance, sph2cart(az_grid.ravel(), el_grid.ravel()), self.d, self.order,
+                                      self.ambisonic_format).reshape(az_grid.shape)
+            idx_max = np.argmax(grid_energy, 1)
+            idx_starts = np.arange(len(az_curr))
+            az_curr = az_grid[idx_starts, idx_max]
+            el_curr = el_grid[idx_starts, idx_max]
+            energy = grid_energy[idx_starts, idx_max]
+            step = step / 3
+
+        return az_curr, el_curr, energy
+
+
+def direction_table(dimension='3D'):
+    # Returns azimuths, elevations and the unit vectors of all the DOAs investigated by the B-format steering, ordered
+    # as a flattened (azimuth x elevation) grid. Tables are calculated only once for each dimension setting
+    if dimension not in _direction_tables:
+        if dimension == 'az' or dimension == '3D':
             azimuths = np.linspace(0, np.pi*2-(np.pi/180), 360)
         else:
             azimuths = np.array([0, np.pi])
 
-        if self.dimension is 'el' or self.dimension is '3D':
+        if dimension == 'el' or dimension == '3D':
             elevations = np.linspace(-np.pi/2, np.pi/2, 181)
         else:
             elevations = np.array([0, np.pi/2])
 
-        # Calculating the steered responses for different angles
-        steeredresp = np.zeros([len(W), len(azimuths), len(elevations)])
-        for iAz in range(0, len(azimuths)):
-            for iEl in range(0, len(elevations)):
-                # Converting from spherical to Cartesian
-                r_x = np.cos(elevations[iEl]) * np.cos(azimuths[iAz])
-                r_y = np.cos(elevations[iEl]) * np.sin(azimuths[iAz])
-                r_z = np.sin(elevations[iEl])
+        # Converting from spherical to Cartesian
+        az_grid, el_grid = np.meshgrid(azimuths, elevations, indexing='ij')
+        directions = sph2cart(az_grid.ravel(), el_grid.ravel())
 
-                # Equation to steer a B-format signal towards a specific DOA
-                steeredresp[:, iAz, iEl] = 0.5 * ((2-self.d)*W + self.d*(r_x*X + r_y*Y + r_z*Z))
+        _direction_tables[dimension] = (azimuths, elevations, directions)
 
-        # Calculates the energy for each DOA
-        angular_response = np.squeeze(np.sum(steeredresp**2, 0))
+    return _direction_tables[dimension]
 
-        # Find the direction of the max energy
-        max_az, max_el = np.where(angular_response == np.max(angular_response))
-        self.az_rad_curr = azimuths[max_az[0]]
-        self.el_rad_curr = elevations[max_el[0]]
-        self.hBeam = steeredresp[:, max_az[0], max_el[0]]
 
-        return self
+def coarse_table(dimension='3D', n_coarse=128):
+    # Returns azimuths and elevations of the DOAs used for the first scan of the coarse-to-fine search, together with
+    # their approximate angular spacing. In 3D the DOAs follow a Fibonacci sampling of the sphere, otherwise the free
+    # angle is sampled every 10 degrees and the other one takes the same two values as in direction_table
+    key = ('coarse', dimension, n_coarse)
+    if key not in _direction_tables:
+        if dimension == '3D':
+            idx_points = np.arange(n_coarse)
+            elevations = np.arcsin(1 - (2*idx_points + 1) / n_coarse)
+            azimuths = np.mod(idx_points * np.pi * (3 - np.sqrt(5)), 2*np.pi)
+            step = np.sqrt(4*np.pi / n_coarse)
+        else:
+            step = np.radians(10)
+            if dimension == 'az':
+                az_axis = np.arange(0, 2*np.pi, step)
+                el_axis = np.array([0, np.pi/2])
+            else:
+                az_axis = np.array([0, np.pi])
+                el_axis = np.linspace(-np.pi/2, np.pi/2, 19)
+            az_grid, el_grid = np.meshgrid(az_axis, el_axis, indexing='ij')
+            azimuths = az_grid.ravel()
+            elevations = el_grid.ravel()
+
+        _direction_tables[key] = (azimuths, elevations, step)
+
+    return _direction_tables[key]
+
+
+def sph2cart(azimuths, elevations):
+    # Unit vectors (one row for each DOA) given azimuths and elevations in radians
+    azimuths = np.atleast_1d(azimuths)
+    elevations = np.atleast_1d(elevations)
+
+    return np.stack([np.cos(elevations) * np.cos(azimuths),
+                     np.cos(elevations) * np.sin(azimuths),
+                     np.sin(elevations)], -1)
+
+
+def steering_table(dimension='3D', d=1, order=1, ambisonic_format='WXYZ'):
+    # Returns the steering vectors of all the DOAs of direction_table, as a (DOAs x channels) matrix. Tables are
+    # calculated only once for each setting
+    key = ('steering', dimension, d, order, ambisonic_format)
+    if key not in _direction_tables:
+        _direction_tables[key] = steering_vectors(direction_table(dimension)[2], d, order, ambisonic_format)
+
+    return _direction_tables[key]
+
+
+def beam_energy(covariance, directions, d=1, order=1, ambisonic_format='WXYZ'):
+    # Energy of the ambisonic signal steered towards each of the directions in input, given the channel covariance
+    steering = steering_vectors(directions, d, order, ambisonic_format)
+
+    return np.sum(np.dot(steering, covariance) * steering, 1)
+
+
+def steering_vectors(directions, d=1, order=1, ambisonic_format='WXYZ'):
+    # Weights of the ambisonic channels steering the signal towards each of the directions in input, one row for each
+    # direction. For first-order B-format the equation is 0.5 * ((2-d)*W + d*(r_x*X + r_y*Y + r_z*Z))
+    if ambisonic_format == 'WXYZ':
+        steering = np.empty([directions.shape[0], 4])
+        steering[:, 0] = 0.5 * (2-d)
+        steering[:, 1:] = 0.5 * d * directions
+
+        return steering
+
+    # In ACN ordering, each channel is weighted by its spherical harmonic in the direction of the beam, times the
+    # weight of its degree. With SN3D normalization the beam pattern is then sum_n(weights[n] * P_n(cos(angle))),
+    # where P_n are the Legendre polynomials and angle is the angle from the steering direction
+    degrees = sh_degrees(order)
+    steering = sh_matrix(directions, order) * beam_weights(order, d)[degrees]
+    if ambisonic_format == 'N3D':
+        steering = steering / np.sqrt(2*degrees + 1)
+
+    return steering
+
+
+def beam_weights(order, d=1):
+    # Weight of each degree of the spherical harmonics. The first order beams are the same as for B-format. The higher
+    # order beams have the in-phase pattern ((1 + cos(angle)) / 2)**order, narrower as the order increases but without
+    # side lobes, whose weights are the coefficients of its Legendre series
+    if order == 1:
+        return np.array([0.5 * (2-d), 0.5 * d])
+
+    return np.polynomial.legendre.poly2leg(np.polynomial.polynomial.polypow([0.5, 0.5], order))
+
+
+def sh_matrix(directions, order):
+    # Real spherical harmonics up to the order in input, for each direction (rows, unit vectors), in ACN channel
+    # ordering and SN3D normalization without the Condon-Shortley phase. Up to the first order, the columns are W, Y,
+    # Z, X with the gains of B-format (1 and the direction cosines)
+    directions = np.atleast_2d(directions)
+    azimuths = np.arctan2(directions[:, 1], directions[:, 0])
+    sin_el = directions[:, 2]
+    cos_el = np.sqrt(directions[:, 0]**2 + directions[:, 1]**2)
+
+    Y = np.zeros([directions.shape[0], (order+1)**2])
+    for m in range(0, order+1):
+        # Associated Legendre functions P_n^m(sin(el)), for n from m to order, by the recursion over n
+        legendre = [math.prod(range(2*m-1, 0, -2)) * cos_el**m]
+        if m < order:
+            legendre.append((2*m+1) * sin_el * legendre[0])
+        for n in range(m+2, order+1):
+            legendre.append(((2*n-1) * sin_el * legendre[-1] - (n+m-1) * legendre[-2]) / (n-m))
+
+        for n in range(m, order+1):
+            norm = math.sqrt((2 if m > 0 else 1) * math.factorial(n-m) / math.factorial(n+m))
+            if m == 0:
+                Y[:, n*n+n] = norm * legendre[n-m]
+            else:
+                Y[:, n*n+n+m] = norm * legendre[n-m] * np.cos(m*azimuths)
+                Y[:, n*n+n-m] = norm * legendre[n-m] * np.sin(m*azimuths)
+
+    return Y
+
+
+def encoding_matrix(directions, order=1, ambisonic_format='WXYZ'):
+    # Gains of the ambisonic channels encoding a plane wave from each of the directions in input (rows, unit vectors),
+    # one row for each direction: W gain 1 and X, Y, Z gains equal to the direction cosines for first-order B-format,
+    # the spherical harmonics in ACN ordering otherwise
+    directions = np.atleast_2d(directions)
+    if ambisonic_format == 'WXYZ':
+        return np.concatenate([np.ones([directions.shape[0], 1]), directions], 1)
+
+    encoding = sh_matrix(directions, order)
+    if ambisonic_format == 'N3D':
+        encoding = encoding * np.sqrt(2*sh_degrees(order) + 1)
+
+    return encoding
+
+
+def sh_degrees(order):
+    # Degree n of each ACN channel up to the order in input
+    return np.int_(np.floor(np.sqrt(np.arange(0, (order+1)**2))))
+
+
+def ambisonic_order(nChannels, ambisonic_format='WXYZ'):
+    # Order of an ambisonic signal given its number of channels
+    if ambisonic_format == 'WXYZ':
+        if nChannels != 4:
+            raise ValueError('B-format (WXYZ) signals have 4 channels, not ' + str(nChannels))
+        return 1
+    elif ambisonic_format == 'SN3D' or ambisonic_format == 'N3D':
+        order = int(round(math.sqrt(nChannels))) - 1
+        if order < 1 or (order+1)**2 != nChannels:
+            raise ValueError('Ambisonic signals of order N have (N+1)^2 channels, not ' + str(nChannels))
+        return order
+    else:
+        raise ValueError("ambisonic_format must be 'WXYZ', 'SN3D' or 'N3D'")
@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+
+# This class contains the decoder of the reverb parameterization model: it re-synthesizes an ambisonic RIR from the
+# RSAO parameters estimated by EncoderSAOBFormat (or read from a VISR .json file, see params_from_json), so that the
+# parameters can be checked against the measured RIR (see roundtrip_metrics).
+#
+# in:
+# * paramEarly, paramLate: parameters of the direct sound and early reflections, and of the late reverberation (the
+#   'param' of the early and of the late stage of EncoderSAOBFormat)
+# * fs: sample frequency
+# * length: number of samples of the RIR (default: the length of the encoded RIR, or 2 s for the parameters read from
+#   a .json file, which do not give it)
+# * order, ambisonic_format: ambisonic order and channel format of the RIR ('WXYZ' for first-order B-format, or
+#   'SN3D', 'N3D' in ACN ordering)
+# * ir_length: number of samples of the impulse responses of the early biquads
+# * seed: seed of the noise of the late reverberation
+#
+# The direct sound and each early reflection are plane waves arriving at their toa from their doa, filtered through
+# their biquads (whose impulse responses have unit energy) and scaled by their level. The late reverberation is
+# diffuse noise (independent in each channel), shaped in each band by the filter bank of the encoder (in the frequency
+# domain, i.e. an FFT convolution), with a linear attack over the attack time followed by the exponential decay. Its
+# level in each band is the one measured by the encoder around the late onset.
+#
+# out:
+# * RIRs: (samples x channels) array
+# * onsets: first sample of the direct sound and of each early reflection
+#
+# Usage:
+#   decoder = DecoderSAOBFormat(paramEarly=Early.param, paramLate=Late.param, fs=fs).synthesize()
+#   roundtrip_metrics(RIRs, decoder.RIRs, fs=fs, onsets=decoder.onsets)
+
+import json
+import numpy as np
+from Encoder_SAO_Bformat import LATE_FCENTRE, LATE_BANDWIDTH, late_windowlength
+
+
+class DecoderSAOBFormat:
+
+    def __init__(self, paramEarly, paramLate, fs=48000, length=None, order=1, ambisonic_format='WXYZ',
+                 ir_length=1024, seed=0):
+        self.paramEarly = paramEarly
+        self.paramLate = paramLate['Late'] if 'Late' in paramLate else paramLate
+        self.fs = fs
+        self.length = length
+        self.order = order
+        self.ambisonic_format = ambisonic_format
+        self.ir_length = ir_length
+        self.seed = seed
+
+        self.RIRs = None
+        self.onsets = None
+
+    def synthesize(self):
+        from Beamformers import sh_degrees
+
+        direct = self.paramEarly['Direct_sound']
+        directOnset = direct.get('toa_notconverted', 0)
+        lateOnset = int(round(directOnset + self.paramLate['toa'] * self.fs))
+        if self.length is None:
+            if 'window_samples' in self.paramLate:
+                self.length = lateOnset + self.paramLate['refattackramplength'] + self.paramLate['window_samples']
+            else:
+                self.length = 2 * self.fs
+
+        self.RIRs = np.zeros([self.length, (self.order + 1)**2])
+        self.earlyParts(directOnset, direct['level'])
+        self.lateReverb(lateOnset, direct['level'], sh_degrees(self.order))
+
+        return self
+
+    def earlyParts(self, directOnset, directLevel):
+        # Adds the direct sound and early reflections, all at once
+        from Beamformers import sph2cart, encoding_matrix
+
+        names = list(self.paramEarly.keys())
+        doas = np.radians(np.array([self.paramEarly[name]['doa'] for name in names], dtype=float))
+        levels = np.array([self.paramEarly[name]['level'] for name in names], dtype=float)
+        levels[1:] = levels[1:] * directLevel  # Reflection levels are relative to the direct sound
+        self.onsets = directOnset + np.int_(np.round(np.array([self.paramEarly[name]['toa'] for name in names],
+                                                              dtype=float) * self.fs))
+        self.onsets[0] = directOnset
+
+        # Impulse responses of the biquads of all the parts, from their frequency responses (the sections of each
+        # part are zero-padded to the largest number of sections with pass-through biquads). The transforms have a
+        # fast length, and the impulse responses are cropped to ir_length
+        from scipy.fft import next_fast_len
+
+        nFFT = next_fast_len(self.ir_length, real=True)
+        sections = max([np.shape(self.paramEarly[name]['filtersos'])[0] for name in names])
+        sos = np.tile(np.array([1., 0, 0, 1, 0, 0]), [len(names), sections, 1])
+        for idx_part in range(0, len(names)):
+            filtersos = np.reshape(self.paramEarly[names[idx_part]]['filtersos'], [-1, 6])
+            sos[idx_part, :filtersos.shape[0], :] = filtersos
+        response = np.prod(np.fft.rfft(sos[:, :, :3], nFFT) / np.fft.rfft(sos[:, :, 3:], nFFT), 1)
+        impulses = np.fft.irfft(response, nFFT)[:, :self.ir_length] * levels[:, None]
+
+        # Each part is a plane wave: its impulse response times the encoding gains of its DOA
+        gains = encoding_matrix(sph2cart(doas[:, 0], doas[:, 1]), self.order, self.ambisonic_format)
+        samples = self.onsets[:, None] + np.arange(0, self.ir_length)[None, :]
+        valid = (samples >= 0) & (samples < self.length)
+        np.add.at(self.RIRs, samples[valid], (impulses[:, :, None] * gains[:, None, :])[valid])
+
+        return self
+
+    def lateReverb(self, lateOnset, directLevel, degrees):
+        # Adds the late reverberation, all the channels of a band at once
+        from scipy import signal
+        from scipy.fft import next_fast_len
+        from FilterGeneration import FilterBank
+
+        nSamples = self.length - lateOnset
+        if nSamples <= 0:
+            return self
+        nBands = len(self.paramLate['expdecays'])
+        fcentre = self.paramLate.get('bandcut', LATE_FCENTRE)
+
+        # Diffuse noise: the 2n+1 channels of degree n share the energy of W (N3D channels have the same energy)
+        rng = np.random.default_rng(self.seed)
+        noise = rng.standard_normal([len(degrees), nSamples])
+        if self.ambisonic_format != 'N3D':
+            noise = noise / np.sqrt(2*degrees + 1)[:, None]
+
+        # Zero-phase band filtering (the squared magnitude response of each band) by FFT convolution, on a transform of
+        # fast length (the noise is zero-padded, and the bands cropped back to nSamples)
+        nFFT = next_fast_len(nSamples, real=True)
+        filterbank = FilterBank(fcentre=fcentre, BW=1, fs=self.fs)
+        filterbank.octaveBankSOS()
+        frequencies = np.fft.rfftfreq(nFFT, 1/self.fs)
+        spectrum = np.fft.rfft(noise, nFFT)
+
+        # Envelopes: linear attack up to the late onset of the encoder, where the level of each band was measured (as
+        # the energy over two windows), then exponential decay
+        attacks = np.array([self.paramLate['attacktimes'][str(iBand + 1)] for iBand in range(0, nBands)]) * self.fs
+        decays = np.array([self.paramLate['expdecays'][str(iBand + 1)] for iBand in range(0, nBands)]) / self.fs
+        levels = np.array([self.paramLate['level'][str(iBand + 1)] for iBand in range(0, nBands)]) * directLevel / \
+            np.array(LATE_BANDWIDTH[:nBands]) / np.sqrt(2 * late_windowlength(self.fs)[:nBands])
+        t = np.arange(0, nSamples)
+
+        # Each band, normalized to the unit variance in W, is shaped by its envelope and added to the RIR
+        for iBand in range(0, nBands):
+            response = np.abs(signal.sosfreqz(filterbank.sos[iBand], worN=frequencies, fs=self.fs)[1])**2
+            band = np.fft.irfft(spectrum * response, nFFT)[:, :nSamples]
+            envelope = levels[iBand] * np.minimum(t / max(attacks[iBand], 1), 1) * \
+                np.exp(decays[iBand] * np.maximum(t - attacks[iBand], 0))
+            self.RIRs[lateOnset:, :] += (band * (envelope / np.std(band[0]))).T
+
+        return self
+
+
+def params_from_json(entry):
+    # Returns the parameters (paramEarly, paramLate) of a VISR room library entry (a dictionary, as written by
+    # GenerateJSON, or the name of its .json file). The levels are relative to the direct sound, which has level 1,
+    # arrives at sample 0 and is not filtered
+    if isinstance(entry, str):
+        with open(entry) as infile:
+            entry = json.load(infile)
+
+    paramEarly = {'Direct_sound': {'toa': 0, 'level': 1.0, 'filtersos': np.array([[1., 0, 0, 1, 0, 0]]),
+                                   'doa': [float(entry['position']['az']), float(entry['position']['el'])]}}
+    for idx_refl, reflection in enumerate(entry['room']['ereflect']):
+        paramEarly['Reflection' + str(idx_refl + 1)] = {
+            'toa': float(reflection['delay']), 'level': float(reflection['level']),
+            'doa': [float(reflection['position']['az']), float(reflection['position']['el'])],
+            'filtersos': np.array([[float(biquad[coefficient]) for coefficient in ['b0', 'b1', 'b2', 'a0', 'a1', 'a2']]
+                                   for biquad in reflection['biquadsos']])}
+
+    lreverb = entry['room']['lreverb']
+    paramLate = {'toa': float(lreverb['delay']), 'refattackramplength': 0}
+    for field, key in [('level', 'level'), ('attacktimes', 'attacktime'), ('expdecays', 'decayconst')]:
+        values = [float(value) for value in lreverb[key].split(',')]
+        paramLate[field] = {str(iBand + 1): values[iBand] for iBand in range(0, len(values))}
+
+    return paramEarly, {'Late': paramLate}
+
+
+def doa_errors(doas, references):
+    # Angles (degrees) between the DOAs in input and the reference ones ([azimuth, elevation] in degrees, last axis)
+    from Beamformers import sph2cart
+
+    doas = np.radians(np.asarray(doas, dtype=float))
+    references = np.radians(np.asarray(references, dtype=float))
+    cosines = np.sum(sph2cart(doas[..., 0], doas[..., 1]) * sph2cart(references[..., 0], references[..., 1]), -1)
+
+    return np.degrees(np.arccos(np.clip(cosines, -1, 1)))
+
+
+def segment_doas(RIRs, onsets, window=64, ambisonic_format='WXYZ', block=16):
+    # DOAs ([azimuth, elevation] in degrees) of the segments of window samples starting at the onsets, found by the
+    # grid steering of Beamformers. RIRs is (RIRs x samples x channels) and onsets is (RIRs x parts). The segments are
+    # steered in blocks of 'block' segments, so that the beam energies of the whole grid are only held for one block
+    from Beamformers import direction_table, steering_table, ambisonic_order
+
+    RIRs = np.asarray(RIRs, dtype=float)
+    onsets = np.asarray(onsets)
+    samples = np.clip(onsets[:, :, None] + np.arange(0, window)[None, None, :], 0, RIRs.shape[1] - 1)
+    segments = RIRs[np.arange(0, RIRs.shape[0])[:, None, None], samples, :]
+    covariances = np.einsum('rpnc,rpnd->rpcd', segments, segments)
+
+    azimuths, elevations, _ = direction_table('3D')
+    steering = steering_table('3D', 1, ambisonic_order(RIRs.shape[2], ambisonic_format), ambisonic_format)
+    covariances = covariances.reshape((-1,) + covariances.shape[2:])
+    best = np.zeros(covariances.shape[0], dtype=int)
+    for first in range(0, covariances.shape[0], block):
+        # Beam energies s'Cs of the block (segments x DOAs), contracted in two steps
+        energies = np.sum((steering @ covariances[first:first + block]) * steering, -1)
+        best[first:first + block] = np.argmax(energies, -1)
+    idx_az, idx_el = np.unravel_index(best.reshape(onsets.shape), (len(azimuths), len(elevations)))
+
+    return np.degrees(np.stack([azimuths[idx_az], elevations[idx_el]], -1))
+
+
+def roundtrip_metrics(measured, decoded, fs=48000, onsets=None, window=64, ambisonic_format='WXYZ'):
+    # Errors of decoded RIRs against the measured ones, for a stack of RIRs ((RIRs x) samples x channels, with the same
+    # number of samples) at once. The energy decay curves of the W channel, in the bands of the late reverberation,
+    # give:
+    # * 'edc_error': mean absolute difference (dB) between the EDCs, down to -30 dB of the measured one (RIRs x bands)
+    # * 'edt', 't30': early decay time and T30 of the measured and decoded RIRs (2 x RIRs x bands, seconds)
+    # * 'edt_error', 't30_error': relative errors of the decoded EDT and T30 (RIRs x bands)
+    # With the onsets of the direct sound and early reflections (RIRs x parts, e.g. DecoderSAOBFormat.onsets):
+    # * 'doa_error': angle (degrees) between the DOAs of the measured and decoded RIRs at the onsets (RIRs x parts)
+    from FilterGeneration import FilterBank
+    from Utility import DecayAnalysis
+
+    single = np.ndim(measured) == 2
+    measured = np.asarray(measured, dtype=float).reshape((-1,) + np.shape(measured)[-2:])
+    decoded = np.asarray(decoded, dtype=float).reshape((-1,) + np.shape(decoded)[-2:])
+    if measured.shape[:2] != decoded.shape[:2]:
+        raise ValueError('Measured ' + str(measured.shape) + ' and decoded ' + str(decoded.shape) +
+                         ' RIRs do not match')
+
+    filterbank = FilterBank(fcentre=LATE_FCENTRE, BW=1, fs=fs)
+    filterbank.filterZeroPhase(np.stack([measured[:, :, 0], decoded[:, :, 0]]))
+    decays = DecayAnalysis(h=np.moveaxis(filterbank.filtered, 0, -2), fs=fs).analyse()  # (2 x RIRs x bands x samples)
+    EDCs = decays.EDC_log
+
+    above = EDCs[0] >= -30
+    metrics = {'edc_error': np.sum(np.abs(EDCs[1] - EDCs[0]) * above, -1) / np.maximum(np.sum(above, -1), 1),
+               'edt': decays.EDT,
+               't30': decays.T30}
+    metrics['edt_error'] = (metrics['edt'][1] - metrics['edt'][0]) / metrics['edt'][0]
+    metrics['t30_error'] = (metrics['t30'][1] - metrics['t30'][0]) / metrics['t30'][0]
+    if onsets is not None:
+        onsets = np.reshape(onsets, (measured.shape[0], -1))
+        metrics['doa_error'] = doa_errors(segment_doas(decoded, onsets, window, ambisonic_format),
+                                          segment_doas(measured, onsets, window, ambisonic_format))
+
+    if single:
+        metrics = {name: value[..., 0, :] for name, value in metrics.items()}
+
+    return metrics
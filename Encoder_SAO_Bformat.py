@@ -3,11 +3,15 @@
 # This class contains the encoder of the reverb parameterization model, described in 
 # Remaggi et al., "Estimation of room reflection parameters for a 
 # reverberant spatial audio object", 138th AES Convention, 2015.
-# This version works with B-format RIRs.
+# This version works with B-format RIRs, and with higher order ambisonic RIRs.
 # 
 # in:
 # * RIRs are impulse responses recorded using a microphone array
 #   (NxM matix, where N is the number of samples, and M the number of microphones) 
+# * ambisonic_format sets the channels of RIRs:
+#   'WXYZ': first-order B-format (4 channels, W, X, Y, Z)
+#   'SN3D', 'N3D': ambisonics of order N ((N+1)^2 channels) in ACN
+#                  channel ordering, with SN3D or N3D normalization
 # * 'fs' is a scalar, corresponding to the sample frequency of RIRs. 
 # *  groupdelay_threshold sets the threshold at which the
 #    slope of the group delay zero crossing is considered to be a reflection e.g -0.05 
@@ -20,12 +24,49 @@
 # * discrete_mode sets the behaviour to return:
 #   'first': the first n_discrete reflections
 #   'strongest': the strongest n_discrete reflections
+# * peak_channels sets the signals where the reflections are detected:
+#   'W': the omnidirectional channel (default)
+#   'WXYZ': the four B-format channels, with the peaks of all the channels
+#           clustered together
+#   'beams': six cardioids steered towards +-x, +-y and +-z, with the
+#            peaks of all the beams clustered together
 # * late_mode sets the behaviour of the late estimation:
 #   'data': uses the mean perceptual mixing time based over all RIR chans
 #   'model': uses the perceptual mixing time based on the given room
 #           dimensions
 # * roomDims gives the ground truth room dimensions [l,w,h] or [] if not
 #    used
+# * doa_search sets how the DOAs are estimated by the B-format steering:
+#   'grid': exhaustive search over a 1 degree grid (DOAs rounded to degrees)
+#   'refine': coarse scan of the sphere followed by a local refinement
+#             (sub-degree DOAs)
+# * late_fit_iterations sets the number of iterations refining the
+#   exponential fit of the late decays (0: closed-form log-linear fit only)
+# * cache is a ResultCache object, storing the outputs of each stage on disk
+#   so that they are not estimated again for the same RIR and options, or
+#   None (no cache)
+# * workers sets the number of threads running the independent parts of
+#   each stage at the same time (the steering of each reflection, the
+#   filtering and decay of each late band), or None to run them one after
+#   the other. The parameters do not depend on it
+# * precision sets the floating point type of the large arrays (the RIRs,
+#   the filtered bands and the energy decay curves of the late stage):
+#   'float64' (default) or 'float32', which halves their memory. The steps
+#   sensitive to rounding (IIR band filtering, EDC cumulative sums, LPC,
+#   group delay and decay fit) still accumulate in float64
+# * late_analysis sets how the bands of the late reverberation are analysed:
+#   'full': every band at fs (default)
+#   'multirate': each band at the lowest rate of a tree of half-band
+#                decimators where it stays below an eighth of the Nyquist
+#                frequency (see late_decimation), which makes the filtering and
+#                energy decay of the low bands up to 32 times cheaper. On the
+#                example RIR the late levels change by about 1%, and the decay
+#                constants by less than 0.3%
+# * profiler is a StageProfiler object, measuring the wall time, CPU time
+#   and peak memory of each stage of the parameterization (the
+#   measurements are also available in the 'report' attribute), or None.
+#   The stages are then run one after the other, whatever workers is, as
+#   the peak memory (tracemalloc) of concurrent stages is not separable
 #
 # out:
 # 'parameters' is a data structure, containing the parameters
@@ -50,21 +91,50 @@
 import numpy as np
 import sys
 import math
-from scipy import signal
-from audiolazy import lazy_lpc as lpc
-from RIR_Segmentation import Segmentation
-from Beamformers import Beamformers
-from MixingTime_Estimation import EstimatePerceptualMixingTime
-from FilterGeneration import FilterGeneration
-from Utility import DecayCalculation
-from scipy import optimize
-from Utility import Biquad_Convertion
+from contextlib import nullcontext
+from Instrumentation import logger
+from TaskGraph import TaskGraph
+
+# The modules of the early and late parameterization (and scipy, which they depend on) are imported by the methods
+# using them, so that importing the encoder, or running only one of the two stages, stays cheap
+
+# Centre frequencies of the bands of the late reverberation
+LATE_FCENTRE = [1000*2**idx for idx in range(-4, 5)]
+
+# Scaling of the level of each band of the late reverberation
+LATE_BANDWIDTH = [0.3] + [1]*8
+
+
+# Metrics of DecayAnalysis kept in decayMetrics, for each band of the RIR from the direct sound
+DECAY_METRICS = ['EDT', 'T20', 'T30', 'C50', 'C80']
+
+
+def late_decimation(fs):
+    # Decimation factor (a power of 2) at which each band of the late reverberation is analysed in the multirate mode:
+    # the largest one keeping the centre frequency below an eighth of the Nyquist frequency of the decimated signal
+    decimation = np.ones(len(LATE_FCENTRE), dtype=int)
+    for iBand in range(0, len(LATE_FCENTRE)):
+        while LATE_FCENTRE[iBand] * 16 <= fs / (2 * decimation[iBand]):
+            decimation[iBand] *= 2
+
+    return decimation
+
+
+def late_windowlength(fs):
+    # Length of the windows (on each side of the late reverberation onset) over which the level of each band is
+    # estimated: two periods of the centre frequency, up to 10 ms
+    windowlength = np.int_([2*fs/idx for idx in LATE_FCENTRE])
+    windowlength[windowlength > fs/100] = fs/100
+
+    return windowlength
 
 
 class EncoderSAOBFormat:
 
     def __init__(self, RIRs, fs=48000, groupdelay_threshold=-0.05, use_LPC=1,
-                 n_discrete=20, discrete_mode='first', RoomDims=None, EarlyProperties=None):
+                 n_discrete=20, discrete_mode='first', RoomDims=None, EarlyProperties=None, doa_search='grid',
+                 late_fit_iterations=20, cache=None, profiler=None, peak_channels='W', ambisonic_format='WXYZ',
+                 workers=None, precision='float64', late_analysis='full'):
         # Including input variables in self
         self.RIRs = RIRs
         self.fs = fs
@@ -72,10 +142,28 @@ class EncoderSAOBFormat:
         self.use_LPC = use_LPC
         self.n_discrete = n_discrete
         self.discrete_mode = discrete_mode
+        self.peak_channels = peak_channels
+        self.ambisonic_format = ambisonic_format
         self.RoomDims = RoomDims
         self.EarlyProperties = EarlyProperties
-
-        print("Assuming RIRs presented in B-Format (WXYZ)")
+        self.doa_search = doa_search
+        self.late_fit_iterations = late_fit_iterations
+        self.cache = cache
+        self._rir_digest = None
+        self.profiler = profiler
+        self.report = None
+        self.workers = workers
+        self.precision = precision
+        self.late_analysis = late_analysis
+        self.filteredBands = None  # W channel filtered through each band of the late reverberation
+        self.bandDecimation = None  # Decimation factor of each filtered band (multirate late analysis)
+        self.decayMetrics = None  # Decay times and clarity of each band of the RIR (see DecayAnalysis)
+        self.mixingTime = None  # Model-based mixing time estimate of the room (see EstimatePerceptualMixingTime)
+
+        if ambisonic_format == 'WXYZ':
+            logger.info("Assuming RIRs presented in B-Format (WXYZ)")
+        else:
+            logger.info("Assuming RIRs presented in ACN/" + ambisonic_format + " ambisonics")
         
         # Number of peaks considered as direct sound and early reflections
         self.nPeaks = n_discrete + 1
@@ -87,15 +175,70 @@ class EncoderSAOBFormat:
             RIRs.transpose()
         
         self.nMics = SizeRIRs[1]
-        if self.nMics != 4:
-            sys.exit("1st order (4-channel) B-Format input expected")
+        if ambisonic_format == 'WXYZ':
+            if self.nMics != 4:
+                sys.exit("1st order (4-channel) B-Format input expected")
+            self.order = 1
+        elif ambisonic_format == 'SN3D' or ambisonic_format == 'N3D':
+            self.order = int(round(math.sqrt(self.nMics))) - 1
+            if self.order < 1 or (self.order + 1)**2 != self.nMics:
+                sys.exit("Ambisonic input of order N ((N+1)^2 channels) expected")
+        else:
+            sys.exit("ambisonic_format must be 'WXYZ', 'SN3D' or 'N3D'")
+
+        if precision != 'float64' and precision != 'float32':
+            sys.exit("precision must be 'float64' or 'float32'")
+        self.dtype = np.dtype(precision)
+        if late_analysis != 'full' and late_analysis != 'multirate':
+            sys.exit("late_analysis must be 'full' or 'multirate'")
+        rirDtype = np.asarray(RIRs).dtype
+        if not np.issubdtype(rirDtype, np.floating) or rirDtype.itemsize > self.dtype.itemsize:
+            self.RIRs = np.asarray(RIRs, dtype=self.dtype)  # Integer RIRs (e.g. 16 bit .wav files) are converted too
 
         self.PeakVals = np.zeros([self.nPeaks, self.nMics])
 
         # Defining the outputs
         self.param = {}
+        self.paramLate = None
+
+    def parameterization(self):
+        # Estimates both the early and the late parameters (RoomDims is needed). The late stage only depends on the
+        # direct sound and first reflection parameters, apart from the filtering of its bands, which only depends on the
+        # RIR: with workers, the bands are filtered at the same time as the early stage runs (otherwise, they are
+        # filtered in the 'late.filterbank' stage). The early parameters are in param, and the late ones in paramLate
+        graph = TaskGraph(workers=self._workers())
+        graph.add('early', self.direct_and_early_parameterization)
+        if self.filteredBands is None and self._workers() is not None:
+            graph.add('filterbank', self.late_filterbank)
+        graph.run()
+
+        paramEarly = self.param
+        self.EarlyProperties = paramEarly
+        self.param = {}
+        self.late_parameterization()
+        self.paramLate = self.param
+        self.param = paramEarly
+
+        return self
 
     def direct_and_early_parameterization(self):
+        from RIR_Segmentation import Segmentation
+        from LinearPrediction import lpc
+        from Utility import Biquad_Convertion
+        from ParameterStore import pack_early, unpack_early
+
+        # Reusing the parameters estimated in a previous run, if cached
+        cached, cachedPeaks, cachedTOAs = None, None, None
+        if self.cache is not None:
+            with self._stage('early.cache'):
+                cached = self._cache_get('early')
+                if cached is None:
+                    cachedPeaks = self._cache_get('peaks')
+                    cachedTOAs = self._cache_get('segments')
+        if cached is not None:
+            self.param = unpack_early(cached)
+            self._update_report()
+            return self
 
         # Window length for segmenting direct sound and early reflections
         hamm_lengths = [32]*(self.n_discrete+1)
@@ -103,82 +246,130 @@ class EncoderSAOBFormat:
         hamm_lengths = np.int_(hamm_lengths)
 
         # Segment every channel of the soundfield mic
-        RIR_segments = Segmentation(RIRs=self.RIRs, fs=self.fs,
-                                              groupdelay_threshold=self.groupdelay_threshold,
-                                              use_LPC=self.use_LPC, discrete_mode=self.discrete_mode,
-                                              nPeaks=self.nPeaks, hamm_lengths=hamm_lengths)
-        RIR_segments.segmentation()
+        with self._stage('early.segmentation'):
+            RIR_segments = Segmentation(RIRs=self.RIRs, fs=self.fs,
+                                                  groupdelay_threshold=self.groupdelay_threshold,
+                                                  use_LPC=self.use_LPC, discrete_mode=self.discrete_mode,
+                                                  nPeaks=self.nPeaks, hamm_lengths=hamm_lengths,
+                                                  peak_channels=self.peak_channels,
+                                                  ambisonic_format=self.ambisonic_format,
+                                                  **(cachedPeaks if cachedPeaks is not None else {}))
+            if cachedTOAs is not None:
+                RIR_segments.TOAs_sample_single_mic = cachedTOAs['TOAs']
+                RIR_segments.segmentsFromTOAs()
+            else:
+                RIR_segments.segmentation()
+                if cachedPeaks is None:
+                    self._cache_put('peaks', {'peak_locs': RIR_segments.peak_locs,
+                                              'peak_vals': RIR_segments.peak_vals})
+                self._cache_put('segments', {'TOAs': RIR_segments.TOAs_sample_single_mic})
 
         segments = RIR_segments.segments
         TOAs = RIR_segments.TOAs_sample_single_mic
 
-        # Beamforming from B-format cardioid steering
-        count = 0
-        for idx_refl in segments:
-            reflectionDOA = Beamformers(signal=segments[idx_refl])
-            reflectionDOA.steerBFormat()
-
-            # Amplitude (for valid peaks)
-            ampl_curr = np.sqrt(np.sum(reflectionDOA.hBeam**2))
-
-            # Defining LPC order to estimate colouration
-            LPC_orders = [8]*(self.n_discrete+1)
-            LPC_orders[0] = 16
-
-            # LPC spectrum estimation based on the highest amplitude microphone
-            hLPCRef = reflectionDOA.hBeam  # segments[idx_refl][:, 0]
-            nOD = LPC_orders[count]
-            ar = lpc.lpc.kautocor(hLPCRef, nOD)
-
-            # Saving parameters in a dictionary
-            self.param.update({idx_refl: {'toa': TOAs[count]}})
-            self.param[idx_refl].update({'window_samples': hamm_lengths[count]*2})
-            self.param[idx_refl].update({'doa': [round(math.degrees(reflectionDOA.az_rad_curr)),
-                                                 round(math.degrees(reflectionDOA.el_rad_curr))]})
-            self.param[idx_refl].update({'level': ampl_curr})
-            self.param[idx_refl].update({'filter': ar.numerator})
-
-            # Convert LPC to biquads including normalization
-            earlybiquad = Biquad_Convertion(RSAO_params=self.param, idx_RIR_part_investigated=idx_refl)
-            earlybiquad.lpc2biquad()
-            self.param[idx_refl].update({'filtersos': earlybiquad.filtersos})
-
-            # Convert the levels to be relative to the direct sound's
-            if count > 0:
-                earlybiquad.convertlevels_early()
-                self.param[idx_refl]['level'] = earlybiquad.earlyLevel
-
-            # Convert delays to be relative to the direct sound's
-            if count > 0:
-                if count == 1:
-                    self.param[idx_refl].update({'toa_notconverted': self.param[idx_refl]['toa']})
-
-                earlybiquad.convertdelays_early()
-                self.param[idx_refl]['toa'] = earlybiquad.earlyDelay
-
-            # Convert onset times in seconds
-            if count > 0:
-                self.param[idx_refl]['toa'] = self.param[idx_refl]['toa'] / self.fs
-
-            count += 1
+        # Beamforming from B-format cardioid steering (in-phase beams of the same order for higher order ambisonics)
+        with self._stage('early.steering'):
+            steering = TaskGraph(workers=self._workers())
+            for idx_refl in segments:
+                steering.add(idx_refl, self._steer, [], segments[idx_refl])
+            reflectionDOAs = steering.run().results
+
+        # Defining LPC order to estimate colouration
+        LPC_orders = [8]*(self.n_discrete+1)
+        LPC_orders[0] = 16
+
+        # LPC spectrum estimation of all the beamformed segments at once
+        with self._stage('early.lpc'):
+            LPC_filters, _ = lpc([reflectionDOAs[idx_refl].hBeam for idx_refl in segments], LPC_orders[:len(segments)])
+
+        with self._stage('early.biquads'):
+            count = 0
+            for idx_refl in segments:
+                reflectionDOA = reflectionDOAs[idx_refl]
+
+                # Amplitude (for valid peaks)
+                ampl_curr = np.sqrt(np.sum(reflectionDOA.hBeam**2))
+
+                # Saving parameters in a dictionary
+                self.param.update({idx_refl: {'toa': TOAs[count]}})
+                self.param[idx_refl].update({'window_samples': hamm_lengths[count]*2})
+                if self.doa_search == 'grid':
+                    self.param[idx_refl].update({'doa': [round(math.degrees(reflectionDOA.az_rad_curr)),
+                                                         round(math.degrees(reflectionDOA.el_rad_curr))]})
+                else:
+                    self.param[idx_refl].update({'doa': [math.degrees(reflectionDOA.az_rad_curr),
+                                                         math.degrees(reflectionDOA.el_rad_curr)]})
+                self.param[idx_refl].update({'level': ampl_curr})
+                self.param[idx_refl].update({'filter': LPC_filters[count, :LPC_orders[count]+1]})
+
+                count += 1
+
+            # Convert the LPC filters of all the segments to biquads including normalization
+            biquads = Biquad_Convertion(RSAO_params=self.param)
+            biquads.lpc2biquads()
+
+            count = 0
+            for idx_refl in segments:
+                self.param[idx_refl].update({'filtersos': biquads.filtersos[idx_refl]})
+                earlybiquad = Biquad_Convertion(RSAO_params=self.param, idx_RIR_part_investigated=idx_refl)
+
+                # Convert the levels to be relative to the direct sound's
+                if count > 0:
+                    earlybiquad.convertlevels_early()
+                    self.param[idx_refl]['level'] = earlybiquad.earlyLevel
+
+                # Convert delays to be relative to the direct sound's
+                if count > 0:
+                    if count == 1:
+                        self.param[idx_refl].update({'toa_notconverted': self.param[idx_refl]['toa']})
+
+                    earlybiquad.convertdelays_early()
+                    self.param[idx_refl]['toa'] = earlybiquad.earlyDelay
+
+                # Convert onset times in seconds
+                if count > 0:
+                    self.param[idx_refl]['toa'] = self.param[idx_refl]['toa'] / self.fs
+
+                count += 1
 
         # Convert delay direct sound
         self.param['Direct_sound'].update({'toa_notconverted': self.param['Direct_sound']['toa']})
         self.param['Direct_sound']['toa'] = 0
 
-        self.param
+        self._cache_put('early', pack_early(self.param))
+        self._update_report()
 
         return self
     
     def late_parameterization(self):
+        from MixingTime_Estimation import EstimatePerceptualMixingTime
+        from Utility import DecayFit
+        from Utility import Biquad_Convertion
+        from ParameterStore import pack_early, pack_late, unpack_late
+        from ResultCache import array_digest
+
         if self.RoomDims is None:
             sys.exit("Please, provide the room dimensions in input")
 
-        # Create object to calculate the mixing time
-        mte = EstimatePerceptualMixingTime(RoomDims=self.RoomDims)
-        mte.model_based()
-
-        self.param.update({'Late': {'toa': mte.mixing_time_estimate['model']['tmp50'] * self.fs /
+        # Reusing the parameters estimated in a previous run with the same early parameters, if cached
+        if self.cache is not None:
+            with self._stage('late.cache'):
+                earlyArrays = pack_early(self.EarlyProperties)
+                earlyDigest = array_digest(*[earlyArrays[name] for name in sorted(earlyArrays)])
+                cached = self._cache_get('late', earlyDigest)
+            if cached is not None:
+                self.param = {'Late': unpack_late(cached)}
+                self._update_report()
+                return self
+
+        # Create object to calculate the mixing time (unless already given, e.g. by a RoomSession)
+        with self._stage('late.mixing_time'):
+            if self.mixingTime is None:
+                mte = EstimatePerceptualMixingTime(RoomDims=self.RoomDims)
+                mte.model_based()
+                self.mixingTime = mte.mixing_time_estimate
+
+        self.param.update({'Late': {'toa': self.mixingTime['model']['tmp50'] * self.fs /
                                            1000 + self.EarlyProperties['Direct_sound']['toa_notconverted'] + 100}})
         self.param['Late'].update({'refattackramplength': math.floor(self.param['Late']['toa'] -
                                                           self.EarlyProperties['Reflection1']['toa_notconverted'])})
@@ -190,76 +381,66 @@ class EncoderSAOBFormat:
         estimateDrop = -20  # Drop in late energy over which to estimate level and decay
 
         # Defining the filter bank properties
-        fcentre = [1000*2**idx for idx in range(-4, 5)]
-        bandwidth = [1]*10
-        bandwidth[0] = 0.3
-        maxwindowlength = self.fs/100
-        windowlength = np.int_([2*self.fs/idx for idx in fcentre])
-        for iW in range(0, len(windowlength)):
-            if windowlength[iW] > maxwindowlength:
-                windowlength[iW] = maxwindowlength
+        fcentre = LATE_FCENTRE
+        bandwidth = LATE_BANDWIDTH
+        windowlength = late_windowlength(self.fs)
         self.param['Late'].update({'bandcut': fcentre})
 
-        # Generating the filter bank and calculating the RIR decays
-        for iBand in range(0, len(fcentre)):
-            if iBand == 0:
-                LowPass = FilterGeneration(f0=fcentre[iBand], BW=1, fs=self.fs)
-                LowPass.lowpassCoefficientsBW()
-                b = LowPass.b
-                a = LowPass.a
-
-            elif iBand == len(fcentre)-1:
-                HighPass = FilterGeneration(f0=fcentre[iBand], BW=1, fs=self.fs)
-                HighPass.highpassCoefficientsBW()
-                b = HighPass.b
-                a = HighPass.a
-
-            else:
-                BandPass = FilterGeneration(f0=fcentre[iBand], BW=1, fs=self.fs)
-                BandPass.bandpassCoefficientsBW()
-                b = BandPass.b
-                a = BandPass.a
-
-            # Backwards integration
-            FilteredLate = signal.filtfilt(b, a, hLate[:, 0])
-            FilteredFull = signal.filtfilt(b, a, self.RIRs[:, 0])
-
-            # Decay estimate
-            decay = DecayCalculation(h=np.abs(FilteredLate), fs=self.fs)
-            decay.RT_Shroeder()
-            estimateStop = np.argmin(np.abs(decay.EDC_log - (-20)))
-
-            # Fitting the decays with an exponential
-            time = np.linspace(0, estimateStop, estimateStop)
-            fitfunc = lambda p, x: p[0]*np.exp(p[1]*x)  # Target function
-            errfunc = lambda p, x, y: fitfunc(p, x) - y  # Distance to the target function
-            fit_init = [np.max(decay.EDC), -0.5]  # Initial guess for the parameters
-            fit_tmp, success = optimize.leastsq(errfunc, fit_init[:], args=(time, decay.EDC[0:estimateStop]))
-            try:
-                success == 1
-            except OverflowError:
-                print('Overflow encountered, possibly in the np.exp function')
-
-            fitresult = fit_tmp[1] / 2
-
-            # Estimating reverberation energy
-            lateEnergy = np.sum(FilteredFull[lateFirstSample:lateFirstSample+estimateStop] ** 2)
-            est_energy = np.sqrt(np.sum(FilteredFull[lateFirstSample-windowlength[iBand]:
-                                        lateFirstSample+windowlength[iBand]] ** 2))
-
-            if iBand == 0:
-                self.param['Late'].update({'expdecays': {str(iBand+1): fitresult}})
-                self.param['Late'].update({'level': {str(iBand + 1): est_energy*bandwidth[iBand]}})
-            else:
-                self.param['Late']['expdecays'].update({str(iBand + 1): fitresult})
-                self.param['Late']['level'].update({str(iBand + 1): est_energy*bandwidth[iBand]})
-
-            # Convert late level to be as a proportion of the direct level
-            latebiquad = Biquad_Convertion(RSAO_params=self.param, idx_RIR_part_investigated='Late',
-                                           RSAO_params_directsound=self.EarlyProperties['Direct_sound'],
-                                           iBand_investigated=iBand)
-            latebiquad.convertlevels_late()
-            self.param['Late']['level'][str(iBand + 1)] = latebiquad.lateLevel
+        # Filtering the full RIR once for all the bands (unless already done by parameterization); the late part of each
+        # band is then a slice of the filtered RIR
+        with self._stage('late.filterbank'):
+            if self.filteredBands is None:
+                self.late_filterbank()
+
+        # Calculating the RIR decays, all the bands analysed at the same rate at once. The bands are analysed from the
+        # direct sound, for the decay times and clarity of the room, and their EDCs from the late reverberation onset
+        directSample = int(self.EarlyProperties['Direct_sound']['toa_notconverted'])
+        with self._stage('late.decays'):
+            decimation = self.bandDecimation if self.bandDecimation is not None else np.ones(len(fcentre), dtype=int)
+            decays = TaskGraph(workers=self._workers())
+            for factor in np.unique(decimation):
+                decays.add(int(factor), self._late_decays, [],
+                           [self.filteredBands[iBand] for iBand in np.flatnonzero(decimation == factor)],
+                           directSample, lateFirstSample, int(factor), estimateDrop)
+            decays.run()
+
+            # The EDCs of the decimated bands are shorter, and zero-padded
+            EDCs = np.zeros([len(fcentre), self.RIRs.shape[0] - lateFirstSample], dtype=self.dtype)
+            estimateStops = np.zeros(len(fcentre), dtype=int)
+            self.decayMetrics = {metric: np.zeros(len(fcentre)) for metric in DECAY_METRICS}
+            for factor in np.unique(decimation):
+                bands = np.flatnonzero(decimation == factor)
+                decay = decays.results[int(factor)]
+                EDCs[bands, :decay.EDC.shape[-1]] = decay.EDC
+                estimateStops[bands] = decay.stops
+                for metric in DECAY_METRICS:
+                    self.decayMetrics[metric][bands] = getattr(decay, metric)
+
+            for iBand in range(0, len(fcentre)):
+                est_energy = self._late_band_energy(self.filteredBands[iBand], lateFirstSample, windowlength[iBand],
+                                                    decimation[iBand])
+                if iBand == 0:
+                    self.param['Late'].update({'level': {str(iBand + 1): est_energy*bandwidth[iBand]}})
+                else:
+                    self.param['Late']['level'].update({str(iBand + 1): est_energy*bandwidth[iBand]})
+
+                # Convert late level to be as a proportion of the direct level
+                latebiquad = Biquad_Convertion(RSAO_params=self.param, idx_RIR_part_investigated='Late',
+                                               RSAO_params_directsound=self.EarlyProperties['Direct_sound'],
+                                               iBand_investigated=iBand)
+                latebiquad.convertlevels_late()
+                self.param['Late']['level'][str(iBand + 1)] = latebiquad.lateLevel
+
+        # Fitting the decays of all the bands with an exponential
+        with self._stage('late.decay_fit'):
+            decayfit = DecayFit(EDC=EDCs, stops=estimateStops, n_iter=self.late_fit_iterations)
+            decayfit.fitExponential()
+        self.param['Late'].update({'expdecays': {str(iBand + 1): decayfit.rate[iBand] / decimation[iBand] / 2
+                                                 for iBand in range(0, len(fcentre))}})
+        self.param['Late'].update({'fitresidual': {str(iBand + 1): decayfit.residual[iBand]
+                                                   for iBand in range(0, len(fcentre))}})
+        self.param['Late'].update({'fitconverged': {str(iBand + 1): bool(decayfit.converged[iBand])
+                                                    for iBand in range(0, len(fcentre))}})
 
         # Convert the reverb TOA assuming that the direct sound arrives at time 0, and populate the attack time based on
         #  the late refattackramplength
@@ -278,4 +459,110 @@ class EncoderSAOBFormat:
 
             self.param['Late']['expdecays'][str(iBand + 1)] = self.param['Late']['expdecays'][str(iBand + 1)] * self.fs
 
+        if self.cache is not None:
+            self._cache_put('late', pack_late(self.param['Late']), earlyDigest)
+        self._update_report()
+
+        return self
+
+    def late_filterbank(self):
+        # Filters the W channel through each band of the late reverberation (concurrently, with workers)
+        from FilterGeneration import FilterBank
+
+        if self.late_analysis == 'multirate':
+            return self._late_filterbank_multirate()
+
+        filterbank = FilterBank(fcentre=LATE_FCENTRE, BW=1, fs=self.fs, dtype=self.dtype)
+        filterbank.octaveBankSOS()
+        bands = TaskGraph(workers=self._workers())
+        for iBand in range(0, len(LATE_FCENTRE)):
+            bands.add(iBand, filterbank.filterBand, [], self.RIRs[:, 0], iBand)
+        self.filteredBands = np.array(list(bands.run().results.values()))
+
+        return self
+
+    def _late_filterbank_multirate(self):
+        # Filters the W channel through each band of the late reverberation at the rate given by late_decimation. The
+        # decimated signals come from a tree of zero-phase half-band decimators (each level decimates the previous
+        # one by 2), and each band is designed for the rate it is filtered at
+        from scipy import signal
+        from FilterGeneration import band_sos, zero_phase_filter
+
+        self.bandDecimation = late_decimation(self.fs)
+        decimated = [np.asarray(self.RIRs[:, 0], dtype=float)]
+        while len(decimated) < int(np.log2(np.max(self.bandDecimation))) + 1:
+            decimated.append(signal.decimate(decimated[-1], 2, ftype='fir', zero_phase=True))
+
+        bands = TaskGraph(workers=self._workers())
+        for iBand in range(0, len(LATE_FCENTRE)):
+            level = int(np.log2(self.bandDecimation[iBand]))
+            bands.add(iBand, zero_phase_filter, [], band_sos(LATE_FCENTRE, iBand, 1, self.fs / 2**level),
+                      decimated[level], self.dtype)
+        self.filteredBands = list(bands.run().results.values())
+
         return self
+
+    def _steer(self, segment):
+        # Direction of arrival and beam of one segment (a task of the steering stage)
+        from Beamformers import Beamformers
+
+        return Beamformers(signal=segment, search=self.doa_search,
+                           ambisonic_format=self.ambisonic_format).steerBFormat()
+
+    def _late_decays(self, filteredBands, directSample, lateFirstSample, decimation, estimateDrop):
+        # Energy decay analysis of bands filtered at the same rate, from the direct sound, with their EDCs and stops
+        # from the late reverberation onset (a task of the late decays stage). For bands decimated by a factor, the
+        # EDCs and the stops are at the decimated rate
+        from Utility import DecayAnalysis
+
+        directSample = int(round(directSample / decimation))
+        lateFirstSample = int(round(lateFirstSample / decimation))
+
+        return DecayAnalysis(h=np.abs(np.stack([band[directSample:] for band in filteredBands])),
+                             fs=self.fs / decimation, stop=estimateDrop, tail=lateFirstSample - directSample).analyse()
+
+    @staticmethod
+    def _late_band_energy(filteredFull, lateFirstSample, windowlength, decimation=1):
+        # Energy of one band around the late onset. For a band decimated by a factor, the energy is scaled back to the
+        # one of the full rate signal
+        if decimation > 1:
+            lateFirstSample = int(round(lateFirstSample / decimation))
+            windowlength = max(int(round(windowlength / decimation)), 1)
+
+        return np.sqrt(decimation * np.sum(filteredFull[lateFirstSample-windowlength:lateFirstSample+windowlength]
+                                           .astype(float) ** 2))
+
+    def _workers(self):
+        # Threads running the independent parts of a stage: none with a profiler, which measures one stage at a time
+        return self.workers if self.profiler is None else None
+
+    def _stage(self, name):
+        # Measures the code run inside it as the stage 'name', if a profiler is given
+        if self.profiler is None:
+            return nullcontext()
+
+        return self.profiler.stage(name)
+
+    def _update_report(self):
+        if self.profiler is not None:
+            self.report = self.profiler.report()
+
+    def _cache_get(self, stage, parent=None):
+        # Returns the cached output of a stage for this RIR and these options, or None
+        if self.cache is None:
+            return None
+
+        return self.cache.get(stage, self._cache_key(stage, parent))
+
+    def _cache_put(self, stage, arrays, parent=None):
+        if self.cache is not None:
+            self.cache.put(stage, self._cache_key(stage, parent), arrays)
+
+    def _cache_key(self, stage, parent=None):
+        from ParameterStore import encoder_settings
+        from ResultCache import array_digest
+
+        if self._rir_digest is None:
+            self._rir_digest = array_digest(self.RIRs)
+
+        return self.cache.key(stage, self._rir_digest, self.fs, encoder_settings(self), parent)
@@ -0,0 +1,360 @@
+#
+# This class is a long-running local encoding service, so that the tools of a pipeline can encode RIRs without starting
+# a Python process (and importing and warming up the encoder) for each one. It is an asyncio HTTP/1.1 server, listening
+# on localhost or on a Unix socket, which runs EncoderSAOBFormat on a bounded pool of worker processes. The workers are
+# started once, and keep the steering tables, DYPSA windows and filter bank designs of the previous requests (they are
+# computed in advance for the fs given in warm_fs).
+#
+# Requests:
+# * POST /encode?x=..&y=..&z=..[&name=..][&objtype=..][&<encoder option>=..]: the body is either a .wav file, or a raw
+#   buffer of interleaved samples (samples x channels) with Content-Type application/octet-stream, described by the
+#   query fields fs, channels and dtype (default float32, little endian). The encoder options are the ones of
+#   BatchEncoding (ENCODER_OPTIONS), plus n_discrete. The response is the VISR room library entry (as written by
+#   GenerateJSON_RSAO), streamed back with chunked transfer encoding, or {"error": ...} with status 400 (invalid
+#   request), 422 (RIR that cannot be encoded, the traceback being logged by the service), 503 (worker crashed while
+#   encoding it) or 500 (any other error of the service)
+# * GET /metrics: queue depth, requests running and counters, and the latency (waiting in the queue, encoding and
+#   total, in seconds) of the last requests
+# * GET /health
+#
+# Backpressure: at most 'workers' RIRs are encoded at the same time, and at most max_queue more wait for a worker.
+# Further requests are rejected straight after their headers (status 503, with Retry-After), without reading their
+# body: a client sending 'Expect: 100-continue' (e.g. curl, for bodies over 1 MB) only receives '100 Continue' once its
+# request is queued. If a worker crashes (e.g. killed), the pool is replaced with a new warmed up one.
+#
+# Usage:
+#   python EncodingService.py --port 8765 --workers 4 --max-queue 32   (or --socket /tmp/rsao.sock)
+#   curl --data-binary @rir.wav 'http://127.0.0.1:8765/encode?x=23.97&y=32.22&z=21.89&n_discrete=20'
+#   curl http://127.0.0.1:8765/metrics
+
+import os
+import io
+import json
+import time
+import asyncio
+import argparse
+import traceback
+import collections
+from urllib.parse import urlsplit, parse_qs
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from BatchEncoding import ENCODER_OPTIONS
+from Instrumentation import logger
+
+# Options of the encoder that can be given in the query of /encode, with the type they are converted to
+SERVICE_OPTIONS = dict(ENCODER_OPTIONS, n_discrete=int, late_fit_iterations=int)
+
+# Number of requests over which the latency is reported
+LATENCY_WINDOW = 1000
+
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 413: 'Payload Too Large',
+           422: 'Unprocessable Entity', 500: 'Internal Server Error', 503: 'Service Unavailable'}
+
+
+class EncodingService:
+
+    def __init__(self, host='127.0.0.1', port=8765, socket=None, workers=None, max_queue=32, max_bytes=256*2**20,
+                 warm_fs=(48000,)):
+        self.host = host
+        self.port = port
+        self.socket = socket  # Path of a Unix socket, listened to instead of host and port
+        self.workers = workers if workers is not None else os.cpu_count()
+        self.max_queue = max_queue
+        self.max_bytes = max_bytes  # Largest body accepted
+        self.warm_fs = warm_fs
+
+        self.pool = None
+        self.server = None
+        self._slots = None  # Free workers
+        self.waiting = 0
+        self.running = 0
+        self.counters = {'accepted': 0, 'completed': 0, 'failed': 0, 'rejected': 0, 'crashed': 0, 'pool_restarts': 0}
+        self.latency = {'wait': collections.deque(maxlen=LATENCY_WINDOW),
+                        'encode': collections.deque(maxlen=LATENCY_WINDOW),
+                        'total': collections.deque(maxlen=LATENCY_WINDOW)}
+        self.started = None
+
+    async def start(self):
+        self._slots = asyncio.Semaphore(self.workers)
+        await self._start_pool()
+
+        if self.socket is not None:
+            self.server = await asyncio.start_unix_server(self._handle, path=self.socket)
+            logger.info('RSAO encoding service listening on ' + self.socket)
+        else:
+            self.server = await asyncio.start_server(self._handle, host=self.host, port=self.port)
+            logger.info('RSAO encoding service listening on http://' + self.host + ':' + str(self.port))
+        self.started = time.perf_counter()
+
+        return self
+
+    async def serve_forever(self):
+        async with self.server:
+            await self.server.serve_forever()
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+        if self.socket is not None and os.path.exists(self.socket):
+            os.remove(self.socket)
+
+        return self
+
+    async def _start_pool(self):
+        # All the workers are started and warmed up before they are given a request
+        self.pool = ProcessPoolExecutor(max_workers=self.workers, initializer=warm_worker, initargs=(self.warm_fs,))
+        await asyncio.gather(*[asyncio.get_running_loop().run_in_executor(self.pool, os.getpid)
+                               for _ in range(0, self.workers)])
+
+    def metrics(self):
+        metrics = {'queue_depth': self.waiting, 'running': self.running, 'workers': self.workers,
+                   'max_queue': self.max_queue, 'uptime': time.perf_counter() - self.started}
+        metrics.update(self.counters)
+        metrics['latency'] = {name: latency_summary(values) for name, values in self.latency.items()}
+
+        return metrics
+
+    async def _handle(self, reader, writer):
+        try:
+            method, target, headers = await read_head(reader)
+            url = urlsplit(target)
+            if url.path == '/encode':
+                if method != 'POST':
+                    await respond(writer, 405, {'error': 'Use POST to encode a RIR'})
+                else:
+                    await self._encode(reader, writer, parse_qs(url.query), headers)
+            elif url.path == '/metrics':
+                await respond(writer, 200, self.metrics())
+            elif url.path == '/health':
+                await respond(writer, 200, {'status': 'ok'})
+            else:
+                await respond(writer, 404, {'error': 'Unknown path ' + url.path})
+        except (ValueError, asyncio.IncompleteReadError) as error:
+            await respond(writer, 400, {'error': str(error)})
+        except ConnectionError:
+            pass
+        except Exception as error:
+            logger.exception('Error while handling a request')
+            try:
+                await respond(writer, 500, {'error': str(error)})
+            except ConnectionError:
+                pass
+        finally:
+            writer.close()
+
+    async def _encode(self, reader, writer, query, headers):
+        arrived = time.perf_counter()
+
+        # Backpressure: the body of a request that cannot be queued is not even read
+        if self.waiting + self.running >= self.workers + self.max_queue:
+            self.counters['rejected'] += 1
+            await respond(writer, 503, {'error': 'Queue full, retry later'}, {'Retry-After': '1'})
+            return
+        length = int(headers.get('content-length', -1))
+        if length < 0:
+            raise ValueError('Content-Length is required')
+        if length > self.max_bytes:
+            await respond(writer, 413, {'error': 'RIRs of up to ' + str(self.max_bytes) + ' bytes are accepted'})
+            return
+
+        # The client may wait for this before sending the body
+        if headers.get('expect', '').lower() == '100-continue':
+            writer.write(b'HTTP/1.1 100 Continue\r\n\r\n')
+            await writer.drain()
+
+        self.waiting += 1
+        self.counters['accepted'] += 1
+        try:
+            job = encoding_job(query, headers, await reader.readexactly(length))
+            await self._slots.acquire()
+        finally:
+            self.waiting -= 1
+
+        self.running += 1
+        started = time.perf_counter()
+        pool = self.pool
+        try:
+            result = await asyncio.get_running_loop().run_in_executor(pool, encode_job, job)
+        except BrokenProcessPool:
+            result = None
+        finally:
+            self.running -= 1
+            self._slots.release()
+
+        if result is None:
+            # A worker crashed: the pool is replaced once, by the first request that finds it broken
+            self.counters['crashed'] += 1
+            if self.pool is pool:
+                logger.warning('A worker process of the encoding service crashed, restarting the pool')
+                pool.shutdown(wait=False, cancel_futures=True)
+                self.counters['pool_restarts'] += 1
+                await self._start_pool()
+            await respond(writer, 503, {'error': 'The worker encoding the RIR crashed, retry later'},
+                          {'Retry-After': '1'})
+            return
+
+        self.latency['wait'].append(started - arrived)
+        self.latency['encode'].append(time.perf_counter() - started)
+        if 'error' in result:
+            self.counters['failed'] += 1
+            logger.warning('RIR not encoded:\n' + result['traceback'])
+            await respond(writer, 422, {'error': result['error']})
+        else:
+            self.counters['completed'] += 1
+            await respond(writer, 200, result['room'])
+        self.latency['total'].append(time.perf_counter() - arrived)
+
+
+async def read_head(reader):
+    # Returns the method, target and headers (lower case names) of an HTTP request
+    request = (await reader.readline()).decode('latin-1').split()
+    if len(request) != 3:
+        raise ValueError('Malformed request line')
+    headers = {}
+    while True:
+        line = (await reader.readline()).decode('latin-1')
+        if line in ('\r\n', '\n', ''):
+            break
+        name, _, value = line.partition(':')
+        headers[name.strip().lower()] = value.strip()
+
+    return request[0], request[1], headers
+
+
+async def respond(writer, status, content, headers=None):
+    # Sends content as JSON, in chunks as it is serialized (chunked transfer encoding)
+    head = 'HTTP/1.1 ' + str(status) + ' ' + REASONS[status] + '\r\nContent-Type: application/json\r\n' + \
+           'Transfer-Encoding: chunked\r\nConnection: close\r\n'
+    for name, value in (headers or {}).items():
+        head += name + ': ' + value + '\r\n'
+    writer.write((head + '\r\n').encode('latin-1'))
+
+    chunk = []
+    size = 0
+    for piece in json.JSONEncoder().iterencode(content):
+        chunk.append(piece)
+        size += len(piece)
+        if size >= 2**16:
+            await _write_chunk(writer, ''.join(chunk).encode())
+            chunk, size = [], 0
+    if chunk:
+        await _write_chunk(writer, ''.join(chunk).encode())
+    writer.write(b'0\r\n\r\n')
+    await writer.drain()
+
+
+async def _write_chunk(writer, data):
+    writer.write(('{:x}'.format(len(data)) + '\r\n').encode() + data + b'\r\n')
+    await writer.drain()
+
+
+def encoding_job(query, headers, body):
+    # Validates the query of an /encode request, and returns the job sent to a worker
+    fields = {name: values[-1] for name, values in query.items()}
+    if 'room' in fields:
+        RoomDims = fields['room'].split(',')
+    else:
+        RoomDims = [fields.get('x'), fields.get('y'), fields.get('z')]
+    if None in RoomDims or len(RoomDims) != 3:
+        raise ValueError('The room dimensions are required (x, y and z, or room=x,y,z)')
+
+    job = {'RoomDims': [float(dim) for dim in RoomDims],
+           'options': {name: SERVICE_OPTIONS[name](value) for name, value in fields.items() if name in SERVICE_OPTIONS},
+           'name': fields.get('name', 'room'),
+           'objtype': fields.get('objtype', 'pointreverb')}
+
+    if headers.get('content-type', '').startswith('application/octet-stream'):
+        if 'fs' not in fields or 'channels' not in fields:
+            raise ValueError('Raw buffers need fs and channels')
+        job.update({'raw': body, 'fs': int(fields['fs']), 'channels': int(fields['channels']),
+                    'dtype': fields.get('dtype', 'float32')})
+    else:
+        job['wav'] = body
+
+    return job
+
+
+def encode_job(job):
+    # Encodes the RIR of a job (in a worker process), and returns its room library entry, or the error and its
+    # traceback. Any error is returned instead of being raised, so that it does not break the pool
+    from scipy.io import wavfile
+    import numpy as np
+    from Encoder_SAO_Bformat import EncoderSAOBFormat
+    from GenerateJSON import GenerateJSON_RSAO
+
+    try:
+        if 'wav' in job:
+            fs, RIRs = wavfile.read(io.BytesIO(job['wav']))
+        else:
+            fs = job['fs']
+            RIRs = np.frombuffer(job['raw'], dtype=np.dtype(job['dtype']).newbyteorder('<'))
+            RIRs = RIRs.reshape(-1, job['channels'])
+
+        encoder = EncoderSAOBFormat(RIRs=np.array(RIRs), fs=fs, RoomDims=job['RoomDims'], **job['options'])
+        encoder.parameterization()
+
+        JsonFile = GenerateJSON_RSAO(paramEarly=encoder.param, paramLate=encoder.paramLate, name=job['name'],
+                                     maxEarly=encoder.n_discrete, filename=None, objtype=job['objtype'])
+        JsonFile.getobjectvector_roomlibrary()
+    except (Exception, SystemExit) as error:
+        # sys.exit is used by the encoder to reject invalid inputs
+        return {'error': str(error) or type(error).__name__, 'traceback': traceback.format_exc()}
+
+    return {'room': JsonFile.libentry}
+
+
+def warm_worker(warm_fs):
+    # Imports the encoder in a new worker process, and computes the tables it shares between RIRs
+    from Encoder_SAO_Bformat import LATE_FCENTRE
+    from FilterGeneration import FilterBank
+    from Beamformers import steering_table
+    from Utility import group_delay_windows
+
+    steering_table('3D', 1, 1, 'WXYZ')
+    for fs in warm_fs:
+        group_delay_windows(fs)
+        FilterBank(fcentre=LATE_FCENTRE, BW=1, fs=fs).octaveBankSOS()
+
+
+def latency_summary(values):
+    import numpy as np
+
+    if len(values) == 0:
+        return {'count': 0}
+    values = np.array(values)
+
+    return {'count': len(values), 'mean': float(np.mean(values)), 'p50': float(np.percentile(values, 50)),
+            'p95': float(np.percentile(values, 95)), 'max': float(np.max(values))}
+
+
+async def main(args):
+    service = EncodingService(host=args.host, port=args.port, socket=args.socket, workers=args.workers,
+                              max_queue=args.max_queue, max_bytes=int(args.max_size*2**20), warm_fs=args.warm_fs)
+    await service.start()
+    try:
+        await service.serve_forever()
+    finally:
+        service.close()
+
+
+if __name__ == '__main__':
+    import logging
+
+    parser = argparse.ArgumentParser(description='Local service encoding B-format RIRs into VISR RSAO .json entries.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--socket', default=None, help='listen on this Unix socket instead of host and port')
+    parser.add_argument('--workers', type=int, default=None, help='number of processes (default: number of CPUs)')
+    parser.add_argument('--max-queue', type=int, default=32, help='requests waiting for a worker (default: 32)')
+    parser.add_argument('--max-size', type=float, default=256, help='largest RIR accepted in MB (default: 256)')
+    parser.add_argument('--warm-fs', type=int, nargs='*', default=[48000], help='fs of the tables computed at start')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, format='%(message)s')
+    logging.getLogger('RSAO').setLevel(logging.INFO)
+    try:
+        asyncio.run(main(args))
+    except KeyboardInterrupt:
+        pass
@@ -7,6 +7,10 @@
 
 import numpy as np
 
+# Coefficients of the filter banks, one for each set of centre frequencies, bandwidth and fs. Each bank is designed the
+# first time it is needed and then shared by all the FilterBank objects (i.e. by all the RIRs encoded by the process)
+_bank_sos = {}
+
 
 class FilterGeneration:
 
@@ -76,3 +80,78 @@ class FilterGeneration:
         self.a = [1 / aUnNorm[0] * idx for idx in aUnNorm]
 
         return self
+
+
+class FilterBank:
+    # Bank of biquad filters, with a low-pass filter for the first band, a high-pass filter for the last band and
+    # band-pass filters in between, all designed with FilterGeneration.
+
+    def __init__(self, fcentre, BW=1, fs=48000, dtype=np.float64):
+        self.fcentre = fcentre
+        self.BW = BW
+        self.fs = fs
+        self.dtype = dtype  # Type of the filtered signals
+
+        self.sos = None
+        self.filtered = None
+
+    def octaveBankSOS(self):
+        # Stacks the coefficients of all the bands into a (bands x 1 x 6) array of second-order sections (shared with
+        # the other banks of the same design, and therefore not to be modified)
+        key = (tuple(self.fcentre), self.BW, self.fs)
+        if key not in _bank_sos:
+            _bank_sos[key] = np.stack([band_sos(self.fcentre, iBand, self.BW, self.fs)
+                                       for iBand in range(0, len(self.fcentre))])
+
+        self.sos = _bank_sos[key]
+
+        return self
+
+    def filterZeroPhase(self, x):
+        # Zero-phase (forward-backward) filtering of the signal x through every band of the bank. The output is a
+        # (bands x samples) array, which the caller can slice to obtain any part of the filtered signal. x can also be a
+        # stack of signals (one per row, e.g. the RIRs of several positions), filtered all at once: the output is then a
+        # (bands x signals x samples) array
+        if self.sos is None:
+            self.octaveBankSOS()
+
+        self.filtered = np.empty((self.sos.shape[0],) + np.shape(x), dtype=self.dtype)
+        for iBand in range(0, self.sos.shape[0]):
+            self.filtered[iBand, :] = self.filterBand(x, iBand)
+
+        return self
+
+    def filterBand(self, x, iBand):
+        # Zero-phase filtering of the signal x through one band of the bank (the bands can be filtered concurrently)
+        if self.sos is None:
+            self.octaveBankSOS()
+
+        return zero_phase_filter(self.sos[iBand], x, self.dtype)
+
+
+def zero_phase_filter(sos, x, dtype=np.float64):
+    # Zero-phase (forward-backward) filtering of the signal x (along its last axis) through the second-order sections
+    # sos, with the output given in dtype. The recursion runs in float64 whatever the dtype of the output: the poles of
+    # the lowest bands are too close to the unit circle for float32 coefficients
+    from scipy import signal
+
+    return signal.sosfiltfilt(sos, x, axis=-1).astype(dtype, copy=False)
+
+
+def band_sos(fcentre, iBand, BW=1, fs=48000):
+    # Second-order section (1 x 6 array) of the band iBand of a bank with the centre frequencies fcentre: low-pass for
+    # the first band, high-pass for the last one and band-pass in between. Each band can be designed for its own fs
+    band = FilterGeneration(f0=fcentre[iBand], BW=BW, fs=fs)
+    if iBand == 0:
+        band.lowpassCoefficientsBW()
+    elif iBand == len(fcentre)-1:
+        band.highpassCoefficientsBW()
+    else:
+        band.bandpassCoefficientsBW()
+
+    sos = np.zeros([1, 6])
+    sos[0, :3] = band.b
+    sos[0, 3:] = band.a
+    sos[0, 3] = 1  # Coefficients are already normalized by a0, this removes the rounding error
+
+    return sos
@@ -5,6 +5,8 @@
 #
 # Ported in Python from the Matlab implementation of Philip Coleman
 
+import os
+import glob
 import numpy as np
 import json
 
@@ -21,49 +23,8 @@ class GenerateJSON_RSAO():
         self.libentry = []
 
     def getobjectvector_roomlibrary(self):
-        ##############
-        # Direct sound
-        ##############
-        self.libentry = {'name': self.name, 'type': self.objtype, 'id': 0, 'channels': 0, 'priority': 0, 'level': 1.0,
-                         'position': {'az': '{:0.2f}'.format(self.paramEarly['Direct_sound']['doa'][0]),
-                                      'el': '{:0.2f}'.format(self.paramEarly['Direct_sound']['doa'][1]),
-                                      'radius': '1.00'},
-                         'room': {'ereflect': []}}
-
-        ###################
-        # Early reflections
-        ###################
-        for idx_refl in range(1, self.maxEarly+1):
-
-            # Instantiate temporary dictionary to then append it in the later loop
-            tmpDictionary = {'level': '{:0.3e}'.format(self.paramEarly['Reflection'+str(idx_refl)]['level']),
-                             'delay': '{:0.3e}'.format(self.paramEarly['Reflection'+str(idx_refl)]['toa']),
-                             'position': {'az': '{:0.1f}'.format(self.paramEarly['Reflection'+str(idx_refl)]['doa'][0]),
-                                          'el': '{:0.1f}'.format(self.paramEarly['Reflection'+str(idx_refl)]['doa'][1]),
-                                          'refdist': '1.0'},
-                             'biquadsos': []}
-
-            # Instantiating another temporary dictionary that is going inside the other dictionary
-            nbiquadparam = np.shape(self.paramEarly['Reflection'+str(idx_refl)]['filtersos'])[0]
-            for idx_biquadparam in range(0, nbiquadparam):
-                tmp = {'b0': '{:0.3e}'.format(self.paramEarly['Reflection'+str(idx_refl)]['filtersos'][idx_biquadparam][0]),
-                       'b1': '{:0.3e}'.format(self.paramEarly['Reflection'+str(idx_refl)]['filtersos'][idx_biquadparam][1]),
-                       'b2': '{:0.3e}'.format(self.paramEarly['Reflection'+str(idx_refl)]['filtersos'][idx_biquadparam][2]),
-                       'a0': '{:0.3e}'.format(self.paramEarly['Reflection'+str(idx_refl)]['filtersos'][idx_biquadparam][3]),
-                       'a1': '{:0.3e}'.format(self.paramEarly['Reflection'+str(idx_refl)]['filtersos'][idx_biquadparam][4]),
-                       'a2': '{:0.3e}'.format(self.paramEarly['Reflection'+str(idx_refl)]['filtersos'][idx_biquadparam][5])}
-
-                tmpDictionary['biquadsos'].append(tmp)
-
-            self.libentry['room']['ereflect'].append(tmpDictionary)
-
-        ####################
-        # Late reverberation
-        ####################
-        self.libentry['room'].update({'lreverb': {'delay': '{:0.3e}'.format(self.paramLate['Late']['toa']),
-                                                  'level': formatList(self.paramLate['Late']['level']),
-                                                  'attacktime': formatList(self.paramLate['Late']['attacktimes']),
-                                                  'decayconst': formatList(self.paramLate['Late']['expdecays'])}})
+        self.libentry = roomentry(paramEarly=self.paramEarly, paramLate=self.paramLate, name=self.name,
+                                  maxEarly=self.maxEarly, objtype=self.objtype)
 
         return self
 
@@ -73,7 +34,146 @@ class GenerateJSON_RSAO():
             json.dump(data, outfile)
 
 
+class RoomLibraryWriter:
+    # Writes the rooms of a library one at a time, so that a long batch never holds the whole library in memory. The
+    # library is a .json file {"rooms": [...]} with one room per line, which is valid JSON after every append. When
+    # shard_size is given, the library is split into files <name>_0000.json, <name>_0001.json, ... of up to
+    # shard_size rooms each. Appending to an existing library (or to its last shard) continues it.
+    #
+    # Usage:
+    #   library = RoomLibraryWriter(filename='library.json', shard_size=1000).open()
+    #   library.append(paramEarly=Early.param, paramLate=Late.param, name='room', maxEarly=20)
+    #   library.close()
+
+    HEADER = b'{"rooms": [\n'
+    TRAILER = b'\n]}\n'
+
+    def __init__(self, filename, shard_size=None, objtype='pointreverb'):
+        self.filename = filename
+        self.shard_size = shard_size
+        self.objtype = objtype
+        self.shard = None  # Index of the shard being written
+        self.nRooms = 0  # Number of rooms in the file being written
+        self.files = []  # Files written, or appended to
+        self._file = None
+
+    def open(self):
+        if self.shard_size is None:
+            self._openfile(self.filename)
+        else:
+            base, extension = os.path.splitext(self.filename)
+            shards = sorted(glob.glob(glob.escape(base) + '_[0-9][0-9][0-9][0-9]' + extension))
+            self.shard = len(shards) - 1 if shards else 0
+            self._openfile(self._shardname(self.shard))
+
+        return self
+
+    def append(self, paramEarly, paramLate, name, maxEarly):
+        return self.appendentry(roomentry(paramEarly=paramEarly, paramLate=paramLate, name=name, maxEarly=maxEarly,
+                                          objtype=self.objtype))
+
+    def appendentry(self, libentry):
+        # Appends a room already converted by roomentry (e.g. GenerateJSON_RSAO.libentry)
+        if self._file is None:
+            self.open()
+        if self.shard_size is not None and self.nRooms >= self.shard_size:
+            self._file.close()
+            self.shard += 1
+            self._openfile(self._shardname(self.shard))
+
+        # The trailer is overwritten by the new room, and written again after it
+        self._file.seek(-len(self.TRAILER), os.SEEK_END)
+        self._file.truncate()
+        self._file.write((b',\n' if self.nRooms > 0 else b'') + json.dumps(libentry).encode() + self.TRAILER)
+        self._file.flush()
+        self.nRooms += 1
+
+        return self
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+        return self
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _openfile(self, filename):
+        if os.path.isfile(filename) and os.path.getsize(filename) > 0:
+            self._file = open(filename, 'r+b')
+            if self._file.read(len(self.HEADER)) != self.HEADER:
+                self._file.close()
+                raise ValueError(filename + ' is not a room library written by RoomLibraryWriter')
+
+            # Every room is on its own line, between the header and the trailer
+            self.nRooms = sum([1 for line in self._file if line.strip() not in (b'', b']}')])
+            self._file.seek(-len(self.TRAILER), os.SEEK_END)
+            if self._file.read() != self.TRAILER:
+                self._file.close()
+                raise ValueError(filename + ' is not a complete room library')
+        else:
+            self._file = open(filename, 'w+b')
+            self._file.write(self.HEADER + self.TRAILER)
+            self.nRooms = 0
+
+        self.files.append(filename)
+
+    def _shardname(self, shard):
+        base, extension = os.path.splitext(self.filename)
+        return base + '_' + '{:04d}'.format(shard) + extension
+
+
+def roomentry(paramEarly, paramLate, name, maxEarly, objtype):
+    # Returns the VISR room library entry of a set of RSAO parameters. All the numbers of each field are formatted in
+    # one call, for all the reflections at once
+    ##############
+    # Direct sound
+    ##############
+    directDOA = np.char.mod('%0.2f', np.asarray(paramEarly['Direct_sound']['doa'], dtype=float))
+    libentry = {'name': name, 'type': objtype, 'id': 0, 'channels': 0, 'priority': 0, 'level': 1.0,
+                'position': {'az': str(directDOA[0]), 'el': str(directDOA[1]), 'radius': '1.00'},
+                'room': {'ereflect': []}}
+
+    ###################
+    # Early reflections
+    ###################
+    reflections = [paramEarly['Reflection'+str(idx_refl)] for idx_refl in range(1, maxEarly+1)]
+    levels = np.char.mod('%0.3e', np.array([reflection['level'] for reflection in reflections], dtype=float))
+    delays = np.char.mod('%0.3e', np.array([reflection['toa'] for reflection in reflections], dtype=float))
+    DOAs = np.char.mod('%0.1f', np.array([reflection['doa'] for reflection in reflections], dtype=float))
+
+    # The biquads of all the reflections are stacked, formatted, and split again
+    nbiquads = [np.shape(reflection['filtersos'])[0] for reflection in reflections]
+    if len(reflections) > 0:
+        biquads = np.char.mod('%0.3e', np.concatenate([np.reshape(reflection['filtersos'], [-1, 6])
+                                                       for reflection in reflections]).astype(float))
+    firstbiquad = np.concatenate([[0], np.cumsum(nbiquads)])
+
+    for idx_refl in range(0, len(reflections)):
+        libentry['room']['ereflect'].append(
+            {'level': str(levels[idx_refl]),
+             'delay': str(delays[idx_refl]),
+             'position': {'az': str(DOAs[idx_refl, 0]), 'el': str(DOAs[idx_refl, 1]), 'refdist': '1.0'},
+             'biquadsos': [dict(zip(['b0', 'b1', 'b2', 'a0', 'a1', 'a2'], biquad.tolist()))
+                           for biquad in biquads[firstbiquad[idx_refl]:firstbiquad[idx_refl+1]]]})
+
+    ####################
+    # Late reverberation
+    ####################
+    libentry['room'].update({'lreverb': {'delay': '{:0.3e}'.format(paramLate['Late']['toa']),
+                                         'level': formatList(paramLate['Late']['level']),
+                                         'attacktime': formatList(paramLate['Late']['attacktimes']),
+                                         'decayconst': formatList(paramLate['Late']['expdecays'])}})
+
+    return libentry
+
+
 def formatList(list_val):
-    val = ['{:0.2e}'.format(list_val[str(item)]) for item in range(1, len(list_val)+1)]
+    val = np.char.mod('%0.2e', np.array([list_val[str(item)] for item in range(1, len(list_val)+1)], dtype=float))
     val = ', '.join(val)
-    return val
\ No newline at end of file
+    return val
@@ -0,0 +1,86 @@
+#
+# This module contains the optional instrumentation of the encoder, and the logger used by all the modules of the
+# package instead of printing to the console.
+#
+# StageProfiler records, for each named stage of the encoder (e.g. 'early.segmentation', 'late.filterbank'), the wall
+# time, the CPU time of the process and the peak memory allocated by Python and NumPy (tracemalloc) while the stage
+# runs. The records are available as a structured report, and can also be sent, one at a time, to a callback.
+#
+# The log messages (e.g. the mixing time estimation) go to the 'RSAO' logger. They are not shown unless the
+# application configures logging, e.g. logging.basicConfig(level=logging.INFO, format='%(message)s'), and can be
+# silenced with logging.getLogger('RSAO').setLevel(logging.WARNING).
+#
+# Usage:
+#   profiler = StageProfiler(callback=print)
+#   EncoderSAOBFormat(RIRs=RIRs, profiler=profiler).direct_and_early_parameterization()
+#   profiler.report()
+
+import time
+import logging
+import tracemalloc
+from contextlib import contextmanager
+
+logger = logging.getLogger('RSAO')
+
+
+class StageProfiler:
+
+    def __init__(self, callback=None, memory=True):
+        self.callback = callback
+        self.memory = memory  # Peak memory measurement (tracemalloc slows down the code running in Python)
+        self.records = []
+        self._depth = 0  # Number of stages being measured (the stages can be nested)
+        self._peaks = []  # Peak memory of the stages being measured
+
+    @contextmanager
+    def stage(self, name):
+        # Context manager measuring the code run inside it as the stage 'name'
+        tracing = self.memory and not tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.start()
+        if self.memory:
+            start_memory = tracemalloc.get_traced_memory()[0]
+            self._update_peaks()
+            tracemalloc.reset_peak()
+            self._peaks.append(start_memory)
+
+        depth = self._depth
+        self._depth += 1
+        start_wall = time.perf_counter()
+        start_cpu = time.process_time()
+        try:
+            yield self
+        finally:
+            self._depth -= 1
+            record = {'stage': name,
+                      'depth': depth,
+                      'wall': time.perf_counter() - start_wall,
+                      'cpu': time.process_time() - start_cpu,
+                      'peak_bytes': None}
+            if self.memory:
+                self._update_peaks()
+                record['peak_bytes'] = self._peaks.pop() - start_memory
+                if tracing:
+                    tracemalloc.stop()
+
+            self.records.append(record)
+            if self.callback is not None:
+                self.callback(record)
+
+    def report(self):
+        # Returns the records of all the stages measured so far, and the totals over the outermost stages
+        outermost = [record for record in self.records if record['depth'] == 0]
+        return {'stages': list(self.records),
+                'wall': sum([record['wall'] for record in outermost]),
+                'cpu': sum([record['cpu'] for record in outermost]),
+                'peak_bytes': max([record['peak_bytes'] or 0 for record in outermost] + [0])}
+
+    def reset(self):
+        self.records = []
+
+        return self
+
+    def _update_peaks(self):
+        # Brings the peak of every stage being measured up to date, before tracemalloc's peak is reset
+        peak = tracemalloc.get_traced_memory()[1]
+        self._peaks = [max(stage_peak, peak) for stage_peak in self._peaks]
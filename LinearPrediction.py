@@ -0,0 +1,67 @@
+#
+# This module contains the Linear Predictive Coding (LPC) analysis used to model the colouration of the direct sound and
+# early reflections, and within DYPSA. The LPC coefficients are obtained by the autocorrelation method, solving the
+# Yule-Walker equations with the Levinson-Durbin recursion, for a whole stack of segments at once. Segments can have
+# different lengths and different LPC orders.
+
+import numpy as np
+
+
+def lpc(segments, orders):
+    # Returns the analysis (whitening) filters A(z) = 1 + a1*z^-1 + ... + ap*z^-p of all the segments in input, as a
+    # (segments x max(orders)+1) array where the coefficients after each segment's order are zero, and the prediction
+    # errors (squared) of all the segments.
+    # * segments is a 1-D array (one segment), a 2-D array (one segment per row) or a list of 1-D arrays
+    # * orders is either a single LPC order, or one order for each segment
+    segments = _stack(segments)
+    orders = np.broadcast_to(np.asarray(orders, dtype=int), (segments.shape[0],))
+
+    return levinson_durbin(autocorrelation(segments, int(np.max(orders))), orders)
+
+
+def autocorrelation(segments, max_lag):
+    # Autocorrelation of each row of segments, from lag 0 to max_lag. Zero padding at the end of the rows (used to stack
+    # segments of different lengths) does not change the result
+    segments = _stack(segments)
+    nSegments, nSamples = segments.shape
+    acdata = np.zeros([nSegments, max_lag + 1])
+    for lag in range(0, min(max_lag + 1, nSamples)):
+        acdata[:, lag] = np.sum(segments[:, :nSamples-lag] * segments[:, lag:], 1)
+
+    return acdata
+
+
+def levinson_durbin(acdata, orders):
+    # Levinson-Durbin recursion on each row of acdata (autocorrelation lags), up to the order of that row. Rows with no
+    # energy (e.g. a silent segment) return the trivial filter A(z) = 1
+    acdata = np.atleast_2d(acdata)
+    nSegments = acdata.shape[0]
+    orders = np.broadcast_to(np.asarray(orders, dtype=int), (nSegments,))
+    max_order = int(np.max(orders)) if nSegments > 0 else 0
+
+    A = np.zeros([nSegments, max_order + 1])
+    A[:, 0] = 1
+    error = acdata[:, 0].astype(float)
+    for m in range(1, max_order + 1):
+        # Reflection (PARCOR) coefficients of the rows that have not reached their order yet
+        active = (orders >= m) & (error > 0)
+        acc = np.sum(A[:, :m] * acdata[:, m:0:-1], 1)
+        k = np.where(active, -acc / np.where(active, error, 1), 0)
+
+        A[:, 1:m+1] = A[:, 1:m+1] + k[:, None] * A[:, m-1::-1]
+        error = error * (1 - k**2)
+
+    return A, error
+
+
+def _stack(segments):
+    # Stacks the segments in a 2-D array, padding the shorter ones with zeros
+    if isinstance(segments, np.ndarray) and segments.ndim <= 2:
+        return np.atleast_2d(segments).astype(float)
+
+    segments = [np.asarray(segment, dtype=float) for segment in segments]
+    stacked = np.zeros([len(segments), max([len(segment) for segment in segments] + [0])])
+    for idx_segment in range(0, len(segments)):
+        stacked[idx_segment, :len(segments[idx_segment])] = segments[idx_segment]
+
+    return stacked
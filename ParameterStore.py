@@ -0,0 +1,176 @@
+#
+# This class saves and loads the RSAO parameters (direct sound and early reflections, late reverberation) and the
+# settings of the encoder that estimated them, in a compressed NumPy .npz file. Only numeric and string arrays are
+# stored, so a file is loaded without executing pickle, and its size is a few kilobytes per room.
+#
+# Layout (schema version 1), with N the number of early parts (direct sound first) and B the number of late bands:
+# * 'schema_version': version of the layout
+# * 'settings': encoder settings, as a JSON string
+# * 'early_names': names of the early parts, e.g. 'Direct_sound', 'Reflection1', ... (N)
+# * 'early_toa', 'early_window_samples', 'early_level': one value per early part (N)
+# * 'early_toa_notconverted': onset in samples before the conversion, NaN for the parts that do not have it (N)
+# * 'early_doa': azimuth and elevation in degrees (N x 2)
+# * 'early_filter', 'early_filter_order': LPC coefficients, zero-padded to the highest order, and LPC orders
+# * 'early_filtersos', 'early_filtersos_sections': biquads, zero-padded to the highest number of sections, and number
+#   of sections (N x sections x 6)
+# * 'late_toa', 'late_refattackramplength', 'late_window_samples': scalars of the late reverberation
+# * 'late_bandcut' and 'late_<field>' for each per-band field in LATE_BAND_FIELDS: one value per band (B)
+#
+# Usage:
+#   ParameterStore(filename='room.npz', paramEarly=Early.param, paramLate=Late.param,
+#                  settings=encoder_settings(Early)).save()
+#   store = ParameterStore(filename='room.npz').load()  # store.paramEarly, store.paramLate, store.settings
+#
+# stack_params stacks the packed parameters of several RIRs along a leading axis (see RoomSession).
+
+import json
+import numpy as np
+
+SCHEMA_VERSION = 1
+
+# Encoder attributes saved as settings
+ENCODER_SETTINGS = ['fs', 'groupdelay_threshold', 'use_LPC', 'n_discrete', 'discrete_mode', 'RoomDims', 'doa_search',
+                    'late_fit_iterations', 'peak_channels', 'ambisonic_format', 'precision',
+                    'late_analysis']
+
+# Late reverberation parameters given for each band, as dictionaries with keys '1', '2', ...
+LATE_BAND_FIELDS = ['level', 'expdecays', 'fitresidual', 'fitconverged', 'attacktimes']
+
+
+class ParameterStore:
+
+    def __init__(self, filename, paramEarly=None, paramLate=None, settings=None):
+        self.filename = filename
+        self.paramEarly = paramEarly
+        self.paramLate = paramLate
+        self.settings = settings if settings is not None else {}
+
+    def save(self):
+        arrays = {'schema_version': np.array(SCHEMA_VERSION),
+                  'settings': np.array(json.dumps(self.settings))}
+        if self.paramEarly is not None:
+            arrays.update(pack_early(self.paramEarly))
+        if self.paramLate is not None:
+            arrays.update(pack_late(self.paramLate['Late']))
+
+        np.savez_compressed(self.filename, **arrays)
+
+        return self
+
+    def load(self):
+        with np.load(self.filename, allow_pickle=False) as data:
+            arrays = {key: data[key] for key in data.files}
+
+        if int(arrays['schema_version']) > SCHEMA_VERSION:
+            raise ValueError(self.filename + ' uses schema version ' + str(int(arrays['schema_version'])) +
+                             ', only versions up to ' + str(SCHEMA_VERSION) + ' are supported')
+
+        self.settings = json.loads(str(arrays['settings']))
+        self.paramEarly = unpack_early(arrays) if 'early_names' in arrays else None
+        self.paramLate = {'Late': unpack_late(arrays)} if 'late_toa' in arrays else None
+
+        return self
+
+
+def encoder_settings(encoder):
+    # Returns the settings of an EncoderSAOBFormat object, as a dictionary that can be written as JSON
+    settings = {}
+    for setting in ENCODER_SETTINGS:
+        value = getattr(encoder, setting, None)
+        settings[setting] = np.asarray(value).tolist() if value is not None else None
+
+    return settings
+
+
+def pack_early(paramEarly):
+    names = list(paramEarly.keys())
+    nParts = len(names)
+    orders = np.array([len(paramEarly[name]['filter']) - 1 for name in names])
+    sections = np.array([np.shape(paramEarly[name]['filtersos'])[0] for name in names])
+
+    arrays = {'early_names': np.array(names),
+              'early_toa': np.array([paramEarly[name]['toa'] for name in names], dtype=float),
+              'early_toa_notconverted': np.array([paramEarly[name].get('toa_notconverted', np.nan)
+                                                  for name in names], dtype=float),
+              'early_window_samples': np.array([paramEarly[name]['window_samples'] for name in names]),
+              'early_doa': np.array([paramEarly[name]['doa'] for name in names]),
+              'early_level': np.array([paramEarly[name]['level'] for name in names], dtype=float),
+              'early_filter': np.zeros([nParts, np.max(orders) + 1]),
+              'early_filter_order': orders,
+              'early_filtersos': np.zeros([nParts, np.max(sections), 6]),
+              'early_filtersos_sections': sections}
+    for idx_part in range(0, nParts):
+        arrays['early_filter'][idx_part, :orders[idx_part]+1] = paramEarly[names[idx_part]]['filter']
+        arrays['early_filtersos'][idx_part, :sections[idx_part], :] = paramEarly[names[idx_part]]['filtersos']
+
+    return arrays
+
+
+def unpack_early(arrays):
+    paramEarly = {}
+    for idx_part in range(0, len(arrays['early_names'])):
+        part = {'toa': float(arrays['early_toa'][idx_part]),
+                'window_samples': int(arrays['early_window_samples'][idx_part]),
+                'doa': arrays['early_doa'][idx_part].tolist(),
+                'level': float(arrays['early_level'][idx_part]),
+                'filter': arrays['early_filter'][idx_part, :arrays['early_filter_order'][idx_part]+1],
+                'filtersos': arrays['early_filtersos'][idx_part, :arrays['early_filtersos_sections'][idx_part], :]}
+        if not np.isnan(arrays['early_toa_notconverted'][idx_part]):
+            part['toa_notconverted'] = int(arrays['early_toa_notconverted'][idx_part])
+
+        paramEarly[str(arrays['early_names'][idx_part])] = part
+
+    return paramEarly
+
+
+def pack_late(paramLate):
+    arrays = {'late_toa': np.array(paramLate['toa'], dtype=float),
+              'late_refattackramplength': np.array(paramLate['refattackramplength']),
+              'late_window_samples': np.array(paramLate['window_samples']),
+              'late_bandcut': np.array(paramLate['bandcut'], dtype=float)}
+    for field in LATE_BAND_FIELDS:
+        if field in paramLate:
+            arrays['late_' + field] = np.array([paramLate[field][str(iBand + 1)]
+                                                for iBand in range(0, len(paramLate[field]))])
+
+    return arrays
+
+
+def unpack_late(arrays):
+    paramLate = {'toa': float(arrays['late_toa']),
+                 'refattackramplength': int(arrays['late_refattackramplength']),
+                 'window_samples': int(arrays['late_window_samples']),
+                 'bandcut': arrays['late_bandcut'].tolist()}
+    for field in LATE_BAND_FIELDS:
+        if 'late_' + field in arrays:
+            paramLate[field] = {str(iBand + 1): arrays['late_' + field][iBand].item()
+                                for iBand in range(0, len(arrays['late_' + field]))}
+
+    return paramLate
+
+
+def stack_params(arraysList):
+    # Stacks the packed parameters of several RIRs (e.g. the positions of a RoomSession) along a new leading axis. The
+    # RIRs can have different numbers of early parts, LPC orders and biquad sections: the arrays are zero-padded to the
+    # largest shape (with '' as the name of the missing early parts), and 'early_count' gives the number of early parts
+    # of each RIR
+    stacked = {'early_count': np.array([len(arrays['early_names']) for arrays in arraysList])}
+    for name in arraysList[0]:
+        shapes = np.array([np.shape(arrays[name]) for arrays in arraysList], dtype=int).reshape(len(arraysList), -1)
+        stacked[name] = np.zeros((len(arraysList),) + tuple(np.max(shapes, 0)),
+                                 dtype=np.result_type(*[arrays[name] for arrays in arraysList]))
+        for idx_rir in range(0, len(arraysList)):
+            stacked[name][(idx_rir,) + tuple([slice(0, size) for size in shapes[idx_rir]])] = arraysList[idx_rir][name]
+
+    return stacked
+
+
+def unstack_params(stacked, idx_rir):
+    # Returns the packed parameters of one of the RIRs stacked by stack_params
+    arrays = {name: stacked[name][idx_rir] for name in stacked if name != 'early_count'}
+    nParts = stacked['early_count'][idx_rir]
+    for name in arrays:
+        if name.startswith('early_'):
+            arrays[name] = arrays[name][:nParts]
+
+    return arrays
@@ -7,11 +7,16 @@
 
 import numpy as np
 from Algorithm_PeakDetection import Peakpicking
+from Beamformers import steering_vectors
+
+# Directions of the beams in which peaks are detected with peak_channels='beams': cardioids towards +-x, +-y and +-z
+BEAM_DIRECTIONS = np.array([[1, 0, 0], [-1, 0, 0], [0, 1, 0], [0, -1, 0], [0, 0, 1], [0, 0, -1]], dtype=float)
 
 
 class Segmentation:
 
-    def __init__(self, RIRs, fs, groupdelay_threshold, use_LPC, discrete_mode, nPeaks, hamm_lengths):
+    def __init__(self, RIRs, fs, groupdelay_threshold, use_LPC, discrete_mode, nPeaks, hamm_lengths, peak_locs=None,
+                 peak_vals=None, peak_channels='W', ambisonic_format='WXYZ'):
         self.RIRs = RIRs
         self.fs = fs
         self.groupdelay_threshold = groupdelay_threshold
@@ -21,41 +26,55 @@ class Segmentation:
         self.segments = None
         self.TOAs_sample_single_mic = None
         self.hamm_lengths = hamm_lengths
+        self.peak_locs = peak_locs  # Output of DYPSA (positions and values of the peaks), if already available
+        self.peak_vals = peak_vals
+        self.peak_channels = peak_channels  # Signals where DYPSA looks for peaks: 'W', 'WXYZ' or 'beams'
+        self.ambisonic_format = ambisonic_format  # Channels of RIRs: 'WXYZ' (B-format), or ACN 'SN3D' or 'N3D'
 
     def segmentation(self):
-        # Run DYPSA with the B-format omni component only (W channel)
-        peakpicking = Peakpicking(RIR=self.RIRs[:, 0], fs=self.fs,
-                                  groupdelay_threshold=self.groupdelay_threshold,
-                                  use_LPC=self.use_LPC)
-        peakpicking.DYPSA()
-        p_pos = peakpicking.p_pos
+        # Run DYPSA with the B-format omni component only (W channel), or with several channels at once
+        if self.peak_locs is None:
+            peakpicking = Peakpicking(RIR=self.peakSignals(), fs=self.fs,
+                                      groupdelay_threshold=self.groupdelay_threshold,
+                                      use_LPC=self.use_LPC)
+            peakpicking.DYPSA()
+            self.peak_locs = peakpicking.peak_locs
+            self.peak_vals = peakpicking.peak_vals
 
         # Choosing which peaks to prioritize
-        if self.discrete_mode is 'first':
-            # Find peaks in the DYPSA output
-            locs_all = np.transpose(np.array(np.where(p_pos[:, 0] != 0)))
-            locs = locs_all[:(self.nPeaks + 5)]
-            peaks = np.squeeze(p_pos[locs])
-            firstearlypeaks = []
-            firstearlylocs = []
-        elif self.discrete_mode is 'strongest':
-            # Find the first two in time
-            locs_all = np.transpose(np.array(np.where(p_pos[:, 0] != 0)))
-            firstearlylocs = locs_all[:2]
-            firstearlypeaks = np.squeeze(p_pos[firstearlylocs])
-
-            # Then finds the first peaks in energy-descending order
-            peaks = np.squeeze(p_pos[locs_all])
-            peaks = list(peaks)
-            peaks = np.array(sorted(peaks, reverse=True))
-            locs_mixed, idx_locs = np.where(p_pos == peaks)
-            locs = locs_mixed[idx_locs]
+        if self.discrete_mode == 'first':
+            # The first peaks in time
+            locs = self.peak_locs[:self.nPeaks]
+            firstearlylocs = self.peak_locs[:0]
+        elif self.discrete_mode == 'strongest':
+            # The first two in time, and the peaks in energy-descending order
+            firstearlylocs = self.peak_locs[:2]
+            locs = self.peak_locs[strongest(self.peak_vals, self.nPeaks)]
+        else:
+            raise ValueError("discrete_mode must be either 'first' or 'strongest'")
 
         # Select the reflections TOAs
-        first_and_strong = list(locs) + list(firstearlylocs)
-        uniquelocs = np.unique(first_and_strong)
+        uniquelocs = np.unique(np.concatenate([locs, firstearlylocs]))
+        if len(uniquelocs) < self.nPeaks:
+            raise ValueError('DYPSA found ' + str(len(uniquelocs)) + ' peaks, but ' + str(self.nPeaks) +
+                             ' (direct sound and early reflections) are needed')
         self.TOAs_sample_single_mic = uniquelocs[0:self.nPeaks]
 
+        return self.segmentsFromTOAs()
+
+    def peakSignals(self):
+        # Returns the signals (one per column) where the peaks are detected. With higher order ambisonics, only the
+        # first-order channels are used ('WXYZ' is then W, Y, Z, X)
+        if self.peak_channels == 'W':
+            return self.RIRs[:, 0]
+        elif self.peak_channels == 'WXYZ':
+            return self.RIRs[:, :4]
+        elif self.peak_channels == 'beams':
+            return np.dot(self.RIRs[:, :4], steering_vectors(BEAM_DIRECTIONS, 1, 1, self.ambisonic_format).T)
+        else:
+            raise ValueError("peak_channels must be 'W', 'WXYZ' or 'beams'")
+
+    def segmentsFromTOAs(self):
         # Create a dictionary and store inside the reflection segments
         self.segments = {'Direct_sound': self.RIRs[self.TOAs_sample_single_mic[0]-self.hamm_lengths[0]:
                                                    self.TOAs_sample_single_mic[0] + self.hamm_lengths[0], :]}
@@ -65,3 +84,16 @@ class Segmentation:
                                                                                                self.hamm_lengths[idx_refl], :]
 
         return self
+
+
+def strongest(values, k):
+    # Returns the indices of the k largest values, in descending order of value. Equal values are taken in order of
+    # index (i.e. the earliest peaks first). Only the values are partitioned, so the cost grows with their number
+    if k >= len(values):
+        candidates = np.arange(0, len(values))
+    else:
+        kth = values[np.argpartition(values, len(values) - k)[len(values) - k]]
+        above = np.where(values > kth)[0]
+        candidates = np.sort(np.concatenate([above, np.where(values == kth)[0][:k - len(above)]]))
+
+    return candidates[np.argsort(-values[candidates], kind='stable')]
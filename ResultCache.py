@@ -0,0 +1,135 @@
+#
+# This class is an on-disk cache of the outputs of the encoder stages, so that running the encoder again on the same
+# RIR (e.g. to write the .json file with different options) does not repeat the analysis. Each stage output is stored
+# in its own .npz file (loaded without executing pickle), named after a hash of everything the stage depends on:
+# * 'peaks': DYPSA peak positions and values, from the RIR samples, fs, groupdelay_threshold, use_LPC,
+#   peak_channels and ambisonic_format
+# * 'segments': TOAs of the direct sound and early reflections, from the 'peaks' inputs, n_discrete and discrete_mode
+# * 'early': direct sound and early reflection parameters, from the 'segments' inputs and doa_search
+# * 'late': late reverberation parameters, from the RIR samples, fs, RoomDims, late_fit_iterations, precision,
+#   late_analysis and the early parameters they are computed with
+# Changing only the late options therefore reuses the cached early stage, and so on.
+#
+# The cache directory is bounded to max_bytes: when it grows larger, the least recently used entries are deleted.
+# Writes are atomic, so the same directory can be shared by concurrent processes (e.g. BatchEncoding).
+#
+# Usage:
+#   cache = ResultCache(directory='RSAO_cache', max_bytes=500*2**20)
+#   EncoderSAOBFormat(RIRs=RIRs, fs=fs, cache=cache)
+
+import os
+import json
+import hashlib
+import tempfile
+import numpy as np
+
+CACHE_VERSION = 3
+
+# Encoder options each stage depends on (on top of the RIR samples, fs and the outputs of the previous stages)
+STAGE_OPTIONS = {'peaks': ['groupdelay_threshold', 'use_LPC', 'peak_channels', 'ambisonic_format'],
+                 'segments': ['groupdelay_threshold', 'use_LPC', 'peak_channels', 'ambisonic_format', 'n_discrete',
+                              'discrete_mode'],
+                 'early': ['groupdelay_threshold', 'use_LPC', 'peak_channels', 'ambisonic_format', 'n_discrete',
+                           'discrete_mode', 'doa_search'],
+                 'late': ['RoomDims', 'late_fit_iterations', 'precision', 'late_analysis']}
+
+
+class ResultCache:
+
+    def __init__(self, directory='RSAO_cache', max_bytes=500*2**20):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, stage, rir_digest, fs, options, parent=None):
+        # Key of a stage output: hash of the stage name, the RIR digest, fs, the stage options and (for the late stage)
+        # the digest of the early parameters
+        description = json.dumps({'version': CACHE_VERSION, 'stage': stage, 'rir': rir_digest, 'fs': fs,
+                                  'options': {option: _jsonable(options.get(option))
+                                              for option in STAGE_OPTIONS[stage]},
+                                  'parent': parent}, sort_keys=True)
+
+        return hashlib.sha256(description.encode()).hexdigest()
+
+    def get(self, stage, key):
+        # Returns the arrays stored for the key (a dictionary), or None on a cache miss
+        filename = self._filename(stage, key)
+        try:
+            with np.load(filename, allow_pickle=False) as data:
+                arrays = {name: data[name] for name in data.files}
+            os.utime(filename)  # Marks the entry as recently used
+        except (IOError, ValueError):
+            self.misses += 1
+            return None
+
+        self.hits += 1
+
+        return arrays
+
+    def put(self, stage, key, arrays):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory, exist_ok=True)
+
+        # The entry is written to a temporary file and then renamed, so that readers never see a partial entry
+        handle, tmpname = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(handle, 'wb') as outfile:
+                np.savez_compressed(outfile, **arrays)
+            os.replace(tmpname, self._filename(stage, key))
+        except BaseException:
+            os.remove(tmpname)
+            raise
+
+        self.evict()
+
+        return self
+
+    def evict(self):
+        # Deletes the least recently used entries until the cache is within max_bytes
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.npz'):
+                try:
+                    stat = os.stat(os.path.join(self.directory, name))
+                except OSError:
+                    continue  # Deleted by another process
+                entries.append((stat.st_mtime, stat.st_size, name))
+
+        total = sum([entry[1] for entry in entries])
+        for mtime, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+            total -= size
+
+        return self
+
+    def clear(self):
+        if os.path.isdir(self.directory):
+            for name in os.listdir(self.directory):
+                if name.endswith('.npz'):
+                    os.remove(os.path.join(self.directory, name))
+
+        return self
+
+    def _filename(self, stage, key):
+        return os.path.join(self.directory, stage + '-' + key + '.npz')
+
+
+def array_digest(*arrays):
+    # Hash of the content, type and shape of the arrays in input
+    digest = hashlib.sha256()
+    for array in arrays:
+        array = np.ascontiguousarray(array)
+        digest.update((str(array.dtype) + str(array.shape)).encode())
+        digest.update(array.tobytes())
+
+    return digest.hexdigest()
+
+
+def _jsonable(value):
+    return np.asarray(value).tolist() if value is not None else None
@@ -0,0 +1,134 @@
+#
+# This class encodes a grid of RIRs measured in the same room (e.g. several source/receiver positions) with the same fs
+# and encoder options. What does not depend on the single RIR is calculated once for the whole grid: the late
+# reverberation filter bank (unless late_analysis is 'multirate', where each encoder filters its own decimated bands),
+# the model-based mixing time of the room, the DYPSA group delay windows and the steering directions of the beamformer.
+# The positions are encoded in chunks of 'chunk' positions: the W channels of a chunk are filtered through each band at
+# once, and its positions are then encoded one by one (concurrently, with workers), as the early reflections found in
+# each RIR are different. Only the filtered bands of one chunk are held in memory at a time.
+#
+# The parameters of all the positions are stacked along a leading position axis (see stack_params in ParameterStore),
+# e.g. params['early_doa'] is a (positions x early parts x 2) array and params['late_expdecays'] a (positions x bands)
+# array, so that a renderer can interpolate them between the positions. save() writes them to a .npz file, together
+# with the coordinates of the positions, if given.
+#
+# Usage:
+#   session = RoomSession(fs=48000, RoomDims=[x, y, z], n_discrete=20, workers=4, chunk=16)
+#   session.encode(RIRs, positions=coordinates)  # RIRs: positions x samples x channels
+#   session.params['early_toa'], session.position(0)  # or session.save('grid.npz')
+
+import json
+import numpy as np
+from Encoder_SAO_Bformat import EncoderSAOBFormat, LATE_FCENTRE
+from ParameterStore import SCHEMA_VERSION, encoder_settings, pack_early, pack_late, stack_params, unstack_params, \
+    unpack_early, unpack_late
+from TaskGraph import TaskGraph
+
+
+class RoomSession:
+
+    def __init__(self, fs=48000, RoomDims=None, workers=None, chunk=8, **options):
+        self.fs = fs
+        self.RoomDims = RoomDims
+        self.workers = workers  # Number of positions encoded at the same time (None: one after the other)
+        self.chunk = chunk  # Number of positions whose bands are filtered at once
+        self.options = options  # Options of EncoderSAOBFormat (e.g. n_discrete, ambisonic_format, cache)
+
+        self.filterbank = None
+        self.prepared = False
+        self.mixingTime = None
+        self.positions = None
+        self.params = None
+        self.settings = None
+
+    def prepare(self, nChannels=4):
+        # Calculates what all the positions share, for RIRs of nChannels channels
+        from FilterGeneration import FilterBank
+        from MixingTime_Estimation import EstimatePerceptualMixingTime
+        from Utility import group_delay_windows
+        from Beamformers import steering_table, coarse_table, ambisonic_order
+
+        if self.RoomDims is None:
+            raise ValueError('Please, provide the room dimensions in input')
+
+        if self.options.get('late_analysis', 'full') == 'full':
+            self.filterbank = FilterBank(fcentre=LATE_FCENTRE, BW=1, fs=self.fs,
+                                         dtype=np.dtype(self.options.get('precision', 'float64')))
+            self.filterbank.octaveBankSOS()
+
+        mte = EstimatePerceptualMixingTime(RoomDims=self.RoomDims)
+        mte.model_based()
+        self.mixingTime = mte.mixing_time_estimate
+
+        # The windows and the steering table are stored by the modules themselves, for all the encoders of the process
+        group_delay_windows(self.fs)
+        ambisonic_format = self.options.get('ambisonic_format', 'WXYZ')
+        steering_table('3D', 1, ambisonic_order(nChannels, ambisonic_format), ambisonic_format)
+        if self.options.get('doa_search', 'grid') == 'refine':
+            coarse_table('3D')
+        self.prepared = True
+
+        return self
+
+    def encode(self, RIRs, positions=None):
+        # Encodes the stack of RIRs (positions x samples x channels). positions optionally gives the coordinates of
+        # each position (one row per position), saved with the parameters
+        RIRs = np.asarray(RIRs)
+        if RIRs.ndim != 3:
+            raise ValueError('RIRs must be a (positions x samples x channels) array, not ' + str(RIRs.shape))
+        if positions is not None and len(positions) != RIRs.shape[0]:
+            raise ValueError(str(len(positions)) + ' positions given for ' + str(RIRs.shape[0]) + ' RIRs')
+        if not self.prepared:
+            self.prepare(RIRs.shape[2])
+
+        results = []
+        for first in range(0, RIRs.shape[0], self.chunk):
+            positions_chunk = range(first, min(first + self.chunk, RIRs.shape[0]))
+
+            # W channels of the chunk, filtered through each band (bands x positions x samples). With the multirate
+            # late analysis, each encoder filters its own decimated bands instead
+            if self.filterbank is not None:
+                self.filterbank.filterZeroPhase(RIRs[positions_chunk.start:positions_chunk.stop, :, 0])
+
+            graph = TaskGraph(workers=self.workers)
+            for idx_position in positions_chunk:
+                graph.add(idx_position, self._encode_position, [], RIRs[idx_position],
+                          self.filterbank.filtered[:, idx_position - first, :] if self.filterbank is not None else None)
+            graph.run()
+            results.extend([graph.results[idx_position] for idx_position in positions_chunk])
+            if self.filterbank is not None:
+                self.filterbank.filtered = None
+
+        self.params = stack_params([result[0] for result in results])
+        self.settings = results[0][1]
+        self.positions = np.asarray(positions, dtype=float) if positions is not None else None
+
+        return self
+
+    def position(self, idx_position):
+        # Parameters of one position, as given by EncoderSAOBFormat (param of the early and of the late stage)
+        arrays = unstack_params(self.params, idx_position)
+
+        return unpack_early(arrays), {'Late': unpack_late(arrays)}
+
+    def save(self, filename):
+        arrays = {'schema_version': np.array(SCHEMA_VERSION),
+                  'settings': np.array(json.dumps(self.settings))}
+        arrays.update(self.params)
+        if self.positions is not None:
+            arrays['positions'] = self.positions
+
+        np.savez_compressed(filename, **arrays)
+
+        return self
+
+    def _encode_position(self, RIRs, filteredBands):
+        encoder = EncoderSAOBFormat(RIRs=RIRs, fs=self.fs, RoomDims=self.RoomDims, **self.options)
+        encoder.filteredBands = filteredBands
+        encoder.mixingTime = self.mixingTime
+        encoder.parameterization()
+
+        arrays = pack_early(encoder.param)
+        arrays.update(pack_late(encoder.paramLate['Late']))
+
+        return arrays, encoder_settings(encoder)
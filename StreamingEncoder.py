@@ -0,0 +1,139 @@
+#
+# This class runs the RSAO encoder on a RIR that arrives block by block (e.g. from the deconvolution of a sweep in a
+# live measurement), publishing the parameters as soon as the samples they depend on are available:
+# * the direct sound and early reflection parameters, as soon as the RIR covers the region where DYPSA looks for peaks
+#   (twice CUTOFF_SAMPLES, see Algorithm_PeakDetection.py, plus the window of the direct sound). They are the same
+#   parameters as given by the complete RIR, as long as the direct sound is its strongest sample
+# * the late reverberation parameters, once the energy of the W channel (in 50 ms windows) has dropped by decay_range
+#   dB below its level at the late reverberation onset, i.e. once the decay is covered. The decays are then estimated
+#   from the RIR received so far. With decay_range None, they are only estimated by finish(), from the complete RIR
+#
+# finish() is called when the RIR is complete, and estimates the parameters not published yet. Without RoomDims, only
+# the early parameters are estimated (the late reverberation onset depends on the mixing time of the room).
+#
+# Usage:
+#   stream = StreamingEncoder(fs=48000, RoomDims=[x, y, z], on_early=show_early, on_late=show_late)
+#   for block in blocks:
+#       stream.push(block)
+#   stream.finish()
+#   stream.paramEarly, stream.paramLate
+
+import numpy as np
+from Encoder_SAO_Bformat import EncoderSAOBFormat
+from Algorithm_PeakDetection import CUTOFF_SAMPLES
+from Instrumentation import logger
+
+
+class StreamingEncoder:
+
+    def __init__(self, fs=48000, RoomDims=None, decay_range=60, on_early=None, on_late=None, **options):
+        self.fs = fs
+        self.RoomDims = RoomDims
+        self.decay_range = decay_range
+        self.on_early = on_early  # Called with the early parameters, as soon as they are estimated
+        self.on_late = on_late  # Called with the late parameters, as soon as they are estimated
+        self.options = options  # Options of EncoderSAOBFormat (e.g. n_discrete, ambisonic_format, cache)
+
+        self.nSamples = 0
+        self.paramEarly = None
+        self.paramLate = None
+
+        # Samples needed for the early parameters: the region analysed by DYPSA, and the window of the direct sound
+        self.early_samples = 2*CUTOFF_SAMPLES + max(int(0.002*fs), 32)
+
+        self._buffer = None
+        self._frame = int(fs / 100)  # Length of the frames of the energy envelope (10 ms)
+        self._late_onset = None  # First sample of the late reverberation
+        self._frame_energies = []  # Energy of the W channel in each frame after the late onset
+
+    def push(self, block):
+        # Appends a block of samples (samples x channels) to the RIR
+        block = np.atleast_2d(np.asarray(block))
+        if block.shape[0] == 0:
+            return self
+        self._append(block)
+
+        if self.paramEarly is None and self.nSamples >= self.early_samples:
+            self._estimate_early()
+        if self.paramEarly is not None and self.paramLate is None and self.RoomDims is not None and \
+                self.decay_range is not None and self._decay_covered():
+            self._estimate_late()
+
+        return self
+
+    def finish(self):
+        # Estimates the parameters not published yet, from the complete RIR
+        if self.paramEarly is None:
+            self._estimate_early()
+        if self.paramLate is None and self.RoomDims is not None:
+            self._estimate_late()
+
+        return self
+
+    @property
+    def RIRs(self):
+        # The RIR received so far
+        return self._buffer[:self.nSamples] if self._buffer is not None else None
+
+    def _append(self, block):
+        # The samples are stored in a buffer that doubles in size when full, so that appending is not quadratic
+        if self._buffer is None:
+            self._buffer = np.zeros([max(block.shape[0], self.early_samples), block.shape[1]], dtype=block.dtype)
+        elif block.shape[1] != self._buffer.shape[1]:
+            raise ValueError('Blocks of ' + str(block.shape[1]) + ' channels given, but the RIR has ' +
+                             str(self._buffer.shape[1]))
+        if self.nSamples + block.shape[0] > self._buffer.shape[0]:
+            buffer = np.zeros([max(2*self._buffer.shape[0], self.nSamples + block.shape[0]), self._buffer.shape[1]],
+                              dtype=self._buffer.dtype)
+            buffer[:self.nSamples] = self._buffer[:self.nSamples]
+            self._buffer = buffer
+
+        self._buffer[self.nSamples:self.nSamples + block.shape[0]] = block
+        self.nSamples += block.shape[0]
+
+    def _estimate_early(self):
+        early = EncoderSAOBFormat(RIRs=self.RIRs, fs=self.fs, **self.options)
+        early.direct_and_early_parameterization()
+        self.paramEarly = early.param
+        logger.info('Early parameters estimated from the first ' + str(self.nSamples) + ' samples')
+
+        if self.on_early is not None:
+            self.on_early(self.paramEarly)
+
+    def _estimate_late(self):
+        late = EncoderSAOBFormat(RIRs=self.RIRs, fs=self.fs, RoomDims=self.RoomDims, EarlyProperties=self.paramEarly,
+                                 **self.options)
+        late.late_parameterization()
+        self.paramLate = late.param
+        logger.info('Late parameters estimated from the first ' + str(self.nSamples) + ' samples')
+
+        if self.on_late is not None:
+            self.on_late(self.paramLate)
+
+    def _decay_covered(self):
+        # True once the energy of the W channel, averaged over 50 ms, has dropped by decay_range dB below its average
+        # over the first 50 ms of the late reverberation
+        if self._late_onset is None:
+            from MixingTime_Estimation import EstimatePerceptualMixingTime
+
+            # Same onset as in EncoderSAOBFormat.late_parameterization
+            mte = EstimatePerceptualMixingTime(RoomDims=self.RoomDims)
+            mte.model_based()
+            self._late_onset = int(round(mte.mixing_time_estimate['model']['tmp50'] * self.fs / 1000 +
+                                         self.paramEarly['Direct_sound']['toa_notconverted'] + 100))
+
+        # Energy of the frames completed since the last block
+        first = self._late_onset + len(self._frame_energies) * self._frame
+        nFrames = max((self.nSamples - first) // self._frame, 0)
+        if nFrames > 0:
+            W = self._buffer[first:first + nFrames*self._frame, 0].astype(float)
+            self._frame_energies.extend(np.sum(W.reshape(nFrames, self._frame) ** 2, 1).tolist())
+
+        window = 5
+        if len(self._frame_energies) < 2*window:
+            return False
+        energies = np.array(self._frame_energies)
+        reference = np.sum(energies[:window])
+        averages = np.convolve(energies[window:], np.ones(window), 'valid')
+
+        return bool(np.any(averages <= reference * 10**(-self.decay_range/10)))
@@ -0,0 +1,82 @@
+#
+# This class runs a set of tasks with dependencies between them (a directed acyclic graph) on a pool of threads or
+# processes. Each task is a function, called with its own arguments followed by the results of the tasks it depends on
+# (in the order they are listed), as soon as all of them are available, so that independent tasks run concurrently.
+# The results are stored by task name, in the order the tasks were added, and do not depend on the order in which the
+# tasks actually ran.
+#
+# With workers None or 1 the tasks run one after the other in the calling thread, in the order they were added (which
+# must then follow the dependencies). Threads suit the encoder stages, whose NumPy/SciPy calls release the GIL; with
+# processes, the functions, arguments and results must be picklable.
+#
+# Usage:
+#   graph = TaskGraph(workers=4)
+#   graph.add('band1', signal.sosfiltfilt, [], sos1, x)
+#   graph.add('band2', signal.sosfiltfilt, [], sos2, x)
+#   graph.add('energy', lambda band1, band2: np.sum(band1**2) + np.sum(band2**2), ['band1', 'band2'])
+#   graph.run().results['energy']
+
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+
+class TaskGraph:
+
+    def __init__(self, workers=None, executor='thread'):
+        self.workers = workers
+        self.executor = executor  # 'thread' or 'process'
+        self.tasks = {}  # name: (function, dependencies, arguments)
+        self.results = {}
+
+    def add(self, name, function, dependencies=(), *args):
+        if name in self.tasks:
+            raise ValueError('Task ' + str(name) + ' added twice')
+        self.tasks[name] = (function, list(dependencies), args)
+
+        return self
+
+    def run(self):
+        for name in self.tasks:
+            for dependency in self.tasks[name][1]:
+                if dependency not in self.tasks:
+                    raise ValueError('Task ' + str(name) + ' depends on the unknown task ' + str(dependency))
+
+        if self.workers is None or self.workers <= 1:
+            results = {}
+            for name, (function, dependencies, args) in self.tasks.items():
+                if any([dependency not in results for dependency in dependencies]):
+                    raise ValueError('Task ' + str(name) + ' is added before the tasks it depends on')
+                results[name] = function(*args, *[results[dependency] for dependency in dependencies])
+        else:
+            results = self._run_pool()
+
+        self.results = {name: results[name] for name in self.tasks}
+
+        return self
+
+    def _run_pool(self):
+        results = {}
+        waiting = dict(self.tasks)
+        running = {}
+        pool_type = ThreadPoolExecutor if self.executor == 'thread' else ProcessPoolExecutor
+        with pool_type(max_workers=self.workers) as pool:
+            while waiting or running:
+                # Submits every task whose dependencies are all completed
+                for name in [name for name in waiting if all([dependency in results
+                                                              for dependency in waiting[name][1]])]:
+                    function, dependencies, args = waiting.pop(name)
+                    running[pool.submit(function, *args, *[results[dependency] for dependency in dependencies])] = name
+
+                if not running:
+                    raise ValueError('The dependencies of the tasks ' + str(list(waiting)) + ' form a cycle')
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        results[name] = future.result()
+                    except BaseException:
+                        for other in running:
+                            other.cancel()
+                        raise
+
+        return results
@@ -5,7 +5,6 @@
 # Email: l.remaggi@surrey.ac.uk
 # 05/02/2018
 
-from scipy import signal
 import numpy as np
 
 
@@ -29,35 +28,39 @@ class Utility:
         # presented in P. A. Naylor, A. Kounoudes, J. Gudnason and M. Brookes, ''Estimation of glottal closure instants in
         # voiced speech using the DYPSA algorithm'', IEEE Trans. on Audio, Speech and Lang. Proc., Vol. 15, No. 1, Jan. 2007
 
-        # General variables
-        dy_gwlen = 0.003
-        dy_fwlen = 0.00045
+        from scipy import signal
 
-        # Perform group delay calculation
-        gw = np.int_(2 * np.floor(dy_gwlen*self.fs/2) + 1)  # Force window length to be odd
-        ghw = signal.hamming(gw, 1)
-        ghwn = np.squeeze(ghw * [np.array(range(gw-1, -gw, -2))/2])
+        # Perform group delay calculation. The numerator and denominator windows are applied to the squared RIR
+        # together, by FFT overlap-add convolution
+        gw, ghw, ghwn, fw, daw = group_delay_windows(self.fs)
 
-        RIR2 = self.RIR ** 2
-        yn = signal.lfilter(ghwn, [1], RIR2)
-        yd = signal.lfilter(ghw, [1], RIR2)
+        # The RIR can have several channels (one per column), all processed together: tew and sew are then lists
+        # with the zero crossings of each channel
+        RIR2 = np.asarray(self.RIR, dtype=np.float64).T ** 2
+        yn, yd = _windowed_sums(RIR2, np.stack([ghwn, ghw]))
         yd[abs(yd) < 10**-16] = 10**-16  # It prevents infinity
-        self.y = yn[gw-1:] / yd[gw-1:]
+        self.y = yn / yd
         self.toff = (gw - 1) / 2
-        fw = np.int_(2 * np.floor(dy_fwlen*self.fs/2) + 1)  # Force window length to be odd
         if fw > 1:
-            daw = signal.hamming(fw, 1)
             self.y = signal.lfilter(daw, [1], self.y) / np.sum(daw)  # Low pass filtering
             self.toff = self.toff - (fw - 1)/2
 
         # Finding zero crossing
-        self.x = self.y * 1
-        self.m = 'n'
-        self.zerocross()
-        self.tew = self.t
-        self.sew = self.s
-
-        self.tew = self.tew + self.toff
+        tew = []
+        sew = []
+        for y in np.atleast_2d(self.y):
+            self.x = y * 1
+            self.m = 'n'
+            self.zerocross()
+            tew.append(self.t + self.toff)
+            sew.append(self.s)
+
+        if self.y.ndim == 1:
+            self.tew = tew[0]
+            self.sew = sew[0]
+        else:
+            self.tew = tew
+            self.sew = sew
 
         return self
 
@@ -67,24 +70,87 @@ class Utility:
 
         self.x[abs(self.x) < 10 ** -5] = 0
 
-        self.s = self.x >= 0
-        self.s = np.int_(np.array(self.s))  # Converting false to 0 and true to 1
-        k = self.s[1:] - self.s[:-1]
-        if self.m is 'p':
-            f = np.where(k > 0)
-        elif self.m is 'n':
-            f = np.where(k < 0)
+        # Sign changes are found on the boolean sign array, without converting it to integers
+        positive = self.x >= 0
+        if self.m == 'p':
+            f = np.flatnonzero(~positive[:-1] & positive[1:])
+        elif self.m == 'n':
+            f = np.flatnonzero(positive[:-1] & ~positive[1:])
         else:
-            f = k != 0
-
-        f = np.transpose(np.int_(f))
+            f = np.flatnonzero(positive[:-1] != positive[1:])
 
-        self.s = np.subtract(self.x[f + 1], self.x[f])
-        self.t = f - np.divide(self.x[f], self.s)
+        self.s = self.x[f + 1] - self.x[f]
+        self.t = f - self.x[f] / self.s
 
         return self
 
 
+# Windows of the group delay calculation, one set for each sampling frequency
+_group_delay_windows = {}
+
+
+def group_delay_windows(fs):
+    # Returns the length and coefficients of the Hamming windows used by xewgrdel (group delay window, group delay
+    # window weighted by the time ramp, and smoothing window). They are calculated only once for each fs
+    if fs not in _group_delay_windows:
+        from scipy import signal
+
+        # General variables
+        dy_gwlen = 0.003
+        dy_fwlen = 0.00045
+
+        gw = int(2 * np.floor(dy_gwlen*fs/2) + 1)  # Force window length to be odd
+        ghw = signal.windows.hamming(gw, True)
+        ghwn = ghw * np.arange(gw-1, -gw, -2) / 2
+        fw = int(2 * np.floor(dy_fwlen*fs/2) + 1)  # Force window length to be odd
+        daw = signal.windows.hamming(fw, True)
+
+        _group_delay_windows[fs] = (gw, ghw, ghwn, fw, daw)
+
+    return _group_delay_windows[fs]
+
+
+def _windowed_sums(x, windows, nfft=1024):
+    # Applies each window (rows of 'windows') as an FIR filter to x, and returns only the output samples computed from
+    # a full window of input, i.e. signal.lfilter(window, [1], x)[len(window)-1:] for every window.
+    # x is either one signal, or several signals (one per row) processed together, in which case the output has one
+    # row per window and signal.
+    # The convolutions are calculated block by block with FFTs. The rounding error of each block is proportional to
+    # the largest input in that block, which is a problem where the RIR drops by many orders of magnitude within a
+    # block: the few output samples whose error bound is not negligible compared to their own (non-negative) value are
+    # calculated again directly
+    single = np.ndim(x) == 1
+    x = np.ascontiguousarray(np.atleast_2d(x))
+    nWin, gw = windows.shape
+    nSignals, N = x.shape
+    block = nfft - gw + 1
+    nBlocks = int(np.ceil(N / block))
+
+    # Overlap-add: every input block is convolved with all the windows, and the last gw-1 samples of each output block
+    # are added to the beginning of the next one
+    blocks = np.zeros([nSignals, nBlocks, block])
+    blocks.reshape(nSignals, -1)[:, :N] = x
+    spectra = np.fft.rfft(windows, nfft)
+    conv = np.fft.irfft(np.fft.rfft(blocks, nfft)[None, :, :, :] * spectra[:, None, None, :], nfft)
+    full = np.zeros([nWin, nSignals, nBlocks+1, block])
+    full[:, :, :nBlocks, :] = conv[:, :, :, :block]
+    full[:, :, 1:, :gw-1] += conv[:, :, :, block:]
+    out = full.reshape(nWin, nSignals, -1)[:, :, gw-1:N]
+
+    # Error bound of the output samples from the largest input of the blocks contributing to them
+    peak = np.max(np.abs(blocks), 2)
+    peak = np.maximum(peak, np.concatenate([np.zeros([nSignals, 1]), peak[:, :-1]], 1))
+    bound = np.repeat(peak, block, 1)[:, gw-1:N] * np.sum(np.abs(windows[-1])) * nfft * np.finfo(float).eps
+    for idx_signal in range(0, nSignals):
+        recompute = np.flatnonzero(np.abs(out[-1, idx_signal]) < 10**8 * bound[idx_signal])
+        if len(recompute) > 0:
+            frames = np.lib.stride_tricks.as_strided(x[idx_signal], shape=(N-gw+1, gw),
+                                                     strides=(x.strides[1], x.strides[1]))
+            out[:, idx_signal, recompute] = np.dot(windows[:, ::-1], frames[recompute].T)
+
+    return out[:, 0, :] if single else out
+
+
 class DecayCalculation:
 
     def __init__(self, h, fs=48000, region=[-5, -35], delay_comp=0):
@@ -94,7 +160,8 @@ class DecayCalculation:
         self.delay_comp = delay_comp
 
     def RT_Shroeder(self):
-        # This method calculates reverb time and energy decay using the Shroeder's approach
+        # This method calculates reverb time and energy decay using the Shroeder's approach (the energy decay is the
+        # one of DecayAnalysis, which analyses many signals at once)
 
         h_length = len(self.h)
         # Compensate sound propagation (exclude parts of the RIR before the direct path)
@@ -104,21 +171,16 @@ class DecayCalculation:
             h_length = len(self.h)
 
         # Energy decay curve
-        h_sq = self.h ** 2
-        h_sq = np.flipud(h_sq)
-        self.EDC = np.cumsum(h_sq)
-        self.EDC = np.flipud(self.EDC) + 10**-250
-
-        # Normalize to '1'
-        EDC_norm = self.EDC / np.max(self.EDC)
+        decay = DecayAnalysis(h=self.h, fs=self.fs).analyse()
+        self.EDC = decay.EDC
+        self.EDC_log = decay.EDC_log
 
         # Estimate the reverberation time
-        self.EDC_log = 10*np.log10(EDC_norm)
         EDC_reg1 = np.int_(np.argwhere(self.EDC_log <= self.region[0])[0])
         EDC_reg2 = np.int_(np.argwhere(self.EDC_log <= self.region[1])[0])
 
         EDC_reg12 = self.EDC_log[EDC_reg1[0]:EDC_reg2[0]]
-        x = np.array([idx for idx in range(0, len(EDC_reg12))])
+        x = np.arange(0, len(EDC_reg12))
         p = np.polyfit(x, EDC_reg12, 1)
         y = p[0]*x + p[1]
 
@@ -130,12 +192,208 @@ class DecayCalculation:
         # Reverberation time in seconds
         self.RT = x_rt/self.fs
 
-        # Fitting line from 0 to -60dB
-        x = np.array([idx for idx in range(0, x_rt[0])])
-        y = p[0]*x + y0
+        return self
+
+
+class DecayAnalysis:
+    # Schroeder energy decay analysis of a batch of signals at once (e.g. channels x bands x samples, the decay being
+    # along the last axis), which start at the direct sound. A single pass gives, for each signal:
+    # * EDT, T20, T30: decay times (seconds) extrapolated to -60 dB from the least-squares line over 0 to -10 dB,
+    #   -5 to -25 dB and -5 to -35 dB of the EDC in dB, NaN where the EDC does not decay that far
+    # * C50, C80: clarity (dB), the energy before 50 and 80 ms from the direct sound over the energy after, NaN for
+    #   signals shorter than that
+    # * EDC, EDC_log: energy decay curve (accumulated in float64, and given with the floating point type of h) and the
+    #   same in dB, normalized to 0 dB at its first sample. They start at the sample 'tail' (e.g. the late
+    #   reverberation onset): the EDC from any sample on is a slice of the EDC of the whole signal
+    # * stops: sample where EDC_log is the closest to stop dB
+    # The EDC in dB is non-increasing, so each fitting region is a contiguous range of samples, and the sums of the
+    # least-squares lines come from two cumulative sums shared by all the regions. The large temporaries are computed
+    # in place.
+
+    def __init__(self, h, fs=48000, stop=-20, tail=0):
+        self.h = np.asarray(h)
+        if not np.issubdtype(self.h.dtype, np.floating):
+            self.h = self.h.astype(float)
+        self.fs = fs
+        self.stop = stop
+        self.tail = tail
+
+        self.EDC = None
+        self.EDC_log = None
+        self.stops = None
+        self.EDT = None
+        self.T20 = None
+        self.T30 = None
+        self.C50 = None
+        self.C80 = None
+
+    def analyse(self):
+        EDC = np.cumsum(np.flip(self.h ** 2, -1), -1, dtype=np.float64)
+        EDC = np.flip(EDC, -1)
+        EDC += 10**-250
+        EDC_log = _decibels(EDC)
+
+        # Sums of EDC_log and of EDC_log times the time (s) up to each sample, for the decay times
+        Cy = np.zeros(EDC_log.shape[:-1] + (EDC_log.shape[-1] + 1,))
+        np.cumsum(EDC_log, -1, out=Cy[..., 1:])
+        Cxy = np.zeros(Cy.shape)
+        np.multiply(EDC_log, np.arange(0, EDC_log.shape[-1]) / self.fs, out=Cxy[..., 1:])
+        np.cumsum(Cxy[..., 1:], -1, out=Cxy[..., 1:])
+        self.EDT = self._decay_time(EDC_log, Cy, Cxy, (0, -10))
+        self.T20 = self._decay_time(EDC_log, Cy, Cxy, (-5, -25))
+        self.T30 = self._decay_time(EDC_log, Cy, Cxy, (-5, -35))
+        self.C50 = self._clarity(EDC, 0.05)
+        self.C80 = self._clarity(EDC, 0.08)
+        del Cy, Cxy
+
+        if self.tail > 0:
+            EDC = EDC[..., self.tail:]
+            EDC_log = _decibels(EDC)
+
+        dtype = np.result_type(self.h.dtype, np.float32)
+        self.EDC = EDC.astype(dtype, copy=False)
+        self.EDC_log = EDC_log.astype(dtype, copy=False)
+        self.stops = np.argmin(np.abs(self.EDC_log - self.stop), -1)
+
+        return self
+
+    def _decay_time(self, EDC_log, Cy, Cxy, region):
+        # Least-squares line over the samples where region[0] >= EDC_log >= region[1], from the cumulative sums (with
+        # the time measured from the first sample of the region, which keeps the sums well conditioned)
+        first = np.sum(EDC_log > region[0], -1, keepdims=True)
+        last = np.sum(EDC_log >= region[1], -1, keepdims=True)
+        n = (last - first)[..., 0].astype(float)
+        Sy = (np.take_along_axis(Cy, last, -1) - np.take_along_axis(Cy, first, -1))[..., 0]
+        Sxy = (np.take_along_axis(Cxy, last, -1) - np.take_along_axis(Cxy, first, -1))[..., 0] - \
+            first[..., 0]/self.fs*Sy
+        Sx = n*(n - 1)/2 / self.fs
+        Sxx = (n - 1)*n*(2*n - 1)/6 / self.fs**2
+        with np.errstate(divide='ignore', invalid='ignore'):
+            slope = (n*Sxy - Sx*Sy) / (n*Sxx - Sx**2)
+        covered = (EDC_log[..., -1] <= region[1]) & (n > 1) & (slope < 0)
+
+        return np.where(covered, -60 / np.where(covered, slope, -1), np.nan)
+
+    def _clarity(self, EDC, time):
+        # Energy before time (s) over the energy after, in dB
+        sample = int(round(time * self.fs))
+        if sample >= EDC.shape[-1]:
+            return np.full(EDC.shape[:-1], np.nan)
+
+        return 10*np.log10((EDC[..., 0] - EDC[..., sample]) / EDC[..., sample])
+
+
+def _decibels(EDC):
+    # Energy decay curves in dB, normalized to 0 dB at their maximum (first sample)
+    EDC_log = EDC / np.max(EDC, -1, keepdims=True)
+    np.log10(EDC_log, out=EDC_log)
+    EDC_log *= 10
+
+    return EDC_log
+
+
+class DecayFit:
+    # Fits the model EDC(n) = A*exp(b*n) to the energy decay curves of several bands at once. Each band is fitted from
+    # its first sample up to its own stop index. The closed-form solution of a weighted log-linear regression is used
+    # as initial estimate, then optionally refined by Newton iterations on the (linear) least-squares error.
+
+    def __init__(self, EDC, stops, n_iter=20, tol=1e-10):
+        self.EDC = np.atleast_2d(EDC)
+        self.stops = np.atleast_1d(stops)
+        self.n_iter = n_iter
+        self.tol = tol
+
+        self.amplitude = None
+        self.rate = None
+        self.residual = None
+        self.converged = None
+        self.iterations = None
+
+    def fitExponential(self):
+        nBands = self.EDC.shape[0]
+        maxstop = int(np.max(self.stops))
+        mask = np.arange(maxstop)[None, :] < self.stops[:, None]
+        # Only the samples up to the stops are fitted, and their sums are accumulated in float64 (a single float64 copy
+        # of the samples fitted is made, whatever the dtype of EDC)
+        y = self.EDC[:, :maxstop].astype(np.float64)
+        y[~mask] = 0
+
+        # Sample indexes are scaled to [0, 1) to keep the sums well conditioned
+        scale = float(max(maxstop, 1))
+        x = np.arange(maxstop) / scale
+        x2 = x**2
+
+        # Log-linear fit weighted by y**2, which makes the log-domain residuals comparable to the linear ones
+        w = y**2
+        wlogy = np.log(np.where(mask, y, 1))
+        wlogy *= w
+        S0 = np.sum(w, 1)
+        S1 = np.dot(w, x)
+        S2 = np.dot(w, x2)
+        T0 = np.sum(wlogy, 1)
+        T1 = np.dot(wlogy, x)
+        del w, wlogy
+        det = S0*S2 - S1**2
+        rate = (S0*T1 - S1*T0) / np.where(det != 0, det, np.finfo(float).tiny)
+        energy = S0
+
+        # Refinement of the least-squares fit. For a given b the best A is sum(y*e)/sum(e**2), with e = exp(b*x), so
+        # that only b has to be found, by maximizing L(b) = 2*log(sum(y*e)) - log(sum(e**2)). All the derivatives of L
+        # come from a single pass over the data, and Newton steps are halved whenever they do not increase L
+        sums = self._sums(y, x, x2, mask, rate)
+        self.converged = np.zeros(nBands, dtype=bool)
+        self.iterations = np.zeros(nBands, dtype=int)
+        step = np.zeros(nBands)
+        for idx_iter in range(0, self.n_iter):
+            P, P1, P2, Q, Q1, Q2 = sums
+            L1 = 2*P1/P - Q1/Q
+            L2 = 2*(P2/P - (P1/P)**2) - (Q2/Q - (Q1/Q)**2)
+            step = np.where(L2 < 0, -L1 / np.where(L2 < 0, L2, -1), 0)
+            self.converged = self.converged | (np.abs(step) < self.tol * np.maximum(np.abs(rate), 1)) | (P <= 0)
+            active = ~self.converged
+            if not np.any(active):
+                break
+
+            objective = 2*np.log(np.abs(P)) - np.log(Q)
+            alpha = np.ones(nBands)
+            for idx_halving in range(0, 30):
+                trial = self._sums(y[active], x, x2, mask[active], rate[active] + alpha[active]*step[active])
+                # Changes of L at the level of the rounding errors are not taken as decrease
+                increased = (2*np.log(np.abs(trial[0])) - np.log(trial[3]) >=
+                             objective[active] - 1e-12*np.abs(objective[active]))
+                if np.all(increased) or idx_halving == 29:
+                    break
+                alpha[np.flatnonzero(active)[~increased]] /= 2
+
+            rate[active] = rate[active] + alpha[active]*step[active]
+            for sum_all, sum_active in zip(sums, trial):
+                sum_all[active] = sum_active
+            self.iterations[active] += 1
+
+        P, _, _, Q, _, _ = sums
+        amplitude = P / Q
+
+        # Going back to the per-sample decay constant, and the residual energy relative to the fitted EDC's energy
+        self.amplitude = amplitude
+        self.rate = rate / scale
+        self.residual = np.maximum(energy - P**2/Q, 0) / np.maximum(energy, np.finfo(float).tiny)
+        if self.n_iter == 0:
+            self.converged[:] = True
 
         return self
 
+    @staticmethod
+    def _sums(y, x, x2, mask, rate):
+        # Weighted sums of e = exp(b*x) needed by the fit, and their derivatives with respect to b
+        # The temporaries are computed in place, as they are as large as the samples fitted
+        e = np.multiply.outer(rate, x)
+        np.exp(e, out=e)
+        e[~mask] = 0
+        ye = y * e
+        e **= 2
+
+        return [np.sum(ye, 1), np.dot(ye, x), np.dot(ye, x2), np.sum(e, 1), 2*np.dot(e, x), 4*np.dot(e, x2)]
+
 
 class Biquad_Convertion():
 
@@ -143,7 +401,8 @@ class Biquad_Convertion():
                  iBand_investigated=None):
 
         self.RSAO_params = RSAO_params
-        self.RSAO_params_single = RSAO_params[idx_RIR_part_investigated]
+        self.RSAO_params_single = RSAO_params[idx_RIR_part_investigated] if idx_RIR_part_investigated is not None \
+            else None
         self.idx_RIR_part_investigated = idx_RIR_part_investigated
         self.iBand_investigated = iBand_investigated
         self.RSAO_params_directsound = RSAO_params_directsound
@@ -158,6 +417,19 @@ class Biquad_Convertion():
 
         return self
 
+    def lpc2biquads(self):
+        # Obtain biquad coefficients of all the parts with an LPC filter (direct sound and early reflections) at once.
+        # filtersos is then a dictionary, with the biquads of each part
+        names = [name for name in self.RSAO_params if 'filter' in self.RSAO_params[name]]
+        orders = [len(self.RSAO_params[name]['filter']) - 1 for name in names]
+        filters = np.zeros([len(names), max(orders + [0]) + 1])
+        for idx_part in range(0, len(names)):
+            filters[idx_part, :orders[idx_part]+1] = self.RSAO_params[names[idx_part]]['filter']
+
+        self.filtersos = dict(zip(names, lpc2sos(filters, orders)))
+
+        return self
+
     def convertlevels_early(self):
         # Convert parameters so that the early levels are relative to the direct level
         directLevel = self.RSAO_params['Direct_sound']['level']
@@ -183,18 +455,77 @@ class Biquad_Convertion():
         return self
 
 
-def _normalized_sos(coeff):
-    # Subfunction to re-normalize the coefficients of the incoming LPC (FIR) coefficients to unity based on the noise
-    # gain np.sqrt(np.sum(coeff**2))
+def lpc2sos(filters, orders):
+    # Converts the LPC (FIR) coefficients of all the reflections, given as the rows of filters (padded with zeros after
+    # each row's order), into the second order sections of the all-pole filters 1/A(z), with the gain re-normalized to
+    # unity noise gain. Returns one array of sections for each row.
+    # The poles of all the rows with the same order are found together, as the eigenvalues of their companion matrices
+    # (as numpy.roots does for each polynomial), and are then paired into sections as by signal.tf2sos
+    from scipy import signal
+
+    filters = np.atleast_2d(np.asarray(filters, dtype=float))
+    orders = np.broadcast_to(np.asarray(orders, dtype=int), (filters.shape[0],))
+    noise_gains = allpole_noise_gain(filters)
+
+    sos = [None] * filters.shape[0]
+    for order in np.unique(orders):
+        rows = np.flatnonzero(orders == order)
+        coeffs = filters[rows, :order+1] / filters[rows, :1]
+        if order > 0:
+            companion = np.zeros([len(rows), order, order])
+            companion[:, 1:, :-1] = np.eye(order - 1)
+            companion[:, 0, :] = -coeffs[:, 1:]
+            poles = np.linalg.eigvals(companion)
+        else:
+            poles = np.zeros([len(rows), 0])
+
+        for idx_row, row in enumerate(rows):
+            if coeffs[idx_row, -1] == 0:
+                # Trailing zero coefficients are poles in zero, which numpy.roots does not calculate
+                row_poles = np.roots(coeffs[idx_row])
+                row_poles = np.concatenate([row_poles, np.zeros(order - len(row_poles))])
+            else:
+                row_poles = poles[idx_row]
+            sos[row] = signal.zpk2sos([], row_poles, 1 / filters[row, 0])
+            sos[row][0, 0] = sos[row][0, 0] / noise_gains[row]
+
+    return sos
+
+
+def allpole_noise_gain(filters):
+    # Noise gain, np.sqrt(np.sum(h**2)) over the whole impulse response h, of the all-pole filters 1/A(z) whose
+    # coefficients are the rows of filters. It is calculated from the reflection coefficients k of A(z), found by the
+    # step-down (inverse Levinson) recursion: with white noise of unit power in input, the output power is
+    # 1 / (a0**2 * prod(1 - k**2)). For unstable filters (|k| >= 1) the impulse response is truncated to 65 samples,
+    # as in the previous estimation by filtering
+    filters = np.atleast_2d(np.asarray(filters, dtype=float))
+    a = filters / filters[:, :1]
+    power = np.ones(filters.shape[0])
+    stable = np.ones(filters.shape[0], dtype=bool)
+    for m in range(a.shape[1] - 1, 0, -1):
+        k = a[:, m]
+        stable = stable & (abs(k) < 1)
+        denominator = np.where(stable, 1 - k**2, 1)
+        power = power * denominator
+        a = (a[:, :m] - k[:, None] * a[:, m:0:-1]) / denominator[:, None]
+
+    noise_gain = 1 / (abs(filters[:, 0]) * np.sqrt(power))
+    for row in np.flatnonzero(~stable):
+        noise_gain[row] = _truncated_noise_gain(filters[row])
 
-    impulse = np.zeros(129)
-    impulse[64] = 1
-    sos = signal.tf2sos(1, coeff)
-    filtsig1 = signal.sosfilt(sos, impulse)
-    lpc_noise_gain = np.sqrt(np.sum(filtsig1 ** 2))
+    return noise_gain
 
-    gainmatrix = np.ones([sos.shape[0], sos.shape[1]])
-    gainmatrix[0, 0] = 1/lpc_noise_gain
-    soscoeff = sos * gainmatrix
 
-    return soscoeff
\ No newline at end of file
+def _truncated_noise_gain(coeff, nSamples=65):
+    from scipy import signal
+
+    impulse = np.zeros(nSamples)
+    impulse[0] = 1
+
+    return np.sqrt(np.sum(signal.lfilter([1], coeff, impulse) ** 2))
+
+
+def _normalized_sos(coeff):
+    # Subfunction to re-normalize the coefficients of the incoming LPC (FIR) coefficients to unity noise gain (see
+    # lpc2sos, converting the coefficients of all the reflections at once)
+    return lpc2sos(coeff, len(coeff) - 1)[0]
@@ -0,0 +1,62 @@
+#
+# Benchmark of the cold-start cost of the encoder: every path is timed in a fresh Python interpreter, so that nothing is
+# already imported. For each path, 'entry' is the import of the module a script starts from, 'first use' the imports
+# done the first time the stage runs, and 'process' the wall time of the whole interpreter (start-up included).
+#
+# Usage (from the repository root):
+#   python benchmarks/bench_import.py [number of runs]
+
+import os
+import sys
+import json
+import time
+import subprocess
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# Imports of each path: the module the script starts from, and the modules loaded the first time the stage runs
+PATHS = {'early': (['Encoder_SAO_Bformat'],
+                   ['RIR_Segmentation', 'Beamformers', 'LinearPrediction', 'Utility', 'scipy.signal']),
+         'late': (['Encoder_SAO_Bformat'],
+                  ['MixingTime_Estimation', 'FilterGeneration', 'Utility', 'scipy.signal']),
+         'json': (['GenerateJSON'], [])}
+
+# Code run in the fresh interpreter, printing the timings (in seconds) and the heavy modules loaded by the entry import
+CHILD = '''
+import sys, time, json, importlib
+sys.path.insert(0, {root!r})
+start = time.perf_counter()
+for module in {entry!r}:
+    importlib.import_module(module)
+entry = time.perf_counter() - start
+loaded = [module for module in ('scipy', 'scipy.signal', 'audiolazy') if module in sys.modules]
+for module in {first_use!r}:
+    importlib.import_module(module)
+print(json.dumps({{'entry': entry, 'first_use': time.perf_counter() - start - entry, 'loaded': loaded}}))
+'''
+
+
+def cold_start(entry, first_use):
+    # Returns the timings of one cold start, in seconds
+    start = time.perf_counter()
+    output = subprocess.check_output([sys.executable, '-c', CHILD.format(root=ROOT, entry=entry,
+                                                                         first_use=first_use)])
+    timings = json.loads(output.decode())
+    timings['process'] = time.perf_counter() - start
+
+    return timings
+
+
+def main(nRuns):
+    print('{:>6} {:>12} {:>15} {:>14}   {}'.format('path', 'entry [ms]', 'first use [ms]', 'process [ms]',
+                                                  'heavy modules loaded by the entry import'))
+    for path in PATHS:
+        runs = [cold_start(*PATHS[path]) for _ in range(0, nRuns)]
+        median = {key: sorted([run[key] for run in runs])[nRuns // 2] for key in ('entry', 'first_use', 'process')}
+        print('{:>6} {:>12.1f} {:>15.1f} {:>14.1f}   {}'.format(path, median['entry']*1000, median['first_use']*1000,
+                                                             median['process']*1000,
+                                                             ', '.join(runs[0]['loaded']) or '-'))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5)
@@ -0,0 +1,117 @@
+#
+# Benchmark of the float32 processing mode of the encoder (precision='float32') against the default float64 one, on a
+# B-format RIR (the example of the repository by default, with the samples of the .wav file as main.py reads them, or
+# converted to float64 with --float-input, as read from a floating point .wav file). For each precision, the wall time
+# (after a warm-up run of both precisions) and peak allocated memory (tracemalloc, in a separate run) of the early and
+# late parameterization are measured, and the parameters written in the VISR room library entries (as in
+# BridgeWaterHall.json) are compared: for each field, the largest relative difference of the values, and the number of
+# values whose string in the .json file differs.
+#
+# Usage (from the repository root):
+#   python benchmarks/bench_precision.py --wav BFormat_BridgeWaterHall.wav --room 23.97 32.22 21.89
+
+import os
+import sys
+import time
+import argparse
+import tracemalloc
+import numpy as np
+from scipy.io import wavfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from Encoder_SAO_Bformat import EncoderSAOBFormat
+from GenerateJSON import roomentry
+
+PRECISIONS = ['float64', 'float32']
+
+
+def encode(RIRs, fs, RoomDims, n_discrete, precision):
+    early = EncoderSAOBFormat(RIRs=RIRs, fs=fs, n_discrete=n_discrete, precision=precision)
+    early.direct_and_early_parameterization()
+    late = EncoderSAOBFormat(RIRs=RIRs, fs=fs, RoomDims=RoomDims, EarlyProperties=early.param, precision=precision)
+    late.late_parameterization()
+
+    return early.param, late.param
+
+
+def measure(function, repeats):
+    # Returns the output and the median wall time (s) over the repeats, and the peak allocated memory (bytes) of a
+    # further run
+    times = []
+    for _ in range(0, repeats):
+        start = time.perf_counter()
+        output = function()
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return output, float(np.median(times)), peak
+
+
+def entry_fields(paramEarly, paramLate, n_discrete):
+    # Parameters written in a room library entry, as {field: (values, strings in the .json file)}
+    entry = roomentry(paramEarly, paramLate, 'room', n_discrete, 'pointreverb')
+    reflections = [paramEarly['Reflection' + str(idx_refl)] for idx_refl in range(1, n_discrete+1)]
+    late = paramLate['Late']
+    bands = [str(iBand + 1) for iBand in range(0, len(late['level']))]
+    ereflect = entry['room']['ereflect']
+    lreverb = entry['room']['lreverb']
+    fields = {'direct doa': (paramEarly['Direct_sound']['doa'], [entry['position']['az'], entry['position']['el']]),
+              'ereflect level': ([reflection['level'] for reflection in reflections],
+                                 [reflection['level'] for reflection in ereflect]),
+              'ereflect delay': ([reflection['toa'] for reflection in reflections],
+                                 [reflection['delay'] for reflection in ereflect]),
+              'ereflect doa': ([angle for reflection in reflections for angle in reflection['doa']],
+                               [reflection['position'][angle] for reflection in ereflect for angle in ['az', 'el']]),
+              'ereflect biquadsos': (np.concatenate([np.ravel(reflection['filtersos']) for reflection in reflections]),
+                                     [coefficient for reflection in ereflect for biquad in reflection['biquadsos']
+                                      for coefficient in biquad.values()]),
+              'lreverb delay': ([late['toa']], [lreverb['delay']]),
+              'lreverb level': ([late['level'][band] for band in bands], lreverb['level'].split(', ')),
+              'lreverb attacktime': ([late['attacktimes'][band] for band in bands], lreverb['attacktime'].split(', ')),
+              'lreverb decayconst': ([late['expdecays'][band] for band in bands], lreverb['decayconst'].split(', '))}
+
+    return {field: (np.asarray(values, dtype=float), strings) for field, (values, strings) in fields.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Accuracy, time and memory of the float32 mode of the encoder.')
+    parser.add_argument('--wav', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                                                      'BFormat_BridgeWaterHall.wav'))
+    parser.add_argument('--room', type=float, nargs=3, default=[23.97, 32.22, 21.89], help='room dimensions (m)')
+    parser.add_argument('--n-discrete', type=int, default=20)
+    parser.add_argument('--repeats', type=int, default=3, help='timed runs for each precision (default: 3)')
+    parser.add_argument('--float-input', action='store_true', help='convert the samples of the .wav file to float64')
+    args = parser.parse_args()
+
+    fs, RIRs = wavfile.read(args.wav)
+    RIRs = np.array(RIRs, dtype=np.float64 if args.float_input else None)
+
+    # Warm-up (imports, and the tables and filter designs the encoder keeps between RIRs), so that neither precision
+    # is timed cold
+    for precision in PRECISIONS:
+        encode(RIRs, fs, args.room, args.n_discrete, precision)
+
+    entries = {}
+    print('{:>8} {:>11} {:>11}'.format('', 'time [ms]', 'peak [MB]'))
+    for precision in PRECISIONS:
+        (paramEarly, paramLate), elapsed, peak = measure(
+            lambda: encode(RIRs, fs, args.room, args.n_discrete, precision), args.repeats)
+        entries[precision] = entry_fields(paramEarly, paramLate, args.n_discrete)
+        print('{:>8} {:>11} {:>11}'.format(precision, '{:0.1f}'.format(elapsed*1000), '{:0.2f}'.format(peak/2**20)))
+
+    print()
+    print('{:>20} {:>8} {:>15} {:>15}'.format('field', 'values', 'max rel. diff', '.json differs'))
+    for field in entries[PRECISIONS[0]]:
+        reference, referenceStrings = entries[PRECISIONS[0]][field]
+        values, strings = entries[PRECISIONS[1]][field]
+        relative = np.abs(values - reference) / np.maximum(np.abs(reference), np.finfo(float).tiny)
+        print('{:>20} {:>8} {:>15} {:>15}'.format(field, len(values), '{:0.2e}'.format(np.max(relative, initial=0)),
+                                                  sum([a != b for a, b in zip(strings, referenceStrings)])))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,212 @@
+#
+# Benchmark of the encoder stages (Segmentation, Beamformers, LPC, _normalized_sos, and the whole early and late
+# parameterization) on synthetic B-format RIRs (see synthetic_rir.py), across a grid of RIR lengths, numbers of early
+# reflections and sample frequencies. For each point of the grid and each stage, the median wall time over a number of
+# runs and the peak memory allocated (tracemalloc, in a separate run) are measured. The stages 'parameterization' and
+# 'parameterization_workers' run the whole encoder (EncoderSAOBFormat.parameterization) one stage after the other and
+# with --workers threads, so the speedup of the concurrent stages is their ratio (it needs as many CPUs as workers).
+#
+# The results can be saved as a .json baseline, and compared with a previous baseline: stages slower than the baseline
+# by more than the tolerance are reported as regressions (and the script exits with 1).
+#
+# Usage (from the repository root):
+#   python benchmarks/bench_stages.py --grid quick --save benchmarks/baselines/stages_quick.json
+#   python benchmarks/bench_stages.py --grid quick --compare benchmarks/baselines/stages_quick.json
+#   python benchmarks/bench_stages.py --grid quick --workers 4
+
+import os
+import io
+import sys
+import json
+import time
+import platform
+import argparse
+import tracemalloc
+import contextlib
+import numpy as np
+import scipy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from synthetic_rir import SyntheticFOARIR
+from Encoder_SAO_Bformat import EncoderSAOBFormat
+from RIR_Segmentation import Segmentation
+from Beamformers import Beamformers
+from LinearPrediction import lpc
+from Utility import _normalized_sos
+
+ROOMDIMS = [8.0, 6.0, 3.5]
+
+# Grids of RIR lengths (s), numbers of early reflections and sample frequencies
+GRIDS = {'quick': {'length': [0.5, 2.0], 'n_discrete': [10], 'fs': [48000]},
+         'full': {'length': [0.5, 1.0, 2.0, 4.0], 'n_discrete': [5, 10, 20], 'fs': [44100, 48000, 96000]}}
+
+STAGES = ['segmentation', 'beamformers', 'lpc', 'normalized_sos', 'early', 'late', 'parameterization',
+          'parameterization_workers']
+
+
+class StageInputs:
+    # Runs the encoder stages one after the other, keeping the outputs that the following stages need
+
+    def __init__(self, RIRs, fs, n_discrete, workers=4):
+        self.RIRs = RIRs
+        self.fs = fs
+        self.n_discrete = n_discrete
+        self.workers = workers
+        self.hamm_lengths = np.int_([0.002*fs] + [32]*n_discrete)
+        self.LPC_orders = [16] + [8]*n_discrete
+        self.segments = None
+        self.beams = None
+        self.filters = None
+        self.early = None
+
+    def segmentation(self):
+        segmentation = Segmentation(RIRs=self.RIRs, fs=self.fs, groupdelay_threshold=-0.05, use_LPC=1,
+                                    discrete_mode='first', nPeaks=self.n_discrete+1, hamm_lengths=self.hamm_lengths)
+        segmentation.segmentation()
+        self.segments = segmentation.segments
+
+    def beamformers(self):
+        self.beams = []
+        for idx_refl in self.segments:
+            beam = Beamformers(signal=self.segments[idx_refl])
+            beam.steerBFormat()
+            self.beams.append(beam.hBeam)
+
+    def lpc(self):
+        self.filters, _ = lpc(self.beams, self.LPC_orders)
+
+    def normalized_sos(self):
+        for idx_refl in range(0, len(self.beams)):
+            _normalized_sos(self.filters[idx_refl, :self.LPC_orders[idx_refl]+1])
+
+    def run_early(self):
+        self.early = EncoderSAOBFormat(RIRs=self.RIRs, fs=self.fs, n_discrete=self.n_discrete)
+        self.early.direct_and_early_parameterization()
+
+    def run_late(self):
+        late = EncoderSAOBFormat(RIRs=self.RIRs, fs=self.fs, RoomDims=ROOMDIMS, EarlyProperties=self.early.param)
+        late.late_parameterization()
+
+    def run_parameterization(self, workers=None):
+        encoder = EncoderSAOBFormat(RIRs=self.RIRs, fs=self.fs, RoomDims=ROOMDIMS, n_discrete=self.n_discrete,
+                                    workers=workers)
+        encoder.parameterization()
+
+    def run_parameterization_workers(self):
+        self.run_parameterization(self.workers)
+
+
+def measure(function, repeats):
+    # Returns the median wall time (s) over the repeats, and the peak allocated memory (bytes) of a further run
+    times = []
+    for _ in range(0, repeats):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return float(np.median(times)), peak
+
+
+def run_grid(grid, repeats, workers):
+    results = []
+    for fs in grid['fs']:
+        for length in grid['length']:
+            RIRs = SyntheticFOARIR(fs=fs, length=length).generate().RIRs
+            for n_discrete in grid['n_discrete']:
+                inputs = StageInputs(RIRs, fs, n_discrete, workers)
+                stages = {'segmentation': inputs.segmentation, 'beamformers': inputs.beamformers, 'lpc': inputs.lpc,
+                          'normalized_sos': inputs.normalized_sos, 'early': inputs.run_early, 'late': inputs.run_late,
+                          'parameterization': inputs.run_parameterization,
+                          'parameterization_workers': inputs.run_parameterization_workers}
+                error = None
+                for stage in STAGES:
+                    result = {'stage': stage, 'fs': fs, 'length': length, 'n_discrete': n_discrete,
+                              'samples': RIRs.shape[0], 'time': None, 'peak_bytes': None, 'error': error}
+                    if error is None:
+                        try:
+                            with contextlib.redirect_stdout(io.StringIO()):
+                                result['time'], result['peak_bytes'] = measure(stages[stage], repeats)
+                        except Exception as exception:
+                            # E.g. fewer peaks found than the reflections asked for; the following stages are skipped
+                            error = stage + ': ' + type(exception).__name__ + ': ' + str(exception)
+                            result['error'] = error
+
+                    results.append(result)
+                    if result['error'] is not None:
+                        print('{:>8} {:>6.1f} {:>4} {:>24}   skipped ({})'.format(fs, length, n_discrete, stage,
+                                                                                      result['error']))
+                        continue
+                    print('{:>8} {:>6.1f} {:>4} {:>24} {:>11} {:>11}'.format(
+                        fs, length, n_discrete, stage,
+                        '{:0.2f}'.format(result['time']*1000), '{:0.2f}'.format(result['peak_bytes']/2**20)))
+
+    return results
+
+
+def compare(results, baseline, tolerance, min_time=0.001):
+    # Returns the results slower than the baseline by more than the tolerance (times below min_time are ignored)
+    reference = {(entry['stage'], entry['fs'], entry['length'], entry['n_discrete']): entry
+                 for entry in baseline['results']}
+    regressions = []
+    for result in results:
+        entry = reference.get((result['stage'], result['fs'], result['length'], result['n_discrete']))
+        if entry is None or entry['time'] is None or result['time'] is None:
+            continue
+        if result['time'] > tolerance * max(entry['time'], min_time):
+            regressions.append((result, entry))
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of the encoder stages on synthetic B-format RIRs.')
+    parser.add_argument('--grid', choices=sorted(GRIDS), default='quick')
+    parser.add_argument('--repeats', type=int, default=3, help='timed runs for each stage (default: 3)')
+    parser.add_argument('--save', default=None, help='save the results in this .json file')
+    parser.add_argument('--compare', default=None, help='.json baseline to compare the results with')
+    parser.add_argument('--tolerance', type=float, default=1.5, help='slowdown reported as regression (default: 1.5)')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='threads of the parameterization_workers stage (default: 4)')
+    args = parser.parse_args()
+
+    print('{:>8} {:>6} {:>4} {:>24} {:>11} {:>11}'.format('fs', 'len[s]', 'refl', 'stage', 'time [ms]',
+                                                          'peak [MB]'))
+    results = run_grid(GRIDS[args.grid], args.repeats, args.workers)
+    for result in results:
+        if result['stage'] == 'parameterization_workers' and result['time'] is not None:
+            serial = [entry for entry in results if entry['stage'] == 'parameterization' and
+                      (entry['fs'], entry['length'], entry['n_discrete']) ==
+                      (result['fs'], result['length'], result['n_discrete'])][0]
+            print('Speedup with {} workers (fs {}, {} s, {} reflections): {:0.2f}x'.format(
+                args.workers, result['fs'], result['length'], result['n_discrete'], serial['time']/result['time']))
+
+    if args.save is not None:
+        if os.path.dirname(args.save) and not os.path.isdir(os.path.dirname(args.save)):
+            os.makedirs(os.path.dirname(args.save))
+        with open(args.save, 'w') as outfile:
+            json.dump({'grid': args.grid, 'repeats': args.repeats, 'workers': args.workers,
+                       'machine': {'platform': platform.platform(), 'processor': platform.processor(),
+                                   'cpus': os.cpu_count(), 'python': platform.python_version(),
+                                   'numpy': np.__version__,
+                                   'scipy': scipy.__version__},
+                       'results': results}, outfile, indent=1)
+
+    if args.compare is not None:
+        with open(args.compare) as infile:
+            regressions = compare(results, json.load(infile), args.tolerance)
+        for result, entry in regressions:
+            print('REGRESSION: {} (fs {}, {} s, {} reflections): {:0.2f} ms, baseline {:0.2f} ms'.format(
+                result['stage'], result['fs'], result['length'], result['n_discrete'], result['time']*1000,
+                entry['time']*1000))
+        if regressions:
+            sys.exit(1)
+        print('No regressions against ' + args.compare)
+
+
+if __name__ == '__main__':
+    main()
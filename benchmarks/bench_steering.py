@@ -0,0 +1,94 @@
+#
+# Benchmark of the B-format steering (Beamformers.steerBFormat) against the original implementation, which calculated
+# the steered responses over the whole 360x181 grid of DOAs. The coarse-to-fine search ('refine') is also timed.
+#
+# Usage (from the repository root):
+#   python benchmarks/bench_steering.py [path to a B-format .wav file]
+
+import os
+import sys
+import time
+import tracemalloc
+import numpy as np
+from scipy.io import wavfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from Beamformers import Beamformers
+
+
+def steer_grid_reference(segment, d=1):
+    # Original implementation of Beamformers.steerBFormat, kept here as the reference for accuracy and timing
+    W = segment[:, 0]
+    X = segment[:, 1]
+    Y = segment[:, 2]
+    Z = segment[:, 3]
+
+    azimuths = np.linspace(0, np.pi*2-(np.pi/180), 360)
+    elevations = np.linspace(-np.pi/2, np.pi/2, 181)
+
+    steeredresp = np.zeros([len(W), len(azimuths), len(elevations)])
+    for iAz in range(0, len(azimuths)):
+        for iEl in range(0, len(elevations)):
+            r_x = np.cos(elevations[iEl]) * np.cos(azimuths[iAz])
+            r_y = np.cos(elevations[iEl]) * np.sin(azimuths[iAz])
+            r_z = np.sin(elevations[iEl])
+            steeredresp[:, iAz, iEl] = 0.5 * ((2-d)*W + d*(r_x*X + r_y*Y + r_z*Z))
+
+    angular_response = np.squeeze(np.sum(steeredresp**2, 0))
+    max_az, max_el = np.where(angular_response == np.max(angular_response))
+
+    return azimuths[max_az[0]], elevations[max_el[0]], steeredresp[:, max_az[0], max_el[0]]
+
+
+def measure(function, *args):
+    # Returns the output, the wall time in seconds and the peak allocated memory in bytes of a function call
+    tracemalloc.start()
+    start = time.perf_counter()
+    output = function(*args)
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return output, elapsed, peak
+
+
+def steer_engine(segment, search='grid'):
+    beam = Beamformers(signal=segment, search=search)
+    beam.steerBFormat()
+
+    return beam.az_rad_curr, beam.el_rad_curr, beam.hBeam
+
+
+def main(wavpath):
+    fs, RIRs = wavfile.read(wavpath)
+    RIRs = np.array(RIRs, dtype=np.float64)
+    ds = int(np.argmax(np.abs(RIRs[:, 0])))
+
+    # Direct sound window (0.002*fs on each side, as in the encoder), a reflection window and longer segments to show
+    # that the memory used by the steering does not depend on the segment length
+    half_lengths = [int(0.002*fs), 32, 512]
+    steer_engine(RIRs[ds-32:ds+32, :])  # The direction tables are built once, outside of the timings
+    steer_engine(RIRs[ds-32:ds+32, :], 'refine')
+
+    print('{:>8} {:>12} {:>12} {:>9} {:>14} {:>14} {:>6} {:>12} {:>14}'.format(
+        'samples', 'grid [ms]', 'engine [ms]', 'speedup', 'grid peak [MB]', 'engine peak [MB]', 'match',
+        'refine [ms]', 'refine err [deg]'))
+    for half_length in half_lengths:
+        segment = RIRs[max(ds-half_length, 0):ds+half_length, :]
+        ref, t_ref, mem_ref = measure(steer_grid_reference, segment)
+        new, t_new, mem_new = measure(steer_engine, segment)
+        match = ref[0] == new[0] and ref[1] == new[1] and np.allclose(ref[2], new[2])
+
+        # Coarse-to-fine search, with its angular distance from the DOA of the 1 degree grid
+        refined, t_refine, _ = measure(steer_engine, segment, 'refine')
+        cos_err = (np.cos(ref[1]) * np.cos(refined[1]) * np.cos(ref[0] - refined[0]) +
+                   np.sin(ref[1]) * np.sin(refined[1]))
+        err = np.degrees(np.arccos(np.clip(cos_err, -1, 1)))
+        print('{:>8} {:>12.2f} {:>12.2f} {:>8.0f}x {:>14.2f} {:>14.2f} {:>6} {:>12.2f} {:>14.2f}'.format(
+            segment.shape[0], t_ref*1000, t_new*1000, t_ref/t_new, mem_ref/2**20, mem_new/2**20, str(match),
+            t_refine*1000, err))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1] if len(sys.argv) > 1 else
+         os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'BFormat_BridgeWaterHall.wav'))
@@ -0,0 +1,124 @@
+#
+# This class generates deterministic synthetic first-order ambisonic (B-format, W X Y Z) room impulse responses, with
+# known ground truth, for benchmarking. The early part is given by the image sources of a shoebox room (Allen and
+# Berkley, 1979), each one a plane wave encoded in B-format with the same convention as Beamformers (W gain 1, X Y Z
+# gains equal to the direction cosines), or in higher order ambisonics (ACN, SN3D or N3D). The late part is an
+# exponentially decaying diffuse tail: independent noise in each channel, split into the octave bands of the encoder,
+# each band with its own reverberation time.
+#
+# in:
+# * RoomDims: dimensions of the room in meters [x, y, z]
+# * source, receiver: positions in meters [x, y, z]
+# * fs: sample frequency
+# * length: length of the RIR in seconds
+# * RT60: reverberation time in seconds, either one value or one value per octave band (fcentre)
+# * max_order: highest reflection order of the image sources
+# * beta: reflection coefficient of the walls
+# * tail_level: amplitude of the diffuse tail at the direct sound arrival, relative to the direct sound
+# * seed: seed of the noise of the diffuse tail
+# * order, ambisonic_format: ambisonic order and channel format ('WXYZ' for first-order B-format, or 'SN3D', 'N3D')
+#
+# out:
+# * RIRs: (samples x channels) array
+# * truth: dictionary with the TOAs (samples), DOAs (degrees, [azimuth, elevation]), amplitudes and orders of the image
+#   sources (sorted by TOA), and the decay constants per band ('expdecays', in the units of the encoder output)
+
+import os
+import sys
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from FilterGeneration import FilterBank
+from Beamformers import encoding_matrix, sh_degrees
+
+FCENTRE = [1000*2**idx for idx in range(-4, 5)]
+
+
+class SyntheticFOARIR:
+
+    def __init__(self, RoomDims=(8.0, 6.0, 3.5), source=(2.0, 4.5, 1.6), receiver=(5.5, 2.0, 1.4), fs=48000,
+                 length=1.0, RT60=0.8, max_order=3, beta=0.85, tail_level=0.05, seed=0, order=1,
+                 ambisonic_format='WXYZ'):
+        self.RoomDims = np.asarray(RoomDims, dtype=float)
+        self.source = np.asarray(source, dtype=float)
+        self.receiver = np.asarray(receiver, dtype=float)
+        self.fs = fs
+        self.length = length
+        self.RT60 = np.broadcast_to(np.asarray(RT60, dtype=float), (len(FCENTRE),))
+        self.max_order = max_order
+        self.beta = beta
+        self.tail_level = tail_level
+        self.seed = seed
+        self.order = order
+        self.ambisonic_format = ambisonic_format
+        self.speed = 343.1
+
+        self.RIRs = None
+        self.truth = None
+
+    def generate(self):
+        nSamples = int(round(self.length * self.fs))
+        nChannels = (self.order + 1)**2
+        self.RIRs = np.zeros([nSamples, nChannels])
+
+        # Early part: one plane wave for each image source arriving within the RIR
+        positions, orders = self.imageSources()
+        relative = positions - self.receiver
+        distances = np.sqrt(np.sum(relative**2, 1))
+        TOAs = np.int_(np.round(distances / self.speed * self.fs))
+        valid = TOAs < nSamples
+        relative, distances, TOAs, orders = relative[valid], distances[valid], TOAs[valid], orders[valid]
+
+        sort = np.argsort(TOAs, kind='stable')
+        relative, distances, TOAs, orders = relative[sort], distances[sort], TOAs[sort], orders[sort]
+        directions = relative / distances[:, None]
+        amplitudes = self.beta**orders * distances[0] / distances  # Direct sound amplitude equal to 1
+
+        encoding = encoding_matrix(directions, self.order, self.ambisonic_format)
+        degrees = sh_degrees(self.order)
+        np.add.at(self.RIRs, TOAs, encoding * amplitudes[:, None])
+
+        # Late part: diffuse noise decaying from the direct sound arrival, band by band
+        rng = np.random.default_rng(self.seed)
+        noise = rng.standard_normal([nChannels, nSamples])
+        if self.ambisonic_format != 'N3D':
+            # Diffuse field: the 2n+1 channels of degree n share the energy of W (N3D channels have the same energy)
+            noise = noise / np.sqrt(2*degrees + 1)[:, None]
+        t = np.arange(0, nSamples - TOAs[0]) / self.fs
+        filterbank = FilterBank(fcentre=FCENTRE, BW=1, fs=self.fs)
+        filterbank.octaveBankSOS()
+        for idx_chan in range(0, nChannels):
+            filterbank.filterZeroPhase(noise[idx_chan, :])
+            envelopes = np.exp(-3*np.log(10) * t[None, :] / self.RT60[:, None])
+            tail = np.sum(filterbank.filtered[:, TOAs[0]:] * envelopes, 0)
+            self.RIRs[TOAs[0]:, idx_chan] += self.tail_level * tail / np.sqrt(np.mean(tail[:self.fs//100]**2))
+
+        azimuths = np.mod(np.degrees(np.arctan2(directions[:, 1], directions[:, 0])), 360)
+        elevations = np.degrees(np.arcsin(np.clip(directions[:, 2], -1, 1)))
+        self.truth = {'toa': TOAs,
+                      'doa': np.stack([azimuths, elevations], 1),
+                      'amplitude': amplitudes,
+                      'order': orders,
+                      'expdecays': -3*np.log(10) / self.RT60}
+
+        return self
+
+    def imageSources(self):
+        # Positions and reflection orders of the image sources up to max_order
+        positions = []
+        orders = []
+        N = self.max_order
+        for nx in range(-N, N+1):
+            for ny in range(-N, N+1):
+                for nz in range(-N, N+1):
+                    for u in (0, 1):
+                        for v in (0, 1):
+                            for w in (0, 1):
+                                order = abs(2*nx - u) + abs(2*ny - v) + abs(2*nz - w)
+                                if order > N:
+                                    continue
+                                mirror = np.array([1 - 2*u, 1 - 2*v, 1 - 2*w])
+                                positions.append(2*np.array([nx, ny, nz])*self.RoomDims + mirror*self.source)
+                                orders.append(order)
+
+        return np.array(positions), np.array(orders)
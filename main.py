@@ -4,8 +4,8 @@ This Python package estimates the Reverberant Spatial Audio Object (RSAO) given
 Input:
 .wav file containing the 4 channels of a B-Format RIR
 OutPut:
-It saves two files containing the RSAO parameters related to the early reflections (plus direct sound) and the late
-reverberation, respectively.
+It saves a .npz file containing the RSAO parameters related to the early reflections (plus direct sound) and the late
+reverberation, together with the encoder settings (see ParameterStore.py).
 Additionally it also saves a .json file, that contains the RSAO metadata that can be read by VISR, the object-based S3A
 renderer.
 
@@ -23,9 +23,14 @@ If you use any code included in this package for research purposes, please cite
 
 from Encoder_SAO_Bformat import EncoderSAOBFormat
 from GenerateJSON import GenerateJSON_RSAO
+from ParameterStore import ParameterStore, encoder_settings
+from ResultCache import ResultCache
 from scipy.io import wavfile
 import numpy as np
-import pickle
+import logging
+
+# Show the messages of the encoder (e.g. the mixing time estimation) on the console
+logging.basicConfig(level=logging.INFO, format='%(message)s')
 
 ##############################################################
 # Loading RIRs
@@ -42,26 +47,26 @@ z_dim = float(input('Input the length oh the z dimension of the room: '))
 RoomDims = [x_dim, y_dim, z_dim]
 #RoomDims = [23.97, 32.22, 21.89]  # This are the dimensions related to the example (i.e. Bridge Water Hall)
 
+# Outputs of previous runs on the same RIR and with the same options are reused from the cache
+cache = ResultCache(directory='RSAO_cache')
+
 # Defining the early reflection object
-EarlyReflections = EncoderSAOBFormat(RIRs=RIRs, discrete_mode='strongest', n_discrete=20)
+EarlyReflections = EncoderSAOBFormat(RIRs=RIRs, discrete_mode='strongest', n_discrete=20, cache=cache)
 # Calculating the early reflection parameters
 EarlyReflections.direct_and_early_parameterization()
 
 # Defining the late reverberation object
-LateReverb = EncoderSAOBFormat(RIRs=RIRs, RoomDims=RoomDims, EarlyProperties=EarlyReflections.param)
+LateReverb = EncoderSAOBFormat(RIRs=RIRs, RoomDims=RoomDims, EarlyProperties=EarlyReflections.param, cache=cache)
 # Calculating the late reverberation parameters
 LateReverb.late_parameterization()
 
 ##############################################################
-# Save objects
+# Save parameters
 ##############################################################
-with open('RSAO_Early_params', 'wb') as output:
-    pickler = pickle.Pickler(output, -1)
-    pickler.dump(EarlyReflections)
-
-with open('RSAO_Late_params', 'wb') as output:
-    pickler = pickle.Pickler(output, -1)
-    pickler.dump(LateReverb)
+settings = encoder_settings(EarlyReflections)
+settings['RoomDims'] = RoomDims
+ParameterStore(filename='RSAO_params.npz', paramEarly=EarlyReflections.param, paramLate=LateReverb.param,
+               settings=settings).save()
 
 ##############################################################
 # Write json file containing BFormat-derived parameters
@@ -0,0 +1,31 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from BatchEncoding import BatchEncoder
+
+
+def test_same_wav_names_in_different_folders(tmp_path):
+    manifest = [{'wav': os.path.join('room1', 'rir.wav'), 'RoomDims': [10, 8, 4]},
+                {'wav': os.path.join('room2', 'rir.wav'), 'RoomDims': [12, 9, 5]},
+                {'wav': 'hall.wav', 'RoomDims': [30, 20, 12]}]
+    batch = BatchEncoder(str(tmp_path / 'manifest.json'), outdir=str(tmp_path / 'out'), save_params=True)
+    batch.resolve(manifest)
+
+    assert [entry['name'] for entry in batch.entries] == ['room1_rir', 'room2_rir', 'hall']
+    outputs = [entry[key] for entry in batch.entries for key in ('output', 'params')]
+    assert len(set(outputs)) == len(outputs)
+    assert batch.results == [None, None, None]
+
+
+def test_clashing_outputs_fail(tmp_path):
+    manifest = [{'wav': os.path.join('room1', 'rir.wav'), 'RoomDims': [10, 8, 4], 'name': 'rir'},
+                {'wav': os.path.join('room2', 'rir.wav'), 'RoomDims': [12, 9, 5], 'name': 'rir'}]
+    batch = BatchEncoder(str(tmp_path / 'manifest.json'), outdir=str(tmp_path / 'out'))
+    batch.resolve(manifest)
+
+    assert batch.entries[0]['output'] == os.path.join(str(tmp_path / 'out'), 'rir.json')
+    assert batch.entries[1] is None
+    assert batch.results[1]['status'] == 'failed'
+    assert 'manifest entry 1' in batch.results[1]['error']